@@ -0,0 +1,277 @@
+"""Read and write the cbf files of the Pilatus with numpy.
+
+Only the x-CBF_BYTE_OFFSET compression written by camserver is
+supported. The decoder is vectorized: the escape sequences of the byte
+offset stream are located with numpy and only the rare ambiguous ones
+are resolved in python.
+"""
+
+import re
+
+import numpy as np
+
+BINARY_MARKER = b"\x0c\x1a\x04\xd5"
+# bytes of the delta following each escape marker
+ESCAPE_16 = 3
+ESCAPE_32 = 7
+ESCAPE_64 = 15
+
+ELEMENT_TYPES = {
+    "signed 32-bit integer": np.int32,
+    "unsigned 32-bit integer": np.uint32,
+    "signed 16-bit integer": np.int16,
+    "unsigned 16-bit integer": np.uint16,
+}
+
+_MIME_FIELD = re.compile(
+    br"^\s*(X-Binary-[\w-]+|conversions)\s*[:=]\s*\"?([^\"\r\n]*)\"?",
+    re.MULTILINE)
+
+
+class CbfError(ValueError):
+    "Malformed or unsupported cbf file"
+
+
+def parse_header(header):
+    """Return the MIME fields of the binary section as a dict of strings,
+    plus "contents": the lines of _array_data.header_contents, with the
+    exposure time and the other camserver settings."""
+    fields = dict(
+        (key.decode(), value.decode().strip())
+        for key, value in _MIME_FIELD.findall(header))
+    contents = []
+    for line in header.decode("ascii", "replace").splitlines():
+        if line.startswith("# "):
+            contents.append(line[2:].strip())
+    fields["contents"] = contents
+    return fields
+
+
+def _integer(fields, key):
+    try:
+        return int(fields[key])
+    except (KeyError, ValueError):
+        raise CbfError("missing or invalid {0}".format(key))
+
+
+def frame_shape(fields):
+    return (
+        _integer(fields, "X-Binary-Size-Second-Dimension"),
+        _integer(fields, "X-Binary-Size-Fastest-Dimension"))
+
+
+def frame_dtype(fields):
+    element_type = fields.get(
+        "X-Binary-Element-Type", "signed 32-bit integer")
+    try:
+        return np.dtype(ELEMENT_TYPES[element_type])
+    except KeyError:
+        raise CbfError("unsupported element type {0}".format(element_type))
+
+
+def _gather_le(raw, positions, n_bytes):
+    "Little endian signed integers of n_bytes starting at each position"
+    value = np.zeros(len(positions), dtype=np.uint64)
+    for byte in range(n_bytes):
+        value |= (raw[positions + byte].astype(np.uint64) <<
+                  np.uint64(8 * byte))
+    signed = {2: np.int16, 4: np.int32, 8: np.int64}[n_bytes]
+    unsigned = {2: np.uint16, 4: np.uint32, 8: np.uint64}[n_bytes]
+    return value.astype(unsigned).view(signed).astype(np.int64)
+
+
+def decode_byte_offset(stream, n_elements, out=None, dtype=np.int32):
+    """Decode a x-CBF_BYTE_OFFSET stream.
+
+    Args:
+        stream: bytes or uint8 array with the compressed data
+        n_elements: number of pixels
+        out: optional preallocated array of n_elements items, filled in
+            place
+        dtype: of the output when out is not given
+
+    Returns:
+        flat array of the pixel values
+    """
+    raw = np.frombuffer(stream, dtype=np.uint8)
+    # padding, so that the escape lookups never run past the end
+    raw = np.concatenate((raw, np.zeros(ESCAPE_64, dtype=np.uint8)))
+    size = len(raw) - ESCAPE_64
+    candidates = np.flatnonzero(raw[:size] == 0x80)
+    lengths = np.full(len(candidates), ESCAPE_16, dtype=np.int64)
+    if len(candidates):
+        wide = _gather_le(raw, candidates + 1, 2) == -0x8000
+        lengths[wide] = ESCAPE_32
+        wider = wide.copy()
+        wider[wide] = _gather_le(raw, candidates[wide] + 3, 4) == -0x80000000
+        lengths[wider] = ESCAPE_64
+    # a 0x80 byte is an escape unless it lies in the delta of the previous
+    # escape; deltas are at most 14 bytes long, so only candidates closer
+    # than that to the previous one need a look
+    real = np.ones(len(candidates), dtype=bool)
+    close = np.flatnonzero(np.diff(candidates) < ESCAPE_64) + 1
+    for j in close:
+        i = j - 1
+        while not real[i]:
+            i -= 1
+        if candidates[j] < candidates[i] + lengths[i]:
+            real[j] = False
+    escapes = candidates[real]
+    lengths = lengths[real]
+    # positions of the first byte of each delta
+    payload = (
+        np.bincount(escapes + 1, minlength=size)[:size] -
+        np.bincount(escapes + lengths, minlength=size)[:size])
+    starts = np.flatnonzero(np.cumsum(payload) == 0)
+    if len(starts) != n_elements:
+        raise CbfError(
+            "byte offset stream has {0} elements, expected {1}".format(
+                len(starts), n_elements))
+    deltas = raw[starts].view(np.int8).astype(np.int64)
+    tokens = np.searchsorted(starts, escapes)
+    for length, offset, n_bytes in (
+            (ESCAPE_16, 1, 2), (ESCAPE_32, 3, 4), (ESCAPE_64, 7, 8)):
+        selected = lengths == length
+        deltas[tokens[selected]] = _gather_le(
+            raw, escapes[selected] + offset, n_bytes)
+    if out is None:
+        out = np.empty(n_elements, dtype=dtype)
+    flat = out.reshape(-1)
+    np.cumsum(deltas, out=deltas)
+    flat[...] = deltas
+    return out
+
+
+def encode_byte_offset(data):
+    "x-CBF_BYTE_OFFSET stream of an integer array, as bytes"
+    values = np.asarray(data).astype(np.int64).ravel()
+    deltas = np.diff(np.concatenate(([0], values)))
+    lengths = np.ones(len(deltas), dtype=np.int64)
+    lengths[np.abs(deltas) > 127] = ESCAPE_16
+    lengths[np.abs(deltas) > 32767] = ESCAPE_32
+    lengths[np.abs(deltas) > 2147483647] = ESCAPE_64
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    stream = np.zeros(int(lengths.sum()), dtype=np.uint8)
+
+    def scatter(positions, value, n_bytes):
+        value = value.astype(np.int64).view(np.uint64)
+        for byte in range(n_bytes):
+            stream[positions + byte] = (
+                value >> np.uint64(8 * byte)) & np.uint64(0xff)
+
+    one = lengths == 1
+    stream[offsets[one]] = deltas[one].astype(np.int8).view(np.uint8)
+    escaped = lengths > 1
+    stream[offsets[escaped]] = 0x80
+    selected = lengths == ESCAPE_16
+    scatter(offsets[selected] + 1, deltas[selected], 2)
+    selected = lengths >= ESCAPE_32
+    stream[offsets[selected] + 1] = 0x00
+    stream[offsets[selected] + 2] = 0x80
+    selected = lengths == ESCAPE_32
+    scatter(offsets[selected] + 3, deltas[selected], 4)
+    selected = lengths == ESCAPE_64
+    stream[offsets[selected] + 6] = 0x80
+    scatter(offsets[selected] + 7, deltas[selected], 8)
+    return stream.tobytes()
+
+
+def split(contents):
+    "Header and compressed data of the bytes of a cbf file"
+    marker = contents.find(BINARY_MARKER)
+    if marker < 0:
+        raise CbfError("no binary section")
+    header = contents[:marker]
+    fields = parse_header(header)
+    if "x-CBF_BYTE_OFFSET" not in fields.get("conversions", ""):
+        raise CbfError("unsupported compression {0}".format(
+            fields.get("conversions")))
+    start = marker + len(BINARY_MARKER)
+    size = _integer(fields, "X-Binary-Size")
+    return fields, contents[start:start + size]
+
+
+def read_header(path):
+    "MIME fields and header contents of a cbf file"
+    with open(path, "rb") as input_file:
+        contents = input_file.read()
+    return split(contents)[0]
+
+
+def read_cbf(path, out=None):
+    """Decode a cbf file.
+
+    Args:
+        path: of the cbf file
+        out: optional preallocated array with the shape of the frame,
+            for example one frame of a stack, filled in place
+
+    Returns:
+        the frame as a 2D array
+    """
+    with open(path, "rb") as input_file:
+        contents = input_file.read()
+    fields, stream = split(contents)
+    shape = frame_shape(fields)
+    if out is None:
+        out = np.empty(shape, dtype=frame_dtype(fields))
+    elif out.shape != shape:
+        raise CbfError("frame of shape {0} does not fit into {1}".format(
+            shape, out.shape))
+    decode_byte_offset(stream, shape[0] * shape[1], out=out)
+    return out
+
+
+def write_cbf(path, data, contents=()):
+    """Write a 2D integer array to a byte offset compressed cbf file, with
+    the same layout as the files of camserver.
+
+    Args:
+        contents: header lines, without the leading "# "
+    """
+    data = np.asarray(data)
+    stream = encode_byte_offset(data)
+    element_type = dict(
+        (np.dtype(value), key) for key, value in ELEMENT_TYPES.items())
+    header_contents = "".join("# {0}\r\n".format(line) for line in contents)
+    header = (
+        "###CBF: VERSION 1.5, python controls\r\n"
+        "\r\n"
+        "data_frame\r\n"
+        "\r\n"
+        "_array_data.header_convention \"PILATUS_1.2\"\r\n"
+        "_array_data.header_contents\r\n"
+        ";\r\n"
+        "{contents}"
+        ";\r\n"
+        "\r\n"
+        "_array_data.data\r\n"
+        ";\r\n"
+        "--CIF-BINARY-FORMAT-SECTION--\r\n"
+        "Content-Type: application/octet-stream;\r\n"
+        "     conversions=\"x-CBF_BYTE_OFFSET\"\r\n"
+        "Content-Transfer-Encoding: BINARY\r\n"
+        "X-Binary-Size: {size}\r\n"
+        "X-Binary-ID: 1\r\n"
+        "X-Binary-Element-Type: \"{element_type}\"\r\n"
+        "X-Binary-Element-Byte-Order: LITTLE_ENDIAN\r\n"
+        "X-Binary-Number-of-Elements: {n_elements}\r\n"
+        "X-Binary-Size-Fastest-Dimension: {columns}\r\n"
+        "X-Binary-Size-Second-Dimension: {rows}\r\n"
+        "X-Binary-Size-Padding: 4095\r\n"
+        "\r\n"
+    ).format(
+        contents=header_contents,
+        size=len(stream),
+        element_type=element_type.get(data.dtype, "signed 32-bit integer"),
+        n_elements=data.size,
+        columns=data.shape[1],
+        rows=data.shape[0],
+    )
+    footer = "\r\n--CIF-BINARY-FORMAT-SECTION----\r\n;\r\n\r\n"
+    with open(path, "wb") as output_file:
+        output_file.write(header.encode("ascii"))
+        output_file.write(BINARY_MARKER)
+        output_file.write(stream)
+        output_file.write(b"\x00" * 4095)
+        output_file.write(footer.encode("ascii"))
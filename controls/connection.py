@@ -0,0 +1,227 @@
+import logging
+import socket
+import struct
+import time
+
+import controls.exceptions
+
+logger = logging.getLogger(__name__)
+
+# timeout argument standing for the default timeout of the connection
+DEFAULT = object()
+
+
+class FramedConnection(object):
+    """Buffered TCP connection to a command based detector server.
+
+    Received bytes are kept in a buffer and split into replies, either on
+    a delimiter or on a struct packed length prefix. Without either, each
+    recv() is taken as one reply, which is how the servers used to be
+    read. Several commands can be sent before reading their replies, which
+    then come back in order.
+
+    A reply that times out is still on its way: resynchronise with drain()
+    before sending new commands.
+    """
+
+    def __init__(self, host, port, terminator="\n", delimiter=None,
+                 length_format=None, timeout=5, buffer_size=4096):
+        """
+        Args:
+            terminator: appended to every command
+            delimiter: ending each reply
+            length_format: struct format of the length prefix of each
+                reply, instead of a delimiter
+            timeout: default seconds to wait for a reply, None to wait
+                forever
+            buffer_size: of each recv()
+        """
+        super(FramedConnection, self).__init__()
+        self.host = host
+        self.port = port
+        self.terminator = terminator
+        self.delimiter = _bytes(delimiter) if delimiter else None
+        self.length_format = length_format
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.socket = None
+        self.buffer = bytearray()
+        # replies requested and not received yet
+        self.outstanding = 0
+
+    @property
+    def is_open(self):
+        return self.socket is not None
+
+    def open(self, timeout=5):
+        """Connect to the first address of host that accepts.
+
+        Returns:
+            True if connected
+        """
+        self.close()
+        for family, socket_type, protocol, _, address in socket.getaddrinfo(
+                self.host, self.port, socket.AF_UNSPEC, socket.SOCK_STREAM):
+            try:
+                connection = socket.socket(family, socket_type, protocol)
+            except socket.error as msg:
+                logger.error("socket connection failed %s", msg)
+                continue
+            try:
+                connection.settimeout(timeout)
+                connection.connect(address)
+                connection.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except socket.error as msg:
+                logger.error("socket connection failed %s", msg)
+                connection.close()
+                continue
+            self.socket = connection
+            self.buffer = bytearray()
+            self.outstanding = 0
+            return True
+        return False
+
+    def close(self):
+        if self.socket is None:
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+        self.socket = None
+
+    def send(self, command, replies=1):
+        """Send a command without waiting for its replies.
+
+        Args:
+            replies: number of replies the command gets
+        """
+        if self.socket is None:
+            raise controls.exceptions.CameraInterrupt(
+                "not connected to {0}:{1}".format(self.host, self.port))
+        logger.debug("sending %r", command)
+        self.socket.settimeout(None)
+        self.socket.sendall(_bytes(command + self.terminator))
+        self.outstanding += replies
+
+    def send_raw(self, data):
+        "Send data as it is, expecting no reply"
+        self.socket.settimeout(None)
+        self.socket.sendall(_bytes(data))
+
+    def receive(self, timeout=DEFAULT):
+        """Next reply.
+
+        Args:
+            timeout: seconds, None to wait forever
+
+        Returns:
+            the reply, or None if it did not arrive in time
+        """
+        if timeout is DEFAULT:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            reply = self._pop_reply()
+            if reply is not None:
+                self.outstanding = max(0, self.outstanding - 1)
+                reply = reply.decode("ascii", "replace")
+                logger.debug("received %r", reply)
+                return reply
+            if deadline is None:
+                self.socket.settimeout(None)
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.socket.settimeout(remaining)
+            try:
+                chunk = self.socket.recv(self.buffer_size)
+            except socket.timeout:
+                return None
+            if not chunk:
+                self.close()
+                raise controls.exceptions.CameraInterrupt(
+                    "connection closed by {0}:{1}".format(
+                        self.host, self.port))
+            self.buffer.extend(chunk)
+
+    def expect(self, timeout=DEFAULT):
+        "Next reply, raising CameraInterrupt if it did not arrive in time"
+        reply = self.receive(timeout)
+        if reply is None:
+            raise controls.exceptions.CameraInterrupt(
+                "no reply from {0}:{1} within {2} s".format(
+                    self.host, self.port,
+                    self.timeout if timeout is DEFAULT else timeout))
+        return reply
+
+    def command(self, command, timeout=DEFAULT):
+        "Send a command and return its reply"
+        self.send(command)
+        return self.expect(timeout)
+
+    def pipeline(self, commands, timeout=DEFAULT):
+        """Send all the commands, then read their replies.
+
+        Returns:
+            the list of replies, in the order of the commands
+        """
+        for command in commands:
+            self.send(command)
+        return [self.expect(timeout) for _ in commands]
+
+    def drain(self, timeout=0.1, outstanding_timeout=DEFAULT):
+        """Read the replies still expected, each within
+        outstanding_timeout, then anything else the server sends within
+        timeout, and forget about them.
+
+        Returns:
+            the replies read
+        """
+        replies = []
+        while self.outstanding > 0:
+            reply = self.receive(outstanding_timeout)
+            if reply is None:
+                break
+            replies.append(reply)
+        while True:
+            reply = self.receive(timeout)
+            if reply is None:
+                break
+            replies.append(reply)
+        self.outstanding = 0
+        return replies
+
+    def _pop_reply(self):
+        if self.delimiter is not None:
+            end = self.buffer.find(self.delimiter)
+            if end < 0:
+                return None
+            reply = bytes(self.buffer[:end])
+            del self.buffer[:end + len(self.delimiter)]
+            return reply
+        if self.length_format is not None:
+            header = struct.calcsize(self.length_format)
+            if len(self.buffer) < header:
+                return None
+            length, = struct.unpack(
+                self.length_format, bytes(self.buffer[:header]))
+            if len(self.buffer) < header + length:
+                return None
+            reply = bytes(self.buffer[header:header + length])
+            del self.buffer[:header + length]
+            return reply
+        if not self.buffer:
+            return None
+        reply = bytes(self.buffer)
+        del self.buffer[:]
+        return reply
+
+
+def _bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("ascii")
@@ -1,32 +1,358 @@
-import dectris.albula
 import os
 import logging
 import datetime
 import json
 import requests
+import struct
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    import dectris.albula
+except ImportError:
+    dectris = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
 
 import controls.hdf5
+import controls.exceptions
+import controls.timing
 
 logger = logging.getLogger(__name__)
 
+STREAM_PORT = 9999
+# encoding of the frames on the stream: compression of the hdf5 stack
+STREAM_ENCODINGS = {
+    "lz4<": controls.hdf5.COMPRESSION_LZ4,
+    "bs32-lz4<": controls.hdf5.COMPRESSION_BSLZ4,
+    "bs16-lz4<": controls.hdf5.COMPRESSION_BSLZ4,
+    "bs8-lz4<": controls.hdf5.COMPRESSION_BSLZ4,
+}
+
+
+def decode_frame(info, blob):
+    """Frame of the stream from its dimage_d part and its data.
+
+    Compressed frames are kept compressed, as a
+    controls.hdf5.CompressedFrame: the bslz4 data already is a chunk of
+    the bitshuffle filter, and the single lz4 block gets the header of
+    the lz4 filter.
+    """
+    shape = tuple(reversed(info["shape"]))
+    dtype = np.dtype(info["type"]).newbyteorder("<")
+    encoding = info.get("encoding", "<")
+    if encoding == "<":
+        return np.frombuffer(blob, dtype=dtype).reshape(shape)
+    if encoding not in STREAM_ENCODINGS:
+        raise controls.exceptions.EigerError(
+            "unsupported stream encoding {0}".format(encoding))
+    compression = STREAM_ENCODINGS[encoding]
+    chunk = bytes(blob)
+    if compression == controls.hdf5.COMPRESSION_LZ4:
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        header = struct.pack(">QI", n_bytes, n_bytes)
+        if len(chunk) >= n_bytes:
+            # the filter would take a block this long as not compressed
+            if lz4 is None:
+                raise controls.exceptions.EigerError(
+                    "decoding an lz4 frame needs the lz4 package")
+            return np.frombuffer(
+                lz4.block.decompress(chunk, uncompressed_size=n_bytes),
+                dtype=dtype).reshape(shape)
+        chunk = header + struct.pack(">I", len(chunk)) + chunk
+    return controls.hdf5.CompressedFrame(chunk, shape, dtype, compression)
+
+
+class ZmqStream(object):
+    """Client of the zmq stream of the DCU, with the interface of
+    dectris.albula.DEigerStream, that does not decompress the frames.
+
+    pop() returns the "dheader", "data" and "dseries_end" messages as
+    dicts, the frame of a "data" message as returned by decode_frame().
+    With the hdf5 compression of the Eiger set to the one of the stream
+    (COMPRESSION_BSLZ4 for the DCU default), the frames are written to
+    the file as they arrive. Needs pyzmq.
+    """
+
+    def __init__(self, host, port=80, stream_port=STREAM_PORT,
+                 timeout=None):
+        """
+        Args:
+            port: of the HTTP API
+            stream_port: of the zmq stream
+            timeout: seconds pop() waits for a message, None for ever
+        """
+        super(ZmqStream, self).__init__()
+        if zmq is None:
+            raise controls.exceptions.EigerError(
+                "the zmq stream needs the pyzmq package")
+        self.host = host
+        self.port = port
+        self.api_version = None
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PULL)
+        if timeout is not None:
+            self.socket.setsockopt(zmq.RCVTIMEO, int(1000 * timeout))
+        self.socket.connect("tcp://{0}:{1}".format(host, stream_port))
+
+    def url(self, path):
+        if self.api_version is None:
+            self.api_version = self.version()
+        return "http://{0}:{1}/stream/api/{2}/{3}".format(
+            self.host, self.port, self.api_version, path)
+
+    def version(self):
+        return requests.get("http://{0}:{1}/stream/api/version/".format(
+            self.host, self.port)).json()["value"]
+
+    def setEnabled(self, enabled):
+        requests.put(
+            self.url("config/mode"),
+            json={"value": "enabled" if enabled else "disabled"})
+
+    def enabled(self):
+        return requests.get(
+            self.url("config/mode")).json()["value"] == "enabled"
+
+    def pop(self):
+        parts = self.socket.recv_multipart(copy=False)
+        header = json.loads(parts[0].bytes.decode())
+        htype = header["htype"].split("-")[0]
+        if htype == "dimage":
+            info = json.loads(parts[1].bytes.decode())
+            return {
+                "type": "data",
+                "series": header["series"],
+                "frame": header["frame"],
+                "data": decode_frame(info, parts[2].buffer),
+            }
+        message = dict(header)
+        message["type"] = htype
+        return message
+
+    def close(self):
+        self.socket.close()
+
+
+class StreamWriter(object):
+    """Drain one series from the detector stream into an hdf5 file while
+    it is being acquired.
+
+    A reader thread pops the stream into a bounded queue and a writer
+    thread empties the queue into the Hdf5Writer. When the writer falls
+    behind, the reader blocks and the frames wait on the DCU, so the
+    memory used on both sides stays bounded.
+    """
+
+    def __init__(self, stream, hdf5_writer, queue_size=64):
+        super(StreamWriter, self).__init__()
+        self.stream = stream
+        self.hdf5_writer = hdf5_writer
+        self.frames = queue.Queue(queue_size)
+        self.errors = []
+        self.frames_received = 0
+        # time.time() at which each frame came off the stream
+        self.arrival_times = []
+        self.reading = True
+        self.arrived = threading.Condition()
+        self.reader = threading.Thread(
+            target=self._read, name="eiger-stream-reader")
+        self.writer = threading.Thread(
+            target=self._write, name="eiger-stream-writer")
+        self.reader.daemon = True
+        self.writer.daemon = True
+
+    @property
+    def filename(self):
+        return self.hdf5_writer.filename
+
+    def start(self):
+        self.hdf5_writer.open()
+        self.writer.start()
+        self.reader.start()
+
+    def is_alive(self):
+        return self.reader.is_alive() or self.writer.is_alive()
+
+    def wait_for_frame(self, n, timeout=None):
+        """Wait until n frames of the series arrived on the stream.
+
+        Returns:
+            True if they did, False on timeout or if the series ended
+            before.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.arrived:
+            while self.frames_received < n and self.reading:
+                if timeout is None:
+                    self.arrived.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.arrived.wait(remaining)
+            return self.frames_received >= n
+
+    def join(self):
+        "Wait for the end of the series and for the file to be closed"
+        self.reader.join()
+        self.writer.join()
+        if self.errors:
+            raise controls.exceptions.EigerError(
+                "saving the stream to {0} failed: {1}".format(
+                    self.filename, self.errors[0]))
+
+    def _read(self):
+        try:
+            # series header
+            self.stream.pop()
+            data = self.stream.pop()
+            while data["type"] == "data":
+                self.arrival_times.append(time.time())
+                self.frames.put(data["data"])
+                with self.arrived:
+                    self.frames_received += 1
+                    self.arrived.notify_all()
+                with controls.timing.span("eiger.stream"):
+                    data = self.stream.pop()
+        except Exception as e:
+            logger.exception("reading the eiger stream failed")
+            self.errors.append(e)
+        finally:
+            with self.arrived:
+                self.reading = False
+                self.arrived.notify_all()
+            self.frames.put(None)
+
+    def _write(self):
+        try:
+            frame = self.frames.get()
+            while frame is not None:
+                with controls.timing.span("eiger.write"):
+                    self.hdf5_writer.write(frame)
+                if self.frames.empty():
+                    # idle, so keep the tail left for save() short
+                    self.hdf5_writer.flush()
+                frame = self.frames.get()
+        except Exception as e:
+            logger.exception("writing %s failed", self.filename)
+            self.errors.append(e)
+            # keep the reader from blocking on a full queue
+            while frame is not None:
+                frame = self.frames.get()
+        finally:
+            self.hdf5_writer.close()
+
+
+class TriggerHandle(object):
+    """Completion handle of an Eiger trigger.
+
+    exposed() returns once the detector answered the trigger command, that
+    is once the exposure is over and motors may move again. result() also
+    waits for the frame to arrive on the stream.
+    """
 
-class Eiger(dectris.albula.DEigerDetector):
+    def __init__(self, command, stream_writer, frame, timeout):
+        super(TriggerHandle, self).__init__()
+        self.command = command
+        self.stream_writer = stream_writer
+        self.frame = frame
+        self.timeout = timeout
+
+    def done(self):
+        return self.command.done() and (
+            self.stream_writer is None or
+            self.stream_writer.frames_received >= self.frame)
+
+    def exposed(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return self.command.result(timeout)
+
+    def result(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        response = self.exposed(timeout)
+        if self.stream_writer is not None and not (
+                self.stream_writer.wait_for_frame(self.frame, timeout)):
+            raise controls.exceptions.EigerError(
+                "frame {0} did not arrive on the stream within {1}s".format(
+                    self.frame, timeout))
+        return response
+
+
+class Eiger(object):
 
     def __init__(self,
                  host,
                  port=80,
                  photon_energy=10000,
-                 storage_path="."):
+                 storage_path=".",
+                 hdf5_layout=controls.hdf5.LAYOUT_STACK,
+                 compression=None,
+                 num_image_per_file=None,
+                 stream=None):
+        """
+        Args:
+            stream: source of the frames with the interface of
+                dectris.albula.DEigerStream, by default the stream of the
+                detector at host. With ZmqStream(host) and compression
+                set to the encoding of the stream, the frames are saved
+                without being decompressed. dectris.albula is only needed
+                for the default stream.
+        """
 
         self.host = host
         self.port = port
         self.storage_path = storage_path
-        super(Eiger, self).__init__(host, port)
+        self.hdf5_layout = hdf5_layout
+        self.compression = compression
+        self.num_image_per_file = num_image_per_file
+        # Hdf5Writer observers of the frames of every series
+        self.frame_observers = []
+        # save one frame out of decimation, none with 0
+        self.decimation = 1
+        # stack index of each frame of the next series, None in order
+        self.frame_order = None
+        self.n_trigger = 1
+        self.n_images = 1
+        self.n_triggered = 0
+        self.stream_writer = None
+        # time.time() at which each frame of the last saved series came
+        # off the stream
+        self.frame_arrivals = []
+        self.session = None
+        self.api_version = None
+        # every request, sent in order by a single thread
+        self.command_executor = ThreadPoolExecutor(1)
+        self.pending_commands = []
         self.initialize()
         self.setNImages(1)
-        self.send_command("config/trigger_mode", {"value": "inte"})
-        self.stream = dectris.albula.DEigerStream(host, port)
+        self.send_command("config/trigger_mode", {"value": "inte"}, wait=False)
+        if stream is None:
+            if dectris is None:
+                raise controls.exceptions.EigerError(
+                    "dectris.albula is needed for the default stream, "
+                    "pass stream= otherwise")
+            stream = dectris.albula.DEigerStream(host, port)
+        self.stream = stream
         self.stream.setEnabled(True)
         logger.debug(
             "eiger version %s returns status %s",
@@ -41,42 +367,206 @@ class Eiger(dectris.albula.DEigerDetector):
         logger.debug("Set energy to %s eV", photon_energy)
         self.setPhotonEnergy(photon_energy)
 
-    def send_command(self, path, dictionary):
-        url = 'http://{0}:{1}/detector/api/{2}/{3}'.format(
+    def initialize(self):
+        """(Re)connect: open a new keep-alive HTTP session, forget the
+        cached API version and initialize the detector."""
+        self.reset_session()
+        return self.send_command("command/initialize", {})
+
+    def version(self):
+        "Version of the detector API"
+        return self.command_executor.submit(self._get_version).result()
+
+    def status(self):
+        "State of the detector, e.g. idle or ready"
+        return self.get_value("status/state")
+
+    def get_value(self, path):
+        "Read a config or status parameter of the detector API"
+        return self.command_executor.submit(self._get, path).result()["value"]
+
+    def _get_version(self):
+        response = self.session.get(
+            "http://{0}:{1}/detector/api/version/".format(self.host, self.port))
+        return response.json()["value"]
+
+    def _get(self, path):
+        with controls.timing.span("eiger.http"):
+            response = self.session.get(self.command_url(path))
+        logger.debug("got response %s %s", response.status_code, response.json())
+        return response.json()
+
+    def reset_session(self):
+        if self.session is not None:
+            self.session.close()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.api_version = None
+
+    def command_url(self, path):
+        if self.api_version is None:
+            # called from the command thread, so not through version()
+            self.api_version = self._get_version()
+            logger.debug("eiger api version %s", self.api_version)
+        return 'http://{0}:{1}/detector/api/{2}/{3}'.format(
                 self.host,
                 self.port,
-                self.version(),
+                self.api_version,
                 path,
                 )
-        headers = {'Content-Type': 'application/json'}
+
+    def send_command(self, path, dictionary, wait=True):
+        """Send a command or a config write to the detector API.
+
+        All the requests are sent in order by a single background thread.
+        With wait=False a concurrent.futures.Future of the response is
+        returned at once, and arm() waits for the ones not done yet.
+        """
+        future = self._submit(path, dictionary)
+        if wait:
+            return future.result()
+        # forget the writes already done, keep the failed ones for arm()
+        self.pending_commands = [
+            pending for pending in self.pending_commands
+            if not pending.done() or pending.exception() is not None]
+        self.pending_commands.append(future)
+        return future
+
+    def _submit(self, path, dictionary):
+        "Queue a request, without keeping track of it"
+        future = self.command_executor.submit(self._put, path, dictionary)
+        future.add_done_callback(self._log_command_error)
+        return future
+
+    def _put(self, path, dictionary):
         logger.debug("sent %s", dictionary)
-        response = requests.put(url, json.dumps(dictionary), headers=headers)
+        data = json.dumps(dictionary)
+        with controls.timing.span("eiger.http"):
+            try:
+                response = self.session.put(self.command_url(path), data)
+            except requests.ConnectionError:
+                logger.warning("lost connection to eiger, reconnecting")
+                self.reset_session()
+                response = self.session.put(self.command_url(path), data)
         logger.debug("got response %s %s", response.status_code, response.json())
         return response.json()
 
-    def save(self):
-        _ = self.stream.pop()
+    def wait_for_commands(self):
+        "Block until all the commands sent with wait=False are done"
+        pending_commands = self.pending_commands
+        self.pending_commands = []
+        for future in pending_commands:
+            future.result()
+
+    @staticmethod
+    def _log_command_error(future):
+        if future.exception() is not None:
+            logger.error("eiger command failed: %s", future.exception())
+
+    def arm(self):
+        """Arm the detector and start draining the stream into a new
+        series file in the background."""
+        if self.stream_writer is not None and self.stream_writer.is_alive():
+            raise controls.exceptions.EigerError(
+                "the previous series is still being written to {0}, "
+                "disarm() and save() it first".format(
+                    self.stream_writer.filename))
+        self.wait_for_commands()
+        response = self.send_command("command/arm", {})
+        self.n_triggered = 0
         now = datetime.datetime.now()
         output_file = os.path.join(
             self.storage_path,
             "series.{0}.h5".format(now.strftime("%y%m%d.%H%M%S%f"))
         )
         logger.debug("saving eiger image to %s ...", output_file)
-        with controls.hdf5.Hdf5Writer(output_file) as hdf5_writer:
-            data = self.stream.pop()
-            while data["type"] == "data":
-                hdf5_writer.write(data["data"])
-                data = self.stream.pop()
-        logger.info("eiger image saved to %s", output_file)
-        logger.debug(now.strftime("%H%M%S%f"))
+        hdf5_writer = controls.hdf5.Hdf5Writer(
+            output_file,
+            n_frames=self.n_trigger * self.n_images,
+            layout=self.hdf5_layout,
+            compression=self.compression,
+            num_image_per_file=self.num_image_per_file,
+            observers=self.frame_observers,
+            decimation=self.decimation,
+            frame_order=self.frame_order)
+        self.stream_writer = StreamWriter(self.stream, hdf5_writer)
+        self.stream_writer.start()
+        return response
+
+    def disarm(self):
+        "End the series, after the triggers already sent"
+        return self.send_command("command/disarm", {})
+
+    @property
+    def series_file(self):
+        "hdf5 file of the series being acquired, None before arm()"
+        if self.stream_writer is None:
+            return None
+        return self.stream_writer.filename
+
+    def save(self):
+        """Wait for the background writer to flush the end of the series.
+        Call after disarm().
+
+        Returns:
+            the name of the hdf5 file
+        """
+        if self.stream_writer is None:
+            raise controls.exceptions.EigerError(
+                "no series to save, arm() the detector first")
+        stream_writer = self.stream_writer
+        self.stream_writer = None
+        stream_writer.join()
+        self.frame_arrivals = stream_writer.arrival_times
+        logger.info("eiger image saved to %s", stream_writer.filename)
+        logger.debug(datetime.datetime.now().strftime("%H%M%S%f"))
+        return stream_writer.filename
+
+    def setNImages(self, n):
+        "Number of frames taken for each trigger"
+        self.n_images = n
+        return self.send_command("config/nimages", {"value": n})
+
+    def setPhotonEnergy(self, photon_energy):
+        "Photon energy in eV, which also sets the threshold"
+        return self.send_command(
+            "config/photon_energy", {"value": photon_energy})
+
+    def abort(self):
+        "Stop the acquisition at once and go back to idle"
+        return self.send_command("command/abort", {})
 
     def setNTrigger(self, n):
+        self.n_trigger = n
         return self.send_command("config/ntrigger", {"value": n})
 
+    def trigger_async(self, exposure_time=1, timeout=10):
+        """Send a trigger without waiting for it.
+
+        Args:
+            exposure_time: count time in the inte trigger mode
+            timeout: seconds to wait on top of the exposure time before the
+                handle gives up
+
+        Returns:
+            a TriggerHandle
+        """
+        self.n_triggered += 1
+        # the handle reports its errors, so arm() does not wait for it
+        command = self._submit(
+            "command/trigger", {"value": exposure_time})
+        return TriggerHandle(
+            command,
+            self.stream_writer,
+            self.n_triggered * self.n_images,
+            self.n_images * exposure_time + timeout)
+
     def trigger(self, exposure_time=1):
-        response = self.send_command("command/trigger", {"value": exposure_time})
-        time.sleep(exposure_time)
-        return response
+        "Expose and wait for the frame"
+        return self.trigger_async(exposure_time).result()
 
     def snap(self, exposure_time=1):
         self.setNTrigger(1)
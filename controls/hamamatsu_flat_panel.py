@@ -1,20 +1,30 @@
-import socket
 import datetime
 import os
 import logging
-import tempfile
-import glob
-import shutil
 import subprocess
-import time
 
+import controls.connection
 import controls.hdf5
+import controls.settings_cache
+import controls.tiff
+import controls.timing
+import controls.transfer
 
 logger = logging.getLogger(__name__)
 
 
 SOCKET_BUFFER_SIZE = 256
+# seconds to wait for the answer to a command
+COMMAND_TIMEOUT = 5
+# seconds to wait for the end of a snap, on top of its exposure time
+EXPOSURE_TIMEOUT = 10
 REMOTE_IMAGE_PATH = "X:\\Data20\\FPD\\Matteo\\"
+# REMOTE_IMAGE_PATH as mounted here
+LOCAL_IMAGE_PATH = "/afs/psi.ch/user/a/abis_m/slsbl/x02da/e13510/Data20/FPD/Matteo"
+# save() ingests the tiff files into one hdf5 file per series
+SAVE_HDF5 = "hdf5"
+# save() moves the tiff files into a timestamped folder
+SAVE_TIFF = "tiff"
 # Let sever return a "OK" and display it.
 _CMD_ECHO       = "10"
 # Set the exposure time
@@ -57,11 +67,53 @@ class HamamatsuFlatPanel(object):
     "Detector interface for Zhentian's camera server on mpc1777"
 
     def __init__(self, host="mpc1777", port=44444, photon_energy=1,
-                 storage_path="."):
+                 storage_path=".",
+                 save_mode=SAVE_TIFF,
+                 local_image_path=LOCAL_IMAGE_PATH,
+                 hdf5_layout=controls.hdf5.LAYOUT_STACK,
+                 compression=None,
+                 num_image_per_file=None,
+                 reply_delimiter=None):
+        """
+        Args:
+            save_mode: SAVE_TIFF, or SAVE_HDF5 for the series files used by
+                the scans, with frame_observers, decimation and
+                frame_order
+            reply_delimiter: ending each answer of the server, if it ends
+                them. The server on mpc1777 is not known to, so by default
+                every recv() is taken as one answer.
+        """
         super(HamamatsuFlatPanel, self).__init__()
+        if save_mode not in (SAVE_HDF5, SAVE_TIFF):
+            raise ValueError("unknown save mode {0}".format(save_mode))
         self.host = host
         self.port = port
         self.storage_path = storage_path
+        self.save_mode = save_mode
+        self.local_image_path = local_image_path
+        self.hdf5_layout = hdf5_layout
+        self.compression = compression
+        self.num_image_per_file = num_image_per_file
+        # Hdf5Writer observers of the frames of every series
+        self.frame_observers = []
+        # save one frame out of decimation, none with 0
+        self.decimation = 1
+        # stack index of each frame of the next series, None in order
+        self.frame_order = None
+        self.transport = controls.transfer.LocalDirectoryTransport(
+            local_image_path)
+        self.collector = None
+        self.n_trigger = 1
+        self.settings = controls.settings_cache.SettingsCache()
+        self.phase_stepping = False
+        self.exposure_time = 1
+        # commands are not terminated, the server reads them whole
+        self.connection = controls.connection.FramedConnection(
+            host, port,
+            terminator="",
+            delimiter=reply_delimiter,
+            timeout=COMMAND_TIMEOUT,
+            buffer_size=SOCKET_BUFFER_SIZE)
         self.initialize()
 
     def initialize(self, timeout=5):
@@ -76,8 +128,8 @@ class HamamatsuFlatPanel(object):
             True if connection was established successfully else False.
         """
 
-        self.__openSocket(timeout)
-        if not self.__socket:
+        self.settings.invalidate()
+        if not self.connection.open(timeout):
             return False
         logger.debug("initializing detector")
         self.__send_command(_CMD_STOP, "")
@@ -92,76 +144,139 @@ class HamamatsuFlatPanel(object):
         """
         Close connection to camserver
         """
-        self.__send_command(_CMD_STOP, "")
-        if self.__socket:
-            self.__socket.shutdown(socket.SHUT_RDWR)
-            self.__socket.close()
-            self.__socket = None
+        try:
+            if self.connection.is_open:
+                self.finish_phase_stepping()
+                self.__send_command(_CMD_STOP, "")
+        finally:
+            self.settings.invalidate()
+            self.connection.close()
         return
 
     def __del__(self):
-        self.close()
-        
+        # no commands, the server may be gone when the interpreter exits
+        connection = getattr(self, "connection", None)
+        if connection is not None:
+            connection.close()
+
     def trigger(self, exposure_time=1):
+        """Snap an image. Within a phase stepping sequence this is a STEP
+        with the exposure time given to prepare_phase_stepping."""
         now = datetime.datetime.now().strftime("%y%m%d.%H%M%S%f")
-        fileName = REMOTE_IMAGE_PATH + 'snap.{0}.tif'.format(now)
+        image_name = 'snap.{0}.tif'.format(now)
+        fileName = REMOTE_IMAGE_PATH + image_name
+        if self.phase_stepping:
+            answer = self.__send_command(
+                _CMD_STEP, fileName,
+                self.exposure_time + EXPOSURE_TIMEOUT)
+        else:
+            self.setExposureParameters(exposure_time)
+            answer = self.__send_command(
+                _CMD_SNAP, fileName,
+                self.exposure_time + EXPOSURE_TIMEOUT)
+        if self.save_mode == SAVE_HDF5:
+            self.collect(image_name, 1)
+        return answer
+
+    def prepare_phase_stepping(self, exposure_time=1):
+        """Start a phase stepping sequence: the server keeps the detector
+        and the Mammo tube ready between the steps, and every trigger()
+        until finish_phase_stepping() is a STEP."""
         self.setExposureParameters(exposure_time)
-        self.__send_command(_CMD_SNAP, fileName)
+        answer = self.__send_command(_CMD_PREPS, str(float(exposure_time)))
+        self.phase_stepping = True
+        return answer
+
+    def finish_phase_stepping(self):
+        if not self.phase_stepping:
+            return
+        self.phase_stepping = False
+        return self.__send_command(_CMD_POSTPS, "")
 
     def arm(self):
-        pass
+        "Start ingesting the images of a new series in the background"
+        if self.save_mode == SAVE_HDF5:
+            self.start_collector()
 
     def disarm(self):
         pass
 
     def setNTrigger(self, n):
-        pass
+        self.n_trigger = n
 
-    def __openSocket(self, timeout):
-        self.__socket = None
-        try:
-            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.__socket.setblocking(1)
-            self.__socket.connect((self.host, self.port))
-        except socket.error as msg:
-            logger.error("socket connection failed %s", msg)
-            self.__socket.close()
-            self.__socket = None
-
-
-    def __socketRecv(self, timeout=None):
-        self.__socket.settimeout(timeout)
-        try:
-            answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        except socket.timeout:
-            answer = None
-        except Exception as e:
-            answer = None
-            self.__socket.settimeout(None)
-            raise e
-        self.__socket.settimeout(None)
-        return answer
-
-    def __send_command(self, command, parameters):
-        payload = command + "_" + parameters
-        logger.debug("sending command %s", payload)
-        self.__socket.send(payload)
-        answer = self.__socketRecv()
-        logger.debug("received answer %s", answer)
-        return answer
+    def __send_command(self, command, parameters,
+                       timeout=controls.connection.DEFAULT):
+        with controls.timing.span("hamamatsu.command"):
+            return self.connection.command(
+                command + "_" + parameters, timeout).strip()
 
     def setExposureParameters(self, exposure_time=1):
-        return self.__send_command(_CMD_EXPTIME, str(float(exposure_time)))
+        self.exposure_time = exposure_time
+        return self.settings.set(
+            _CMD_EXPTIME, str(float(exposure_time)),
+            lambda value: self.__send_command(_CMD_EXPTIME, value))
 
     def setROI(self, x1, y1, x2, y2):
         roi = ",".join([str(x) for x in [x1, y1, x2, y2]])
-        return self.__send_command(_CMD_SETROI, roi)
+        return self.settings.set(
+            _CMD_SETROI, roi,
+            lambda value: self.__send_command(_CMD_SETROI, value))
 
     def setPaths(self):
         self.__send_command(_CMD_IMAGEPATH, REMOTE_IMAGE_PATH)
 
+    def collect(self, pattern, count=None):
+        "Queue the tiff files matching pattern for the hdf5 file"
+        if self.collector is None:
+            self.start_collector()
+        self.collector.add(pattern, count)
+
+    def start_collector(self):
+        if self.collector is not None:
+            logger.warning("previous series was not saved, saving it now")
+            self.save()
+        now = datetime.datetime.now()
+        output_file = os.path.join(
+            self.storage_path,
+            "series.{0}.h5".format(now.strftime("%y%m%d.%H%M%S%f"))
+        )
+        logger.debug("saving hamamatsu images to %s ...", output_file)
+        hdf5_writer = controls.hdf5.Hdf5Writer(
+            output_file,
+            n_frames=self.n_trigger,
+            layout=self.hdf5_layout,
+            compression=self.compression,
+            num_image_per_file=self.num_image_per_file,
+            observers=self.frame_observers,
+            decimation=self.decimation,
+            frame_order=self.frame_order)
+        # reading memory mapped files is io bound
+        self.collector = controls.transfer.FileCollector(
+            self.transport, hdf5_writer, controls.tiff.read_tiff,
+            processes=False)
+        self.collector.start()
+
+    @property
+    def series_file(self):
+        "hdf5 file of the series being acquired, None before arm()"
+        if self.collector is None:
+            return None
+        return self.collector.filename
+
     def save(self):
-        root = "/afs/psi.ch/user/a/abis_m/slsbl/x02da/e13510/Data20/FPD/Matteo"
+        if self.save_mode == SAVE_TIFF:
+            return self.save_tiff_folder()
+        if self.collector is None:
+            self.collect("snap.*.tif")
+        collector = self.collector
+        self.collector = None
+        collector.finish()
+        self.transport.remove(self.transport.list("ct*.tif"))
+        logger.info("hamamatsu images saved to %s", collector.filename)
+        return collector.filename
+
+    def save_tiff_folder(self):
+        root = self.local_image_path
         now = datetime.datetime.now()
         folder = now.strftime("%y%m%d.%H%M%S%f")
         output_folder = os.path.join(
@@ -180,5 +295,8 @@ class HamamatsuFlatPanel(object):
         logger.debug(removed)
 
     def snap(self, exposure_time=1):
+        self.setNTrigger(1)
+        self.arm()
         self.trigger(exposure_time)
+        self.disarm()
         self.save()
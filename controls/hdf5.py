@@ -1,18 +1,462 @@
+import collections
+import logging
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import h5py
+import numpy as np
+
+import controls.timing
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+try:
+    # registers the hdf5 filter, to write and read the per frame datasets
+    import bitshuffle.h5
+except ImportError:
+    pass
+
+try:
+    # registers the lz4 and bitshuffle hdf5 filters
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+logger = logging.getLogger(__name__)
+
+# one (n_frames, rows, cols) dataset, chunked per frame
+LAYOUT_STACK = "stack"
+# one /entry/data/data_NNNNNN dataset per frame, as written by
+# dectris.albula.Hdf5Writer, for the old analysis code
+LAYOUT_PER_FRAME = "per_frame"
+
+DATA_GROUP = "/entry/data"
+STACK_DATASET = "data"
+# attribute of the stack with the number of frames committed to it
+FRAMES_ATTRIBUTE = "frames"
+# per frame motor positions of a scan
+SCAN_GROUP = "/entry/scan"
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_LZ4 = "lz4"
+COMPRESSION_BSLZ4 = "bslz4"
+
+# registered hdf5 filter ids
+LZ4_FILTER = 32004
+BITSHUFFLE_FILTER = 32008
+# bitshuffle filter option selecting the lz4 compressor
+BITSHUFFLE_LZ4 = 2
+# filter version written when the bitshuffle package is not installed
+BITSHUFFLE_VERSION = (0, 5)
+
+
+def frame_data(dimage):
+    """Return the numpy array of a dectris.albula.DImage or of a
+    CompressedFrame, or the frame itself if it is already an array."""
+    if isinstance(dimage, np.ndarray):
+        return dimage
+    return dimage.data()
+
+
+def write_scan_data(filename, datasets):
+    """Add per frame scan data to a saved series: each item of the
+    datasets dict becomes a dataset of SCAN_GROUP, replacing any
+    previous one."""
+    with h5py.File(filename, "a") as output_file:
+        group = output_file.require_group(SCAN_GROUP)
+        for name, values in datasets.items():
+            if name in group:
+                del group[name]
+            group.create_dataset(name, data=np.asarray(values))
+
+
+def count_frames(filename):
+    """Number of frames in a series file, in the stack or in the per frame
+    datasets, 0 if unreadable"""
+    try:
+        with h5py.File(filename, "r") as input_file:
+            group = input_file[DATA_GROUP]
+            if STACK_DATASET not in group:
+                return len(_frame_datasets(group))
+            dataset = group[STACK_DATASET]
+            return int(dataset.attrs.get(FRAMES_ATTRIBUTE, dataset.shape[0]))
+    except (IOError, OSError, KeyError) as e:
+        logger.warning("no frames in %s: %s", filename, e)
+        return 0
+
+
+def write_segments(filename, segments, frame_order=None):
+    """Master file with a virtual stack concatenating the first frames of
+    several series files, of either layout.
+
+    Args:
+        segments: list of (series file, number of frames)
+        frame_order: stack index of each frame of the segments, such as
+            the canonical index of the frames of a scan taken out of
+            order, by default the frames are concatenated in order
+    """
+    # (series file, dataset, frames or None for a dataset of a single
+    # frame, shape, dtype)
+    sources = []
+    for segment_file, n_frames in segments:
+        if not n_frames:
+            continue
+        with h5py.File(segment_file, "r") as input_file:
+            group = input_file[DATA_GROUP]
+            if STACK_DATASET in group:
+                dataset = group[STACK_DATASET]
+                sources.append((segment_file, STACK_DATASET, n_frames,
+                                dataset.shape, dataset.dtype))
+            else:
+                for name in _frame_datasets(group)[:n_frames]:
+                    dataset = group[name]
+                    sources.append((segment_file, name, None,
+                                    dataset.shape, dataset.dtype))
+    with h5py.File(filename, "w") as output_file:
+        if not sources:
+            return
+        _, _, n_frames, shape, dtype = sources[0]
+        total = sum(1 if source[2] is None else source[2]
+                    for source in sources)
+        if frame_order is not None:
+            total = max(total, int(np.max(frame_order[:total])) + 1)
+        layout = h5py.VirtualLayout(
+            shape=(total,) + (shape if n_frames is None else shape[1:]),
+            dtype=dtype)
+        position = 0
+        for segment_file, name, n_frames, shape, _ in sources:
+            source = h5py.VirtualSource(
+                os.path.relpath(segment_file, os.path.dirname(
+                    os.path.abspath(filename))),
+                DATA_GROUP + "/" + name,
+                shape=shape)
+            if n_frames is None:
+                target, _, _ = _runs(frame_order, position, 1)[0]
+                layout[target] = source
+                position += 1
+                continue
+            for target, first, length in _runs(
+                    frame_order, position, n_frames):
+                layout[target:target + length] = source[first:first + length]
+            position += n_frames
+        group = output_file.require_group(DATA_GROUP)
+        group.create_virtual_dataset(STACK_DATASET, layout, fillvalue=0)
+
+
+def _runs(frame_order, start, n_frames):
+    """Split the frames start to start + n_frames into runs stored next
+    to each other.
+
+    Returns:
+        list of (stack index, offset from start, length)
+    """
+    if frame_order is None:
+        return [(start, 0, n_frames)]
+    targets = np.asarray(frame_order[start:start + n_frames])
+    if len(targets) != n_frames:
+        raise ValueError("no stack index for frames {0} to {1}".format(
+            start + len(targets), start + n_frames))
+    offsets = np.concatenate(
+        ([0], np.flatnonzero(np.diff(targets) != 1) + 1))
+    lengths = np.diff(np.concatenate((offsets, [n_frames])))
+    return [(int(targets[offset]), int(offset), int(length))
+            for offset, length in zip(offsets, lengths)]
+
+
+def _frame_datasets(group):
+    "Names of the datasets of LAYOUT_PER_FRAME in group, in frame order"
+    return sorted(name for name in group if name.startswith("data_"))
+
+
+def bitshuffle_block_size(itemsize):
+    "Same default block size (in elements) as the bitshuffle library"
+    block_size = 8192 // itemsize
+    block_size = (block_size // 8) * 8
+    return max(block_size, 128)
+
+
+def bitshuffle_filter_options(itemsize):
+    """cd_values of the bitshuffle lz4 filter for create_dataset.
+
+    A registered filter prepends its version and the element size in its
+    set_local callback. Without it they are written here, otherwise the
+    file would not be readable.
+    """
+    options = (bitshuffle_block_size(itemsize), BITSHUFFLE_LZ4)
+    if h5py.h5z.filter_avail(BITSHUFFLE_FILTER):
+        return options
+    version = BITSHUFFLE_VERSION
+    if bitshuffle is not None and hasattr(bitshuffle, "__version__"):
+        version = tuple(
+            int(part) for part in bitshuffle.__version__.split(".")[:2])
+    return version + (itemsize,) + options
+
+
+class ChunkCompressor(object):
+    """Compress whole chunks outside of the hdf5 filter pipeline, so that
+    they can be compressed in parallel and written with
+    write_direct_chunk. The output is byte for byte what the hdf5 filter
+    would have produced, so any reader with the filter plugin can read it.
+
+    lz4 and bslz4 need the optional lz4 and bitshuffle packages, and fall
+    back to gzip if they are not installed. Without fallback they keep
+    their compression, for the dataset options of chunks compressed
+    elsewhere, and compress() and decompress() raise ImportError.
+    """
+
+    def __init__(self, compression, level=4, fallback=True):
+        super(ChunkCompressor, self).__init__()
+        if compression not in (
+                COMPRESSION_GZIP, COMPRESSION_LZ4, COMPRESSION_BSLZ4):
+            raise ValueError("unknown compression {0}".format(compression))
+        self.compression = compression
+        self.level = level
+        if fallback and self.missing is not None:
+            logger.warning("%s not installed, falling back to gzip",
+                           self.missing)
+            self.compression = COMPRESSION_GZIP
+
+    @property
+    def missing(self):
+        "The package needed by the compression if it is not installed"
+        if self.compression == COMPRESSION_LZ4 and lz4 is None:
+            return "lz4"
+        if self.compression == COMPRESSION_BSLZ4 and bitshuffle is None:
+            return "bitshuffle"
+        return None
+
+    def _check_installed(self):
+        if self.missing is not None:
+            raise ImportError("{0} chunks need the {1} package".format(
+                self.compression, self.missing))
+
+    def dataset_options(self, dtype):
+        "Keyword arguments for h5py create_dataset of frames of dtype"
+        if self.compression == COMPRESSION_GZIP:
+            return dict(
+                compression="gzip",
+                compression_opts=self.level,
+                shuffle=True)
+        elif self.compression == COMPRESSION_LZ4:
+            return dict(
+                compression=LZ4_FILTER,
+                allow_unknown_filter=True)
+        else:
+            return dict(
+                compression=BITSHUFFLE_FILTER,
+                compression_opts=bitshuffle_filter_options(
+                    np.dtype(dtype).itemsize),
+                allow_unknown_filter=True)
+
+    def compress(self, data):
+        "Return the bytes of the compressed chunk"
+        self._check_installed()
+        data = np.ascontiguousarray(data)
+        if self.compression == COMPRESSION_GZIP:
+            # same byte order as the hdf5 shuffle filter
+            shuffled = data.view(np.uint8).reshape(-1, data.itemsize).T
+            return zlib.compress(shuffled.tobytes(), self.level)
+        elif self.compression == COMPRESSION_LZ4:
+            raw = data.tobytes()
+            block = lz4.block.compress(raw, store_size=False)
+            if len(block) >= len(raw):
+                # the filter stores incompressible blocks as they are
+                block = raw
+            return (struct.pack(">QI", len(raw), len(raw)) +
+                    struct.pack(">I", len(block)) +
+                    block)
+        else:
+            block_size = bitshuffle_block_size(data.itemsize)
+            blocks = bitshuffle.compress_lz4(data.ravel(), block_size)
+            return (struct.pack(">QI", data.nbytes,
+                                block_size * data.itemsize) +
+                    blocks.tobytes())
+
+    def decompress(self, chunk, shape, dtype):
+        "Return the array of a chunk written by compress()"
+        self._check_installed()
+        dtype = np.dtype(dtype)
+        if self.compression == COMPRESSION_GZIP:
+            shuffled = np.frombuffer(zlib.decompress(chunk), dtype=np.uint8)
+            return np.ascontiguousarray(
+                shuffled.reshape(dtype.itemsize, -1).T).view(
+                    dtype).reshape(shape)
+        elif self.compression == COMPRESSION_LZ4:
+            n_bytes, block_size = struct.unpack(">QI", chunk[:12])
+            blocks = []
+            position = 12
+            remaining = n_bytes
+            while remaining:
+                size = min(block_size, remaining)
+                stored, = struct.unpack(
+                    ">I", chunk[position:position + 4])
+                block = chunk[position + 4:position + 4 + stored]
+                if stored != size:
+                    block = lz4.block.decompress(
+                        block, uncompressed_size=size)
+                blocks.append(block)
+                position += 4 + stored
+                remaining -= size
+            return np.frombuffer(
+                b"".join(blocks), dtype=dtype).reshape(shape)
+        else:
+            _, block_size = struct.unpack(">QI", chunk[:12])
+            return bitshuffle.decompress_lz4(
+                np.frombuffer(chunk, dtype=np.uint8, offset=12),
+                tuple(shape), dtype, block_size // dtype.itemsize)
+
+
+class CompressedFrame(object):
+    """A frame still compressed, as the chunk ChunkCompressor(compression)
+    would write, such as the lz4 and bslz4 frames of the Eiger stream.
+
+    Hdf5Writer writes it as it is if it compresses the stack the same way,
+    and data() decompresses it otherwise.
+    """
+
+    def __init__(self, chunk, shape, dtype, compression):
+        super(CompressedFrame, self).__init__()
+        self.chunk = chunk
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def data(self):
+        return ChunkCompressor(self.compression, fallback=False).decompress(
+            self.chunk, self.shape, self.dtype)
+
+
+def dataset_compression(dataset):
+    """The compression of a dataset as written by ChunkCompressor, None if
+    it is not compressed, or False for any other filter pipeline."""
+    plist = dataset.id.get_create_plist()
+    filters = tuple(
+        plist.get_filter(i)[0] for i in range(plist.get_nfilters()))
+    if not filters:
+        return None
+    return {
+        (h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE): COMPRESSION_GZIP,
+        (LZ4_FILTER,): COMPRESSION_LZ4 if lz4 is not None else False,
+        (BITSHUFFLE_FILTER,): (
+            COMPRESSION_BSLZ4 if bitshuffle is not None else False),
+    }.get(filters, False)
+
 
 class Hdf5Writer(object):
 
-    def __init__(self, filename, num_image_per_file=None, nexus=None, compression=None):
-        # unused args to get the same interface as dectris.albula.Hdf5Writer
+    def __init__(self, filename, num_image_per_file=None, nexus=None,
+                 compression=None, n_frames=None, layout=LAYOUT_STACK,
+                 batch_size=16, compression_threads=4, observers=(),
+                 decimation=1, frame_order=None):
+        """
+        Args:
+            filename: output hdf5 file. With num_image_per_file this is a
+                master file with a virtual dataset spanning all the data
+                files.
+            num_image_per_file: roll over to a new data file every
+                num_image_per_file frames (stack layout only)
+            nexus: unused, to get the same interface as
+                dectris.albula.Hdf5Writer
+            compression: None, COMPRESSION_GZIP, COMPRESSION_LZ4 or
+                COMPRESSION_BSLZ4
+            n_frames: expected number of frames, used to preallocate the
+                stack. The stack still grows if more frames are written,
+                and it is shrunk on close if fewer frames arrive.
+            layout: LAYOUT_STACK or LAYOUT_PER_FRAME
+            batch_size: number of frames buffered in memory and written to
+                the stack with a single hdf5 call
+            compression_threads: size of the thread pool compressing the
+                frames
+            observers: objects following the series, such as
+                controls.phase_retrieval.OnlineRetrieval. Each gets
+                start(writer) on open, frame(index, data) for every frame
+                and finish(writer) before the file is closed.
+            decimation: write only one frame out of decimation, or none
+                with 0, and then no file at all and filename is None.
+                The observers still get every frame.
+            frame_order: index in the stack of each frame written, such
+                as the canonical index of the frames of a scan taken out
+                of order (stack layout in a single file only). The stack
+                is preallocated to hold them all.
+        """
         super(Hdf5Writer, self).__init__()
-        self.filename = filename
+        if layout not in (LAYOUT_STACK, LAYOUT_PER_FRAME):
+            raise ValueError("unknown hdf5 layout {0}".format(layout))
+        if num_image_per_file and layout != LAYOUT_STACK:
+            raise ValueError("num_image_per_file needs the stack layout")
+        if frame_order is not None and (
+                num_image_per_file or layout != LAYOUT_STACK):
+            raise ValueError("frame_order needs the stack in a single file")
+        self.filename = filename if decimation else None
+        self.num_image_per_file = num_image_per_file
+        self.decimation = decimation
+        if n_frames is not None and decimation:
+            n_frames = -(-n_frames // decimation)
+        self.frame_order = frame_order
+        if frame_order is not None and len(frame_order):
+            n_frames = max(n_frames or 0, int(np.max(frame_order)) + 1)
+        self.n_frames = n_frames
+        self.layout = layout
+        self.batch_size = max(1, batch_size)
+        self.compression_threads = compression_threads
+        self.compressor = None
+        if compression is not None:
+            # falls back to gzip only once a frame needs compressing, see
+            # _fall_back, as frames already compressed need no package
+            self.compressor = ChunkCompressor(compression, fallback=False)
         self.image_id = 1
+        self.file = None
+        self.executor = None
+        self.pending = collections.deque()
+        self.stack_file = None
+        self.dataset = None
+        self.dataset_start = 0
+        self.buffer = None
+        self.buffered = 0
+        self.written = 0
+        self.data_files = []
+        self.observers = list(observers)
 
     def open(self):
-        self.file = h5py.File(self.filename)
+        if self.filename is not None:
+            self.file = h5py.File(self.filename, "a")
+        if self.compressor is not None and self.file is not None:
+            self.executor = ThreadPoolExecutor(self.compression_threads)
+        for observer in self.observers:
+            observer.start(self)
 
     def close(self):
-        self.file.close()
+        try:
+            self.flush()
+            self._finish_stack()
+            if self.data_files:
+                self._write_master()
+            for observer in self.observers:
+                observer.finish(self)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self.stack_file is not None and self.stack_file is not self.file:
+                self.stack_file.close()
+            self.stack_file = None
+            if self.file is not None:
+                self.file.close()
 
     def __enter__(self):
         self.open()
@@ -22,9 +466,500 @@ class Hdf5Writer(object):
         self.close()
 
     def write(self, dimage):
-        group = self.file.require_group("/entry/data")
-        dataset = group.create_dataset(
+        data = None
+        if self._kept(self.image_id - 1):
+            if self._passthrough(dimage):
+                self._submit_compressed(dimage)
+            else:
+                data = frame_data(dimage)
+                self._fall_back()
+                self._write_data(data)
+        if self.observers and data is None:
+            data = frame_data(dimage)
+        for observer in self.observers:
+            observer.frame(self.image_id - 1, data)
+        self.image_id += 1
+
+    def _write_data(self, data):
+        if self.layout == LAYOUT_PER_FRAME:
+            with controls.timing.span("hdf5.write_frame"):
+                self._write_frame_dataset(data)
+        elif self.compressor is not None:
+            self._submit(data)
+        else:
+            self._append_to_stack(data)
+
+    def _passthrough(self, dimage):
+        "Whether dimage is already compressed as the stack"
+        return (isinstance(dimage, CompressedFrame) and
+                self.layout == LAYOUT_STACK and
+                self.compressor is not None and
+                dimage.compression == self.compressor.compression)
+
+    def _fall_back(self):
+        """Compress with gzip if the package of the compression is not
+        installed, unless the stack already has chunks compressed with
+        it."""
+        if self.compressor is None or self.compressor.missing is None:
+            return
+        if self.layout == LAYOUT_STACK and (
+                self.pending or self.dataset is not None or self.data_files):
+            return
+        self.compressor = ChunkCompressor(self.compressor.compression)
+
+    def _kept(self, index):
+        "Whether frame index is saved, with decimation"
+        return bool(self.decimation) and index % self.decimation == 0
+
+    def write_many(self, dimages):
+        for dimage in dimages:
+            self.write(dimage)
+
+    def flush(self):
+        """Write the buffered frames to the stack in a single call, wait
+        for the frames still being compressed, and commit them to the
+        file so that they survive a crash."""
+        with controls.timing.span("hdf5.flush"):
+            self._flush()
+
+    def _flush(self):
+        committed = bool(self.pending)
+        while self.pending:
+            self._write_compressed(*self.pending.popleft())
+        if self.buffered:
+            dataset = self._target(self.buffer.shape[1:], self.buffer.dtype)
+            for index, offset, length in _runs(
+                    self.frame_order,
+                    self.written - self.dataset_start,
+                    self.buffered):
+                if index + length > dataset.shape[0]:
+                    dataset.resize(index + length, axis=0)
+                dataset[index:index + length] = (
+                    self.buffer[offset:offset + length])
+            logger.debug("wrote frames %d to %d to %s",
+                         self.written, self.written + self.buffered,
+                         self.stack_file.filename)
+            self.written += self.buffered
+            self.buffered = 0
+            committed = True
+        if self.layout == LAYOUT_PER_FRAME and self.file is not None:
+            self.file.flush()
+        if committed and self.dataset is not None:
+            # the stack is preallocated, so tell how much of it is filled
+            self.dataset.attrs[FRAMES_ATTRIBUTE] = self._filled()
+            self.stack_file.flush()
+
+    def _write_frame_dataset(self, data):
+        group = self.file.require_group(DATA_GROUP)
+        options = {}
+        if self.compressor is not None:
+            options = self.compressor.dataset_options(data.dtype)
+        group.create_dataset(
             "data_{0:06d}".format(self.image_id),
-            data=dimage.data()
+            data=data,
+            **options
         )
-        self.image_id += 1
+
+    def _room(self):
+        "Frames that still fit in the current data file"
+        if not self.num_image_per_file:
+            return float("inf")
+        room = self.num_image_per_file
+        if self.dataset is not None:
+            room -= self.written - self.dataset_start
+        # a full file is rolled over before the next frame is written
+        return room if room > 0 else self.num_image_per_file
+
+    def _data_file_name(self, index):
+        stem, extension = os.path.splitext(self.filename)
+        return "{0}_data_{1:06d}{2}".format(stem, index, extension)
+
+    def _target(self, shape, dtype):
+        """Return the dataset receiving the next frame, rolling over to a
+        new data file if the current one is full."""
+        if (self.dataset is not None and self.num_image_per_file and
+                self.written - self.dataset_start >= self.num_image_per_file):
+            self._finish_stack()
+        if self.dataset is None:
+            self._create_stack(shape, dtype)
+        return self.dataset
+
+    def _create_stack(self, shape, dtype):
+        n_frames = self.n_frames or self.batch_size
+        if self.num_image_per_file:
+            n_frames = max(1, min(
+                self.num_image_per_file, n_frames - self.written))
+            data_file_name = self._data_file_name(len(self.data_files) + 1)
+            self.stack_file = h5py.File(data_file_name, "w")
+        else:
+            self.stack_file = self.file
+        self.dataset_start = self.written
+        options = {}
+        if self.compressor is not None:
+            options = self.compressor.dataset_options(dtype)
+        group = self.stack_file.require_group(DATA_GROUP)
+        self.dataset = group.create_dataset(
+            STACK_DATASET,
+            shape=(n_frames,) + tuple(shape),
+            maxshape=(None,) + tuple(shape),
+            chunks=(1,) + tuple(shape),
+            dtype=dtype,
+            **options
+        )
+
+    def _finish_stack(self):
+        "Shrink the current stack to the frames actually written"
+        if self.dataset is None:
+            return
+        n_frames = self._filled()
+        if self.dataset.shape[0] != n_frames:
+            self.dataset.resize(n_frames, axis=0)
+        if self.stack_file is not self.file:
+            self.data_files.append(
+                (self.stack_file.filename, self.dataset.shape,
+                 self.dataset.dtype))
+            self.stack_file.close()
+        self.stack_file = None
+        self.dataset = None
+
+    def _filled(self):
+        "Frames of the current stack up to the last one written"
+        n_written = self.written - self.dataset_start
+        if self.frame_order is None or not n_written:
+            return n_written
+        return int(np.max(self.frame_order[:n_written])) + 1
+
+    def _write_master(self):
+        "Virtual dataset presenting all the data files as one stack"
+        n_frames = sum(shape[0] for _, shape, _ in self.data_files)
+        frame_shape = self.data_files[0][1][1:]
+        layout = h5py.VirtualLayout(
+            shape=(n_frames,) + frame_shape,
+            dtype=self.data_files[0][2])
+        start = 0
+        for data_file_name, shape, _ in self.data_files:
+            # relative path, resolved next to the master file
+            source = h5py.VirtualSource(
+                os.path.basename(data_file_name),
+                DATA_GROUP + "/" + STACK_DATASET,
+                shape=shape)
+            layout[start:start + shape[0]] = source
+            start += shape[0]
+        group = self.file.require_group(DATA_GROUP)
+        group.create_virtual_dataset(STACK_DATASET, layout, fillvalue=0)
+        logger.debug("master file %s links %d data files",
+                     self.filename, len(self.data_files))
+
+    def _append_to_stack(self, data):
+        if self.buffer is None:
+            self.buffer = np.empty(
+                (self.batch_size,) + data.shape,
+                dtype=data.dtype)
+        if data.shape != self.buffer.shape[1:]:
+            raise ValueError(
+                "frame {0} has shape {1}, expected {2}".format(
+                    self.image_id, data.shape, self.buffer.shape[1:]))
+        self.buffer[self.buffered] = data
+        self.buffered += 1
+        if self.buffered == min(self.batch_size, self._room()):
+            self.flush()
+
+    def _submit(self, data):
+        future = self.executor.submit(self.compressor.compress, data)
+        self.pending.append((data, future))
+        # bound the memory held by frames waiting to be compressed
+        while len(self.pending) > 2 * self.compression_threads:
+            self._write_compressed(*self.pending.popleft())
+
+    def _submit_compressed(self, frame):
+        "Queue a CompressedFrame behind the frames being compressed"
+        future = Future()
+        future.set_result(frame.chunk)
+        self.pending.append((frame, future))
+        while len(self.pending) > 2 * self.compression_threads:
+            self._write_compressed(*self.pending.popleft())
+
+    def _write_compressed(self, data, future):
+        dataset = self._target(data.shape, data.dtype)
+        if data.shape != dataset.shape[1:]:
+            raise ValueError(
+                "frame {0} has shape {1}, expected {2}".format(
+                    self.written + 1, data.shape, dataset.shape[1:]))
+        index, _, _ = _runs(
+            self.frame_order, self.written - self.dataset_start, 1)[0]
+        if index >= dataset.shape[0]:
+            dataset.resize(index + 1, axis=0)
+        offset = (index,) + (0,) * len(data.shape)
+        with controls.timing.span("hdf5.compress_wait"):
+            chunk = future.result()
+        with controls.timing.span("hdf5.write_chunk"):
+            dataset.id.write_direct_chunk(offset, chunk)
+        self.written += 1
+
+
+def _first_selected(space):
+    "First frame selected in a dataspace"
+    if space.get_select_type() == h5py.h5s.SEL_ALL:
+        return 0
+    return space.get_select_bounds()[0][0]
+
+
+class SeriesReader(object):
+    """A saved series as a lazily read array of shape (n_frames, rows,
+    columns), whatever its layout: the stack, the master file of several
+    data files, the master of a resumed scan, or the per frame datasets
+    of LAYOUT_PER_FRAME.
+
+        with SeriesReader("series.h5") as series:
+            roi = series[::10, 100:200, 300:400]
+            for index, frame in series.iter_frames():
+                ...
+
+    Frames stored uncompressed are memory mapped. Compressed frames are
+    decompressed outside of the hdf5 library when they were written by
+    ChunkCompressor, so iter_frames() decompresses them in parallel, and
+    are kept in an LRU cache of cache_bytes. Only the frames being read
+    are ever in memory.
+    """
+
+    def __init__(self, filename, cache_bytes=256 << 20, memory_map=True):
+        """
+        Args:
+            cache_bytes: size of the cache of decompressed frames
+            memory_map: map the uncompressed frames instead of reading
+                them
+        """
+        super(SeriesReader, self).__init__()
+        self.filename = filename
+        self.cache_bytes = cache_bytes
+        self.memory_map = memory_map
+        self.cache = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.files = {}
+        self.maps = {}
+        self.decoders = {}
+        self.compressions = {}
+        self.file = self._open(filename)
+        # (first frame, dataset, index of the first frame in the
+        # dataset or None for a dataset of a single frame), sorted
+        self.segments = []
+        group = self.file[DATA_GROUP]
+        if STACK_DATASET in group:
+            n_frames, frame_shape, self.dtype = self._add_stack(
+                group[STACK_DATASET])
+        else:
+            names = _frame_datasets(group)
+            for i, name in enumerate(names):
+                self.segments.append((i, group[name], None))
+            n_frames = len(names)
+            frame_shape = group[names[0]].shape if names else ()
+            self.dtype = group[names[0]].dtype if names else np.dtype(float)
+        self.shape = (n_frames,) + tuple(frame_shape)
+        self.starts = np.array([start for start, _, _ in self.segments])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.cache.clear()
+        self.cached_bytes = 0
+        self.maps.clear()
+        for input_file in self.files.values():
+            input_file.close()
+        self.files.clear()
+
+    def __getitem__(self, key):
+        """Frames and region of interest, indexed as a numpy array: the
+        first index selects the frames (integer, slice, list or boolean
+        mask), the others apply to every frame."""
+        if not isinstance(key, tuple):
+            key = (key,)
+        frames, region = key[0], key[1:]
+        if isinstance(frames, (int, np.integer)):
+            return self.frame(frames)[region]
+        indices = np.arange(len(self))[frames]
+        region_shape = np.broadcast_to(
+            np.zeros((), dtype=self.dtype), self.shape[1:])[region].shape
+        output = np.empty((len(indices),) + region_shape, dtype=self.dtype)
+        for n, (_, data) in enumerate(self.iter_frames(indices, region)):
+            output[n] = data
+        return output
+
+    def frame(self, index):
+        "Frame index, memory mapped if possible"
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame {0} of a series of {1}".format(
+                index, len(self)))
+        with self.lock:
+            if index in self.cache:
+                data = self.cache.pop(index)
+                self.cache[index] = data
+                return data
+        segment = int(np.searchsorted(self.starts, index, side="right")) - 1
+        if segment < 0:
+            return self._missing()
+        start, dataset, first = self.segments[segment]
+        if first is None:
+            if index != start:
+                return self._missing()
+            offset = None
+        else:
+            offset = first + index - start
+            if offset >= dataset.shape[0]:
+                return self._missing()
+        data = self._mapped(dataset, offset)
+        if data is None:
+            data = self._read(dataset, offset)
+            self._cache(index, data)
+        return data
+
+    def iter_frames(self, indices=None, region=(), workers=4, prefetch=16):
+        """Yield (index, frame[region]) in order, reading up to prefetch
+        frames ahead with workers threads.
+
+        Args:
+            indices: of the frames, all of them by default
+            region: index or tuple of indices applied to each frame
+        """
+        if indices is None:
+            indices = range(len(self))
+        if not isinstance(region, tuple):
+            region = (region,)
+        indices = iter(indices)
+        pending = collections.deque()
+        executor = ThreadPoolExecutor(workers)
+        try:
+            for index in indices:
+                pending.append(
+                    (index, executor.submit(self._region, index, region)))
+                if len(pending) >= prefetch:
+                    index, future = pending.popleft()
+                    yield index, future.result()
+            while pending:
+                index, future = pending.popleft()
+                yield index, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def _region(self, index, region):
+        return np.array(self.frame(index)[region])
+
+    def _open(self, filename):
+        if filename not in self.files:
+            self.files[filename] = h5py.File(filename, "r")
+        return self.files[filename]
+
+    def _add_stack(self, dataset):
+        if not dataset.is_virtual:
+            n_frames = int(dataset.attrs.get(
+                FRAMES_ATTRIBUTE, dataset.shape[0]))
+            self.segments.append((0, dataset, 0))
+            return n_frames, dataset.shape[1:], dataset.dtype
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        for source in dataset.virtual_sources():
+            start = _first_selected(source.vspace)
+            first = _first_selected(source.src_space)
+            source_file = source.file_name
+            if source_file == ".":
+                source_file = self.filename
+            elif not os.path.isabs(source_file):
+                source_file = os.path.join(directory, source_file)
+            try:
+                source_dataset = self._open(source_file)[source.dset_name]
+            except (IOError, OSError, KeyError) as e:
+                logger.warning("frames of %s missing: %s", source_file, e)
+                continue
+            if source_dataset.ndim < dataset.ndim:
+                # a per frame dataset
+                first = None
+            self.segments.append((start, source_dataset, first))
+        self.segments.sort(key=lambda segment: segment[0])
+        return dataset.shape[0], dataset.shape[1:], dataset.dtype
+
+    def _missing(self):
+        "Frame not written, read as the fill value of the virtual stack"
+        return np.zeros(self.shape[1:], dtype=self.dtype)
+
+    def _mapped(self, dataset, offset):
+        """Memory mapped frame of an uncompressed dataset, None if it
+        cannot be mapped"""
+        if not self.memory_map or self._compression(dataset) is not None:
+            return None
+        frame_shape = dataset.shape if offset is None else dataset.shape[1:]
+        n_bytes = int(np.prod(frame_shape)) * dataset.dtype.itemsize
+        if dataset.chunks is None:
+            position = dataset.id.get_offset()
+            if position is None:
+                return None
+            if offset is not None:
+                position += offset * n_bytes
+        elif (offset is not None and
+                dataset.chunks == (1,) + tuple(frame_shape) and
+                hasattr(dataset.id, "get_chunk_info_by_coord")):
+            info = dataset.id.get_chunk_info_by_coord(
+                (offset,) + (0,) * len(frame_shape))
+            if info.byte_offset is None:
+                return None
+            position = info.byte_offset
+        else:
+            return None
+        filename = dataset.file.filename
+        raw = self.maps.get(filename)
+        if raw is None or position + n_bytes > len(raw):
+            # mapped again if the file grew
+            raw = self.maps[filename] = np.memmap(
+                filename, dtype=np.uint8, mode="r")
+        return raw[position:position + n_bytes].view(
+            dataset.dtype).reshape(frame_shape)
+
+    def _read(self, dataset, offset):
+        "Read and decompress a frame"
+        if offset is None:
+            return dataset[...]
+        compression = self._compression(dataset)
+        frame_shape = dataset.shape[1:]
+        if compression and dataset.chunks == (1,) + tuple(frame_shape):
+            if compression not in self.decoders:
+                self.decoders[compression] = ChunkCompressor(
+                    compression, fallback=False)
+            filter_mask, chunk = dataset.id.read_direct_chunk(
+                (offset,) + (0,) * len(frame_shape))
+            if not filter_mask:
+                return self.decoders[compression].decompress(
+                    chunk, frame_shape, dataset.dtype)
+        return dataset[offset]
+
+    def _compression(self, dataset):
+        key = (dataset.file.filename, dataset.name)
+        if key not in self.compressions:
+            self.compressions[key] = dataset_compression(dataset)
+        return self.compressions[key]
+
+    def _cache(self, index, data):
+        # shared by every reader of the frame
+        data.flags.writeable = False
+        if data.nbytes > self.cache_bytes:
+            return
+        with self.lock:
+            if index in self.cache:
+                return
+            self.cache[index] = data
+            self.cached_bytes += data.nbytes
+            while self.cached_bytes > self.cache_bytes:
+                _, dropped = self.cache.popitem(last=False)
+                self.cached_bytes -= dropped.nbytes
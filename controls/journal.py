@@ -0,0 +1,104 @@
+"""Append-only progress log of a scan, to resume it after a failure.
+
+The journal is a text file of json lines: a header describing the scan,
+then for every run of the scan a segment line naming the series file of
+the detector, followed by one line per point whose frames were taken. A
+line cut short by a crash is ignored.
+"""
+
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ScanJournal(object):
+
+    def __init__(self, filename):
+        super(ScanJournal, self).__init__()
+        self.filename = filename
+        self.header = None
+        # [series file, number of points done] of each run
+        self.segments = []
+        self.finished = False
+
+    @property
+    def output_file(self):
+        "Master file presenting the frames of all the runs as one series"
+        return os.path.splitext(self.filename)[0] + ".h5"
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        with open(self.filename) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning("ignoring truncated journal line %r", line)
+                    continue
+                if entry["type"] == "scan":
+                    self.header = entry
+                elif entry["type"] == "segment":
+                    self.segments.append([entry["file"], 0])
+                elif entry["type"] == "point":
+                    self.segments[-1][1] += 1
+                elif entry["type"] == "end":
+                    self.finished = True
+        return self
+
+    def create(self, **header):
+        "Start a new journal, overwriting any previous one"
+        header["type"] = "scan"
+        self.header = header
+        self.segments = []
+        self.finished = False
+        with open(self.filename, "w") as journal_file:
+            journal_file.write(json.dumps(header) + "\n")
+
+    def start_segment(self, series_file):
+        self.segments.append([series_file, 0])
+        self._append(type="segment", file=series_file)
+
+    def point_done(self, point):
+        "Record that the frames of point (index into the scan points) are taken"
+        self.segments[-1][1] += 1
+        self._append(type="point", point=int(point), time=time.time())
+
+    def finish(self):
+        self.finished = True
+        self._append(type="end", time=time.time())
+
+    def truncate(self, n_points):
+        """Keep only the first n_points points done, dropping the runs
+        after them."""
+        kept = []
+        for segment in self.segments:
+            if n_points <= 0:
+                break
+            kept.append([segment[0], min(segment[1], n_points)])
+            n_points -= segment[1]
+        self.segments = kept
+        self.finished = False
+        # rewrite, so that the dropped points are not counted on reload
+        header = dict(self.header)
+        with open(self.filename, "w") as journal_file:
+            journal_file.write(json.dumps(header) + "\n")
+            for series_file, n_done in kept:
+                journal_file.write(json.dumps(
+                    {"type": "segment", "file": series_file}) + "\n")
+                for _ in range(n_done):
+                    journal_file.write(json.dumps({"type": "point"}) + "\n")
+
+    @property
+    def points_done(self):
+        return sum(n_done for _, n_done in self.segments)
+
+    def _append(self, **entry):
+        with open(self.filename, "a") as journal_file:
+            journal_file.write(json.dumps(entry) + "\n")
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
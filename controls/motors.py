@@ -12,12 +12,118 @@
 ########################################################################
 
 
-import epics
 import logging
+import time
 import controls.exceptions
+import controls.timing
 
 logger = logging.getLogger(__name__)
 
+# seconds between two checks of a move in progress
+POLL_INTERVAL = 0.01
+
+
+class Move(object):
+    """ Wait handle of a motor move started without waiting for it
+    """
+    def __init__(self, motor, position, timeout):
+        self.motor = motor
+        self.position = position
+        self.timeout = timeout
+        self.started = time.time()
+
+    def done(self):
+        return self.motor._pv.put_complete
+
+    def wait(self, timeout=None):
+        """ Wait for the motor to reach the position
+
+            Input parameters:
+
+                timeout: seconds since the start of the move, by default
+                         the timeout given to mv
+
+            Return parameters:
+
+                none
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = self.started + timeout
+        with controls.timing.span("motor.wait"):
+            while not self.done():
+                if time.time() > deadline:
+                    raise controls.exceptions.MotorInterrupt(
+                        "Motor [{0}] did not reach position [{1}] "
+                        "within {2} s".format(
+                            self.motor._epics_name, self.position, timeout))
+                time.sleep(POLL_INTERVAL)
+
+
+class SettlePolicy(object):
+    """ How to tell that a motor has settled after a move: its done flag
+        (DMOV) is set, then its readback stays within deadband of the
+        setpoint for a number of consecutive samples
+    """
+    def __init__(self, deadband=None, samples=1, timeout=10,
+                 interval=POLL_INTERVAL):
+        """ Input variables:
+
+                deadband: largest distance between readback and setpoint,
+                          None to only wait for the done flag
+                samples: consecutive readbacks within the deadband
+                timeout: seconds to wait before raising MotorInterrupt
+                interval: seconds between two samples
+
+        """
+        self.deadband = deadband
+        self.samples = samples
+        self.timeout = timeout
+        self.interval = interval
+
+    def settle(self, motor):
+        """ Wait until motor has settled
+
+            Input parameters:
+
+                motor: the Motor
+
+            Return parameters:
+
+                none
+
+        """
+        with controls.timing.span("motor.settle"):
+            self._settle(motor)
+
+    def _settle(self, motor):
+        deadline = time.time() + self.timeout
+        while motor.is_moving():
+            self._check_deadline(motor, deadline, "stop moving")
+            time.sleep(self.interval)
+        if self.deadband is None:
+            return
+        within = 0
+        while True:
+            if abs(motor.get_readback() -
+                   motor.get_current_value()) <= self.deadband:
+                within += 1
+                if within >= self.samples:
+                    return
+            else:
+                within = 0
+            self._check_deadline(
+                motor, deadline,
+                "settle within {0}".format(self.deadband))
+            time.sleep(self.interval)
+
+    def _check_deadline(self, motor, deadline, what):
+        if time.time() > deadline:
+            raise controls.exceptions.MotorInterrupt(
+                "Motor [{0}] did not {1} within {2} s".format(
+                    motor._epics_name, what, self.timeout))
+
 
 class Motor():
     """ Class to define and control motors using the EPICS package
@@ -28,7 +134,9 @@ class Motor():
             description,
             init=False,
             disabled=False,
-            wait_for_finish=True):
+            wait_for_finish=True,
+            pv_factory=None,
+            settle_policy=None):
         """ Initialization function, sets motor name and description and all
             other motor specific parameters
 
@@ -41,7 +149,15 @@ class Motor():
                 disabled: set the motor as disabled (default: False)
                 wait_for_finish: wait for the motor finish movement
                 before returning (default: True)
-
+                pv_factory: creates the PVs, with the signature of
+                            epics.PV (default: epics.PV), for example
+                            controls.simulators.pv.SimulatedIOC().pv
+                settle_policy: SettlePolicy used by settle() (default:
+                               wait for the done flag only)
+
+            Position, readback, limits and motion done state are cached
+            from monitors, so that reading them costs no channel access
+            round trip. refresh() forces a read.
         """
 
         # Class variables
@@ -53,44 +169,109 @@ class Motor():
         # Instance variables
         self._epics_name = epics_name
         self._description = description
+        if settle_policy is None:
+            settle_policy = SettlePolicy()
+        self.settle_policy = settle_policy
+
+        if pv_factory is None:
+            # pyepics is only needed for a real IOC
+            import epics
+            pv_factory = epics.PV
 
         # Set motor process variable (PV)
-        self._pv = epics.PV(self._epics_name + ".VAL")  # To set/get parameters
+        self._pv = pv_factory(  # To set/get parameters
+            self._epics_name + ".VAL", callback=self._on_val)
+        self._hlm_pv = pv_factory(
+            self._epics_name + ".HLM", callback=self._on_hlm)
+        self._llm_pv = pv_factory(
+            self._epics_name + ".LLM", callback=self._on_llm)
+        self._dmov_pv = pv_factory(
+            self._epics_name + ".DMOV", callback=self._on_dmov)
+        self._rbv_pv = pv_factory(
+            self._epics_name + ".RBV", callback=self._on_rbv)
+        self._velo_pv = pv_factory(self._epics_name + ".VELO")
+        # functions called with (readback, time) on every RBV update
+        self._readback_callbacks = {}
+
+        self.refresh()
+
+    def refresh(self):
+        """ Read position, readback, limits and motion done state from the
+            PVs, bypassing the monitors
+        """
+        self._val = self._pv.get(use_monitor=False)  # Current PV value
+        self._hlm = self._hlm_pv.get(use_monitor=False)
+        self._llm = self._llm_pv.get(use_monitor=False)
+        self._dmov = self._dmov_pv.get(use_monitor=False)
+        self._rbv = self._rbv_pv.get(use_monitor=False)
+
+    # Monitor callbacks, called by the channel access thread
+    def _on_val(self, value=None, **kwargs):
+        self._val = value
+
+    def _on_hlm(self, value=None, **kwargs):
+        self._hlm = value
+
+    def _on_llm(self, value=None, **kwargs):
+        self._llm = value
+
+    def _on_dmov(self, value=None, **kwargs):
+        self._dmov = value
+
+    def _on_rbv(self, value=None, **kwargs):
+        self._rbv = value
+        now = time.time()
+        for callback in list(self._readback_callbacks.values()):
+            callback(value, now)
+
+    def add_readback_callback(self, callback):
+        """ Call callback(readback, time) on every readback update
+
+            Return parameters:
+
+                index for remove_readback_callback
 
-        self._val = self._pv.get()  # Current PV value
+        """
+        index = max(self._readback_callbacks or [0]) + 1
+        self._readback_callbacks[index] = callback
+        return index
+
+    def remove_readback_callback(self, index):
+        self._readback_callbacks.pop(index, None)
 
-    def mv(self, absolute_position, timeout=9999):
+    def mv(self, absolute_position, timeout=9999, wait=None):
         """ Move motor to absolute position
 
             Input parameters:
 
                 absolute_position: absoulte "position" value, can be um/rad/V
+                wait: wait for the motor to finish the movement
+                      (default: wait_for_finish of the motor)
 
             Return parameters:
 
-                none
+                Move handle, to wait for the movement when not waiting
 
         """
         logger.debug("%s moving to absolute position %s",
                      self._epics_name,
                      absolute_position)
-        if self._motor_disabled:
-            raise controls.exceptions.MotorInterrupt(
-                "Motor [{0}] is disabled".format(self._epics_name)
-            )
-
-        # Check validity of absolute position
-        if (absolute_position > self._pv.upper_ctrl_limit
-            or absolute_position < self._pv.lower_ctrl_limit):
-            raise controls.exceptions.MotorInterrupt(
-                "Moving motor [{0}] to position\
-                [{1}] failed: position out of range.".format(
-                    self._epics_name, absolute_position))
+        self.check_position(absolute_position)
+        if wait is None:
+            wait = self._wait_for_finish
 
         # Set new position and wait (if necessary) for finish
-        self._pv.put(absolute_position, self._wait_for_finish, timeout=timeout)
-
-    def mvr(self, relative_position, timeout=9999):
+        move = Move(self, absolute_position, timeout)
+        # the monitor may lag behind the put
+        self._val = absolute_position
+        with controls.timing.span("motor.put"):
+            if wait:
+                self._pv.put(absolute_position, True, timeout=timeout)
+            else:
+                self._pv.put(absolute_position, use_complete=True)
+        return move
+
+    def mvr(self, relative_position, timeout=9999, wait=None):
         """ Move motor to relative position
 
             I.e. if current position is 40um, and mvr(20), move to 60um
@@ -98,10 +279,12 @@ class Motor():
             Input parameters:
 
                 realtive_position: relative "position" value, can be um/rad/V
+                wait: wait for the motor to finish the movement
+                      (default: wait_for_finish of the motor)
 
             Return parameters:
 
-                none
+                Move handle, to wait for the movement when not waiting
 
         """
         logger.debug("%s moving relative %s",
@@ -113,20 +296,34 @@ class Motor():
 
         # Calculate absolute position
         absolute_position = self.get_current_value() + relative_position
+        return self.mv(absolute_position, timeout, wait)
+
+    def check_position(self, absolute_position):
+        """ Raise MotorInterrupt if the motor is disabled or the position
+            is out of its limits
+        """
+        if self._motor_disabled:
+            raise controls.exceptions.MotorInterrupt(
+                "Motor [{0}] is disabled".format(self._epics_name)
+            )
+
         # Check validity of absolute position
-        if (absolute_position > self._pv.upper_ctrl_limit
-            or absolute_position < self._pv.lower_ctrl_limit):
+        if (absolute_position > self._hlm
+            or absolute_position < self._llm):
             raise controls.exceptions.MotorInterrupt(
                 "Moving motor [{0}] to position\
                 [{1}] failed: position out of range.".format(
                     self._epics_name, absolute_position))
 
-        # Set new position and wait (if necessary) for finish
-        self._pv.put(absolute_position, self._wait_for_finish, timeout=timeout)
+    @property
+    def name(self):
+        """ Brief description of the motor
+        """
+        return self._description
 
     # Get current value of motor PV (position)
     def get_current_value(self):
-        """ Update motor PV value (position) and return it
+        """ Return motor PV value (position), as last monitored
 
             Input parameters:
 
@@ -137,7 +334,28 @@ class Motor():
                 self._val (current)
 
         """
-        return self._pv.get()
+        return self._val
+
+    def get_readback(self):
+        """ Return the motor readback (RBV), as last monitored
+        """
+        return self._rbv
+
+    def get_velocity(self):
+        """ Return the motor velocity (VELO), in units per second
+        """
+        return self._velo_pv.get()
+
+    def set_velocity(self, velocity):
+        """ Set the motor velocity (VELO) of the next moves
+        """
+        self._velo_pv.put(velocity, True)
+
+    def settle(self):
+        """ Wait for the motor to settle after a move, following its
+            settle policy
+        """
+        self.settle_policy.settle(self)
 
     # Get high/low limits
     def get_high_limit(self):
@@ -152,7 +370,7 @@ class Motor():
                 self._hlm
 
         """
-        return self._pv.upper_ctrl_limit
+        return self._hlm
 
     def get_low_limit(self):
         """ Return the motors low limit value
@@ -166,7 +384,12 @@ class Motor():
                 self._llm
 
         """
-        return self._pv.lower_ctrl_limit
+        return self._llm
+
+    def is_moving(self):
+        """ Return True while the motor record is moving (DMOV is 0)
+        """
+        return not self._dmov
 
     # Print Info of single motor
     def __str__(self):
@@ -176,3 +399,90 @@ class Motor():
             self._epics_name,
             self._description,
             self.get_current_value())
+
+
+class MotorGroup(object):
+    """ Motors that are moved together: every axis starts at once and the
+        group waits for all of them
+    """
+    def __init__(self, motors=(), description=""):
+        """ Input variables:
+
+                motors: the motors of the group, for display
+                description: brief description
+
+        """
+        self.motors = list(motors)
+        self.description = description
+
+    def mv(self, positions, timeout=9999):
+        """ Move motors to absolute positions in parallel
+
+            Input parameters:
+
+                positions: dict of motor: absolute position
+                timeout: seconds for each axis, or dict of motor: seconds
+
+            Return parameters:
+
+                none
+
+            All the positions are checked before any motor moves. A
+            MotorInterrupt reports every axis that failed.
+        """
+        for motor, position in positions.items():
+            motor.check_position(position)
+        moves = []
+        errors = []
+        for motor, position in positions.items():
+            try:
+                moves.append(motor.mv(
+                    position, self._timeout(motor, timeout), wait=False))
+            except Exception as e:
+                errors.append(e)
+        for move in moves:
+            try:
+                move.wait()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise controls.exceptions.MotorInterrupt(
+                "Moving {0} motors failed:\n{1}".format(
+                    len(errors), "\n".join(str(e) for e in errors)))
+
+    def mvr(self, offsets, timeout=9999):
+        """ Move motors relative to their current positions in parallel
+
+            Input parameters:
+
+                offsets: dict of motor: relative position
+                timeout: seconds for each axis, or dict of motor: seconds
+
+            Return parameters:
+
+                none
+
+        """
+        self.mv(
+            dict((motor, motor.get_current_value() + offset)
+                 for motor, offset in offsets.items()),
+            timeout)
+
+    def get_current_value(self):
+        """ Return a dict of motor: position of the motors of the group
+        """
+        return dict(
+            (motor, motor.get_current_value()) for motor in self.motors)
+
+    @staticmethod
+    def _timeout(motor, timeout):
+        if isinstance(timeout, dict):
+            return timeout.get(motor, 9999)
+        return timeout
+
+    def __str__(self):
+        """ Print description and all the motors of the group
+        """
+        return "\n{0}{1}".format(
+            self.description,
+            "".join(str(motor) for motor in self.motors))
@@ -0,0 +1,285 @@
+"""Absorption, differential phase and dark-field from phase stepping
+curves, while the scan is running.
+
+The intensity of each pixel along a phase stepping curve is a sine: its
+mean gives the absorption, its phase the differential phase and its
+amplitude over the mean (the visibility) the dark-field signal. All three
+are read from the first two coefficients of an FFT along the phase step
+axis, and normalized by the same coefficients of a flat scan without the
+sample.
+
+OnlineRetrieval follows the frames of a phase_stepping_scan as they are
+written to the series file. Each phase stepping curve is reduced as soon
+as all its frames arrived, and the maps are written to REDUCED_GROUP of
+the series file, one row per position of the outer motor.
+"""
+
+from __future__ import division
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+import controls.hdf5
+import controls.timing
+
+logger = logging.getLogger(__name__)
+
+REDUCED_GROUP = "/entry/reduced"
+ABSORPTION = "absorption"
+DIFFERENTIAL_PHASE = "differential_phase"
+DARK_FIELD = "dark_field"
+
+# flat references already computed, by (file, modification time, steps)
+_flats = {}
+_flats_lock = threading.Lock()
+
+
+def coefficients(curves):
+    """Mean and first harmonic of the phase stepping curves.
+
+    Args:
+        curves: (phase_steps, ...) array, one curve per pixel
+
+    Returns:
+        the mean (real) and the first harmonic (complex) of each curve
+    """
+    spectrum = np.fft.rfft(curves, axis=0)
+    phase_steps = curves.shape[0]
+    return spectrum[0].real / phase_steps, 2 * spectrum[1] / phase_steps
+
+
+def retrieve(curves, flat_mean, flat_harmonic):
+    """Absorption, differential phase and dark-field of the curves, given
+    the coefficients of the flat curves.
+
+    Returns:
+        dict of float32 arrays with the shape of one frame: ABSORPTION is
+        the transmission, DIFFERENTIAL_PHASE the phase shift in radians
+        within [-pi, pi] and DARK_FIELD the relative visibility
+    """
+    mean, harmonic = coefficients(curves)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        transmission = mean / flat_mean
+        visibility = np.abs(harmonic) / mean
+        flat_visibility = np.abs(flat_harmonic) / flat_mean
+        return {
+            ABSORPTION: transmission.astype(np.float32),
+            DIFFERENTIAL_PHASE: np.angle(
+                harmonic * np.conj(flat_harmonic)).astype(np.float32),
+            DARK_FIELD: (visibility / flat_visibility).astype(np.float32),
+        }
+
+
+class FlatReference(object):
+    "Coefficients of the phase stepping curves without the sample"
+
+    def __init__(self, curves):
+        """
+        Args:
+            curves: (phase_steps, rows, columns) flat phase stepping curve
+        """
+        super(FlatReference, self).__init__()
+        self.phase_steps = curves.shape[0]
+        self.shape = curves.shape[1:]
+        self.mean, self.harmonic = coefficients(
+            np.asarray(curves, dtype=np.float64))
+
+    @classmethod
+    def from_file(cls, filename, phase_steps, frames_per_point=1):
+        """Flat reference from the series file of a phase_stepping_scan,
+        averaging the frames of each phase step over all the positions of
+        the outer motor.
+
+        It is computed once per file and then kept in memory.
+
+        Args:
+            frames_per_point: frames of each phase step, only needed if
+                the file has no SCAN_GROUP/point dataset
+        """
+        key = (os.path.abspath(filename), os.path.getmtime(filename),
+               phase_steps)
+        with _flats_lock:
+            if key not in _flats:
+                _flats[key] = cls(_read_curves(
+                    filename, phase_steps, frames_per_point))
+            return _flats[key]
+
+
+def _read_curves(filename, phase_steps, frames_per_point):
+    """Mean frame of each phase step of a series of any layout, read
+    through controls.hdf5.SeriesReader."""
+    scan_points = controls.hdf5.SCAN_GROUP + "/point"
+    with h5py.File(filename, "r") as input_file:
+        points = None
+        if scan_points in input_file:
+            points = input_file[scan_points][...]
+    with controls.hdf5.SeriesReader(filename) as series:
+        if points is None:
+            # canonical order
+            points = np.arange(len(series)) // frames_per_point
+        steps = points[:len(series)] % phase_steps
+        curves = np.zeros((phase_steps,) + series.shape[1:])
+        for index, frame in series.iter_frames(range(len(steps))):
+            curves[steps[index]] += frame
+    counts = np.bincount(steps, minlength=phase_steps)
+    if not counts.all():
+        raise ValueError("{0} misses some of the {1} phase steps".format(
+            filename, phase_steps))
+    return curves / counts.reshape((-1,) + (1,) * (curves.ndim - 1))
+
+
+class OnlineRetrieval(object):
+    """Hdf5Writer observer reducing each phase stepping curve of a
+    phase_stepping_scan as soon as its frames are written.
+
+    The frames of a curve are summed into one buffer per position of the
+    outer motor, so only the curves being acquired are in memory. A
+    complete curve is split in bands of rows reduced in parallel by a
+    thread pool, while the next frames arrive. The maps are written from
+    the writer thread, when the next frame comes or when the series is
+    closed.
+
+    Failures are logged and stop the reduction, never the acquisition.
+    """
+
+    def __init__(self, flat, shape, frames_per_point=1, workers=4):
+        """
+        Args:
+            flat: FlatReference
+            shape: (positions of the outer motor, phase steps)
+            frames_per_point: frames taken at each phase step
+            workers: threads reducing the curves
+        """
+        super(OnlineRetrieval, self).__init__()
+        if flat.phase_steps != shape[1]:
+            raise ValueError(
+                "flat reference of {0} phase steps for a scan of {1}".format(
+                    flat.phase_steps, shape[1]))
+        self.flat = flat
+        self.shape = shape
+        self.frames_per_point = frames_per_point
+        self.workers = workers
+        self.order = np.arange(int(np.prod(shape)))
+        self.writer = None
+        self.executor = None
+        self.curves = {}
+        self.frames = {}
+        self.reducing = []
+        self.datasets = None
+        self.failed = False
+        self.reduced = 0
+
+    def set_order(self, order):
+        "Points of the scan (indices into the grid) in acquisition order"
+        self.order = np.asarray(order)
+
+    def start(self, writer):
+        self.writer = writer
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.curves = {}
+        self.frames = {}
+        self.reducing = []
+        self.datasets = None
+        self.failed = False
+        self.reduced = 0
+
+    def frame(self, index, data):
+        if self.failed:
+            return
+        try:
+            with controls.timing.span("reduction.accumulate"):
+                self._accumulate(index, data)
+            self._write_done(wait=False)
+        except Exception:
+            logger.exception("phase stepping retrieval failed, stopping it")
+            self.failed = True
+
+    def finish(self, writer):
+        try:
+            if not self.failed:
+                self._write_done(wait=True)
+                if self.curves:
+                    logger.warning(
+                        "%d phase stepping curves were not complete",
+                        len(self.curves))
+        except Exception:
+            logger.exception("phase stepping retrieval failed")
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+            self.curves = {}
+            self.reducing = []
+            self.writer = None
+
+    def _accumulate(self, index, data):
+        point = self.order[index // self.frames_per_point]
+        position, step = divmod(int(point), self.shape[1])
+        if position not in self.curves:
+            self.curves[position] = np.zeros(
+                (self.shape[1],) + data.shape, dtype=np.float32)
+            self.frames[position] = 0
+        self.curves[position][step] += data
+        self.frames[position] += 1
+        if self.frames[position] == self.shape[1] * self.frames_per_point:
+            curves = self.curves.pop(position)
+            del self.frames[position]
+            # mean frame of each step, as the flat reference
+            curves /= self.frames_per_point
+            self._reduce(position, curves)
+
+    def _reduce(self, position, curves):
+        "Start reducing the curves of one position in bands of rows"
+        bands = np.array_split(
+            np.arange(curves.shape[1]), min(self.workers, curves.shape[1]))
+        futures = [
+            self.executor.submit(
+                self._retrieve_band,
+                curves[:, band[0]:band[-1] + 1],
+                self.flat.mean[band[0]:band[-1] + 1],
+                self.flat.harmonic[band[0]:band[-1] + 1])
+            for band in bands if len(band)]
+        self.reducing.append((position, futures))
+
+    @staticmethod
+    def _retrieve_band(curves, flat_mean, flat_harmonic):
+        with controls.timing.span("reduction.retrieve"):
+            return retrieve(curves, flat_mean, flat_harmonic)
+
+    def _write_done(self, wait):
+        "Write the maps of the curves reduced so far"
+        while self.reducing:
+            position, futures = self.reducing[0]
+            if not wait and not all(future.done() for future in futures):
+                return
+            self.reducing.pop(0)
+            bands = [future.result() for future in futures]
+            with controls.timing.span("reduction.write"):
+                self._write(position, dict(
+                    (name, np.concatenate([band[name] for band in bands]))
+                    for name in bands[0]))
+
+    def _write(self, position, maps):
+        output_file = self.writer.file
+        if self.datasets is None:
+            group = output_file.require_group(REDUCED_GROUP)
+            self.datasets = {}
+            for name, values in maps.items():
+                if name in group:
+                    del group[name]
+                self.datasets[name] = group.create_dataset(
+                    name,
+                    shape=(self.shape[0],) + values.shape,
+                    chunks=(1,) + values.shape,
+                    dtype=np.float32,
+                    fillvalue=np.nan)
+        for name, values in maps.items():
+            self.datasets[name][position] = values
+        output_file.flush()
+        self.reduced += 1
+        logger.debug("reduced the phase stepping curve at position %d",
+                     position)
@@ -1,31 +1,69 @@
-import dectris.albula
-
-import socket
 import datetime
 import os
 import logging
-import tempfile
-import glob
-import shutil
-import subprocess
+import re
 import time
 
+import controls.cbf
+import controls.connection
 import controls.hdf5
+import controls.settings_cache
+import controls.timing
+import controls.transfer
 
 logger = logging.getLogger(__name__)
 
 
 REMOTE_IMAGE_PATH = "/home/det/python-controls-high-energy"
-SOCKET_BUFFER_SIZE = 1024
+# camserver ends each reply with a CAN character
+CAMSERVER_DELIMITER = "\x18"
+# seconds to wait for the reply to a command
+COMMAND_TIMEOUT = 5
+# seconds to wait for SetThreshold, which reloads the trim files
+THRESHOLD_TIMEOUT = 60
+# seconds to wait for the end of an exposure, on top of its duration
+EXPOSURE_TIMEOUT = 10
+# minimum time between the end of a frame and the start of the next one
+READOUT_TIME = 0.003
+# camserver command starting the frames in each trigger mode, named as
+# the trigger modes of the Eiger
+TRIGGER_COMMANDS = {
+    # internal timing, one command per series of nImages() frames
+    "ints": "expo",
+    # one external trigger starts the whole series
+    "exts": "exttrigger",
+    # one external trigger per frame
+    "extm": "extmtrigger",
+    # each external enable gate is one frame
+    "exte": "extenable",
+}
+
+
+def camserver_ok(answer):
+    "camserver answers OK or ERR after the command number"
+    return bool(answer) and "ERR" not in answer
 
 
 class DPilatusDetector(object):
     "Use the same interface as the DEigerDetector class from dectris.albula"
 
+    readout_time = READOUT_TIME
+
     def __init__(self, host="129.129.99.81", port=41234):
         super(DPilatusDetector, self).__init__()
         self.host = host
         self.port = port
+        self.trigger_mode = "ints"
+        self.n_images = 1
+        self.n_trigger = 1
+        self.exposure_time = 1
+        self.armed = False
+        self.series_name = None
+        self.settings = controls.settings_cache.SettingsCache(camserver_ok)
+        self.connection = controls.connection.FramedConnection(
+            host, port,
+            delimiter=CAMSERVER_DELIMITER,
+            timeout=COMMAND_TIMEOUT)
 
     def initialize(self, timeout=5):
         """
@@ -39,148 +77,223 @@ class DPilatusDetector(object):
             True if connection was established successfully else False.
         """
 
-        self.__openSocket(self.host, timeout)
-        if not self.__socket:
+        self.settings.invalidate()
+        if not self.__openSocket(timeout):
             return False
-        self.__socket.sendall("prog b*_m*_chsel 0xffff\n")
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        logger.debug(answer)
-        self.__socket.settimeout(None)
-        # unload flat field
-        self.__socket.sendall('LdFlatField 0\n')
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        logger.debug(answer)
-        # set remote image path
-        self.__socket.sendall("imgpath {0}\n".format(REMOTE_IMAGE_PATH))
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        logger.debug(answer)
+        answers = self.connection.pipeline([
+            "prog b*_m*_chsel 0xffff",
+            # unload flat field
+            "LdFlatField 0",
+            # set remote image path
+            "imgpath {0}".format(REMOTE_IMAGE_PATH),
+        ])
+        logger.debug(answers)
         return True
 
     def close(self):
         """
         Close connection to camserver
         """
-        if self.__socket:
-            self.__socket.shutdown(socket.SHUT_RDWR)
-            self.__socket.close()
-            self.__socket = None
+        self.settings.invalidate()
+        self.connection.close()
         return
-        
+
     def abort(self):
         try:
-            self.__socket.sendall("k")
-            self.__socketRecv(timeout = 0.1) # set timeout because 'k' may or may not return an answer
-            self.__socketRecv(timeout = 0.1) # set timeout because 'k' may or may not return an answer
-            self.__socketRecv(timeout = 10) # eventually read final answer from exposure, ...
-        except:
-            pass
+            self.connection.send_raw("k")
+            # 'k' may or may not return an answer, a running exposure
+            # returns its final one
+            logger.debug(self.connection.drain(
+                timeout=0.1, outstanding_timeout=10))
+        except Exception:
+            logger.exception("abort failed")
+        self.settings.invalidate()
+        self.armed = False
         self.__abort = True;
         return self.__abort
 
     def setPhotonEnergy(self, photon_energy):
-        self.__socket.sendall("SetThreshold {0}\n".format(photon_energy))
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        return answer
+        """Set the threshold. This reloads the trim files and takes
+        seconds, so it is skipped if the threshold is already set."""
+        if self.settings.get("SetThreshold") is None:
+            self.photonEnergy()
+        return self.settings.set(
+            "SetThreshold", int(photon_energy),
+            lambda value: self.__send_command(
+                "SetThreshold {0}".format(value), THRESHOLD_TIMEOUT))
 
     def photonEnergy(self):
-        self.__socket.sendall("SetThreshold\n")
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
+        "Query the threshold, and remember it for setPhotonEnergy"
+        answer = self.__send_command("SetThreshold")
+        match = re.search(r"threshold: *(\d+) *eV", answer or "")
+        if match is not None:
+            self.settings.seed("SetThreshold", int(match.group(1)), answer)
         return answer
 
     def setCountTime(self, exposure_time):
-        self.__socket.sendall("Exptime {0}\n".format(exposure_time))
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        return answer
+        return self.__set("Exptime", exposure_time)
 
     def countTime(self):
-        self.__socket.sendall("Exptime\n")
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        return answer
+        return self.__send_command("Exptime")
 
-    setFrameTime = setCountTime
-    frameTime = countTime
+    def setFrameTime(self, frame_time):
+        return self.__set("expperiod", frame_time)
+
+    def frameTime(self):
+        return self.__send_command("expperiod")
+
+    def setExposureParameters(self, exposure_time=1):
+        """Set the count time and the shortest frame time for a series"""
+        self.exposure_time = exposure_time
+        self.setCountTime(exposure_time)
+        return self.setFrameTime(exposure_time + READOUT_TIME)
 
     def setNImages(self, n):
-        # dont want to take more than one image with the pilatus trigger now
-        pass
+        "Number of frames taken for each trigger"
+        self.n_images = n
+        return self.__set("nimages", n)
 
     def nImages(self):
-        return 1
+        return self.n_images
+
+    def setNTrigger(self, n):
+        "Number of triggers in the series started by arm()"
+        self.n_trigger = n
+
+    def nTrigger(self):
+        return self.n_trigger
+
+    def setTriggerMode(self, mode):
+        "One of the keys of TRIGGER_COMMANDS"
+        if mode not in TRIGGER_COMMANDS:
+            raise ValueError("unknown trigger mode {0}".format(mode))
+        self.trigger_mode = mode
+
+    def triggerMode(self):
+        return self.trigger_mode
 
     def version(self):
-        self.__socket.sendall("version\n")
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        return answer
+        return self.__send_command("version")
 
     def status(self):
-        self.__socket.sendall("status\n")
-        answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        return answer
+        return self.__send_command("status")
 
     isError = status
 
     def trigger(self, exposure_time=1):
-        self.setCountTime(exposure_time)
-        self.setFrameTime(1.02 * exposure_time)
-        now = datetime.datetime.now().strftime("%y%m%d.%H%M%S%f")
-        fileName = 'dectrisAlbula.{0}.cbf'.format(now)
-        logger.debug("exposing for %s", fileName)
-        self.__socket.sendall("expo {0}\n".format(fileName))
-        answer = self.__socketRecv(SOCKET_BUFFER_SIZE)
+        """Take nImages() frames with a single expo command.
+
+        The settings that changed since the last frames are sent together
+        with expo, and their replies read back at once.
+
+        With the external trigger modes the frames were already requested
+        by arm() and are started by the hardware, so nothing is sent.
+        """
+        if self.trigger_mode != "ints":
+            logger.debug("%s mode, waiting for the hardware trigger",
+                         self.trigger_mode)
+            return
+        self.exposure_time = exposure_time
+        frame_time = exposure_time + READOUT_TIME
+        # arm() may have changed nimages for an external series
+        with controls.timing.span("pilatus.command"):
+            answer = self.__start_frames([
+                ("Exptime", exposure_time),
+                ("expperiod", frame_time),
+                ("nimages", self.n_images),
+            ])
         logger.debug(answer)
-        answer = self.__socketRecv(SOCKET_BUFFER_SIZE)
+        with controls.timing.span("pilatus.expo"):
+            answer = self.connection.expect(
+                self.n_images * frame_time + EXPOSURE_TIMEOUT)
         logger.debug(answer)
 
     def arm(self):
-        pass
-
-    def disarm(self):
-        pass
-
-    def __openSocket(self, host, timeout):
-        self.__socket = None
-        for addrFam, socketType, proto, canonName, socketAddr in socket.getaddrinfo(host, self.port, socket.AF_UNSPEC, socket.SOCK_STREAM):
-            try:
-                self.__socket = socket.socket(addrFam, socketType, proto)
-            except socket.error as msg:
-                logger.error("socket connection failed %s", msg)
-                self.__socket = None
-                continue
-            try:
-                self.__socket.connect(socketAddr)
-                timeWaited = 0
-                while True:
-                    self.__socket.sendall("imgmode x\n")
-                    answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-                    if (answer.find("access denied")>=0):
-                        if timeWaited < timeout:
-                            timeWaited += 1
-                            time.sleep(1)
-                        else:
-                            self.__socket.close()
-                            self.__socket = None
-                            return None
-                    else:
-                        break
-            except socket.error as msg:
-                logger.error("socket connection failed %s", msg)
-                self.__socket.close()
-                self.__socket = None
-                continue
-            break
-
-    def __socketRecv(self, timeout=None):
-        self.__socket.settimeout(timeout)
+        """In the external trigger modes, request all the frames of the
+        series, nTrigger() * nImages(), with a single command."""
+        if self.trigger_mode == "ints":
+            return
+        answer = self.__start_frames([
+            ("nimages", self.n_trigger * self.n_images)])
+        logger.debug(answer)
+        self.armed = True
+
+    def disarm(self, timeout=None):
+        """Wait for the end of an externally triggered series.
+
+        Args:
+            timeout: seconds, by default the time the frames of the series
+                take at the shortest frame time, plus EXPOSURE_TIMEOUT
+
+        Raises:
+            CameraInterrupt if the series did not end in time, when a
+            trigger was missed or camserver dropped the series
+        """
+        if not self.armed:
+            return
+        self.armed = False
+        if timeout is None:
+            timeout = (self.n_trigger * self.n_images *
+                       (self.exposure_time + READOUT_TIME) + EXPOSURE_TIMEOUT)
+        answer = self.connection.expect(timeout)
+        logger.debug(answer)
+
+    def __start_frames(self, settings=()):
+        """Send the (name, value) settings that changed, then the command
+        starting the frames, without waiting in between.
+
+        Returns:
+            the first answer to the start command
+        """
+        now = datetime.datetime.now().strftime("%y%m%d.%H%M%S%f")
+        # camserver appends _NNNNN to the name of the frames of a series
+        self.series_name = 'dectrisAlbula.{0}'.format(now)
+        fileName = '{0}.cbf'.format(self.series_name)
+        command = TRIGGER_COMMANDS[self.trigger_mode]
+        changed = [
+            (name, value) for name, value in settings
+            if self.settings.changed(name, value)]
         try:
-            answer = self.__socket.recv(SOCKET_BUFFER_SIZE)
-        except socket.timeout:
-            answer = None
-        except Exception as e:
-            answer = None
-            self.__socket.settimeout(None)
-            raise e
-        self.__socket.settimeout(None)
-        return answer
+            for name, value in changed:
+                self.settings.invalidate(name)
+                self.connection.send("{0} {1}".format(name, value))
+            logger.debug("%s %s", command, fileName)
+            # acknowledged at the start and at the end of the frames
+            self.connection.send(
+                "{0} {1}".format(command, fileName), replies=2)
+            for name, value in changed:
+                self.settings.acknowledge(
+                    name, value, self.connection.expect())
+            return self.connection.expect()
+        except Exception:
+            self.settings.invalidate()
+            raise
+
+    def __set(self, name, value):
+        return self.settings.set(
+            name, value,
+            lambda value: self.__send_command(
+                "{0} {1}".format(name, value)))
+
+    def __send_command(self, command,
+                       timeout=controls.connection.DEFAULT):
+        with controls.timing.span("pilatus.command"):
+            return self.connection.command(command, timeout)
+
+    def __openSocket(self, timeout):
+        "Connect and wait for camserver to accept commands from us"
+        if not self.connection.open(timeout):
+            return False
+        timeWaited = 0
+        while True:
+            answer = self.connection.command("imgmode x")
+            if answer.find("access denied") < 0:
+                return True
+            if timeWaited >= timeout:
+                self.connection.close()
+                return False
+            timeWaited += 1
+            time.sleep(1)
 
 
 class Pilatus(DPilatusDetector):
@@ -189,9 +302,32 @@ class Pilatus(DPilatusDetector):
                  host="129.129.99.81",
                  port=41234,
                  photon_energy=10000,
-                 storage_path="."):
+                 storage_path=".",
+                 hdf5_layout=controls.hdf5.LAYOUT_STACK,
+                 compression=None,
+                 num_image_per_file=None,
+                 transport=None):
+        """
+        Args:
+            transport: where to collect the cbf files from, by default
+                REMOTE_IMAGE_PATH on the camserver host over ssh
+        """
 
         self.storage_path = storage_path
+        self.hdf5_layout = hdf5_layout
+        self.compression = compression
+        self.num_image_per_file = num_image_per_file
+        # Hdf5Writer observers of the frames of every series
+        self.frame_observers = []
+        # save one frame out of decimation, none with 0
+        self.decimation = 1
+        # stack index of each frame of the next series, None in order
+        self.frame_order = None
+        if transport is None:
+            transport = controls.transfer.SshTransport(
+                host, REMOTE_IMAGE_PATH)
+        self.transport = transport
+        self.collector = None
         super(Pilatus, self).__init__(host, port)
         self.initialize()
         logger.debug(
@@ -202,41 +338,83 @@ class Pilatus(DPilatusDetector):
         answer = self.setPhotonEnergy(photon_energy)
         logger.debug("Set energy %s", answer)
 
-    def save(self):
+    def close(self):
+        super(Pilatus, self).close()
+        self.transport.close()
+
+    def arm(self):
+        "Start collecting the frames of a new series in the background"
+        self.start_collector()
+        return super(Pilatus, self).arm()
+
+    def trigger(self, exposure_time=1):
+        super(Pilatus, self).trigger(exposure_time)
+        if self.trigger_mode == "ints":
+            self.collect(self.series_name, self.n_images)
+
+    def disarm(self, timeout=None):
+        armed = self.armed
+        super(Pilatus, self).disarm(timeout)
+        if armed:
+            self.collect(self.series_name, self.n_trigger * self.n_images)
+
+    def collect(self, series_name, count=None):
+        "Queue the count frames of a completed exposure for the hdf5 file"
+        if self.collector is None:
+            self.start_collector()
+        self.collector.add("{0}*.cbf".format(series_name), count)
+
+    def start_collector(self):
+        if self.collector is not None:
+            logger.warning("previous series was not saved, saving it now")
+            self.save()
         now = datetime.datetime.now()
         output_file = os.path.join(
             self.storage_path,
             "series.{0}.h5".format(now.strftime("%y%m%d.%H%M%S%f"))
         )
         logger.debug("saving pilatus image to %s ...", output_file)
-        tempdir = tempfile.mkdtemp()
-        try:
-            logger.debug("created temporary directory %s", tempdir)
-            copy_command = "scp det@{0}:{1}/*.cbf {2}".format(
-                self.host,
-                REMOTE_IMAGE_PATH,
-                tempdir) 
-            logger.debug(copy_command)
-            copied = subprocess.check_output(copy_command, shell=True)
-            logger.debug(copied)
-            removed = subprocess.check_output(
-                "ssh det@{0} 'rm {1}/*.cbf'".format(
-                    self.host,
-                    REMOTE_IMAGE_PATH,
-                    ), shell=True)
-            logger.debug(removed)
-            copied_files = sorted(glob.glob("{0}/*.cbf".format(tempdir)))
-            with controls.hdf5.Hdf5Writer(output_file) as hdf5_writer:
-                for input_file in copied_files:
-                    data = dectris.albula.readImage(input_file)
-                    hdf5_writer.write(data)
-            logger.info("pilatus image saved to %s", output_file)
-            logger.debug(now.strftime("%H%M%S%f"))
-        finally:
-            shutil.rmtree(tempdir)
-
-    def snap(self, exposure_time=1):
-        self.setNImages(1)
-        self.setCountTime(exposure_time)
-        self.trigger()
+        hdf5_writer = controls.hdf5.Hdf5Writer(
+            output_file,
+            n_frames=self.n_trigger * self.n_images,
+            layout=self.hdf5_layout,
+            compression=self.compression,
+            num_image_per_file=self.num_image_per_file,
+            observers=self.frame_observers,
+            decimation=self.decimation,
+            frame_order=self.frame_order)
+        self.collector = controls.transfer.FileCollector(
+            self.transport, hdf5_writer, controls.cbf.read_cbf)
+        self.collector.start()
+
+    @property
+    def series_file(self):
+        "hdf5 file of the series being acquired, None before arm()"
+        if self.collector is None:
+            return None
+        return self.collector.filename
+
+    def save(self):
+        """Wait for the collector to write the last frames. Without a
+        series started by arm(), collect all the cbf files left on the
+        camserver.
+
+        Returns:
+            the name of the hdf5 file, None if decimation saves no frame
+        """
+        if self.collector is None:
+            self.collect("")
+        collector = self.collector
+        self.collector = None
+        collector.finish()
+        logger.info("pilatus image saved to %s", collector.filename)
+        logger.debug(datetime.datetime.now().strftime("%H%M%S%f"))
+        return collector.filename
+
+    def snap(self, exposure_time=1, n_images=1):
+        self.setNImages(n_images)
+        self.setNTrigger(1)
+        self.arm()
+        self.trigger(exposure_time)
+        self.disarm()
         self.save()
@@ -0,0 +1,147 @@
+"""Statistics of regions of interest of the frames, computed while they
+are acquired, for alignment scans that do not need the frames themselves.
+
+A region is (x1, y1, x2, y2) in pixels, as in
+HamamatsuFlatPanel.setROI: columns x1 to x2 and rows y1 to y2, ends
+excluded. None is the whole frame.
+"""
+
+from __future__ import division
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# sum of the counts
+SUM = "sum"
+# highest pixel
+MAX = "max"
+# intensity weighted mean position, in pixels of the frame
+CENTROID_X = "centroid_x"
+CENTROID_Y = "centroid_y"
+# sqrt(2) * standard deviation / mean: the visibility of a sine pattern
+# covering the region
+VISIBILITY = "visibility"
+METRICS = (SUM, MAX, CENTROID_X, CENTROID_Y, VISIBILITY)
+
+# position of the maximum of a metric
+FIT_PEAK = "peak"
+# position of the steepest change of a metric
+FIT_EDGE = "edge"
+
+
+def statistics(frame, region=None):
+    """Every metric of one region of a frame.
+
+    Returns:
+        dict of metric: float
+    """
+    if region is not None:
+        x1, y1, x2, y2 = region
+        frame = frame[y1:y2, x1:x2]
+    else:
+        x1 = y1 = 0
+    frame = np.asarray(frame, dtype=np.float64)
+    total = frame.sum()
+    columns = frame.sum(axis=0)
+    rows = frame.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            SUM: total,
+            MAX: frame.max(),
+            CENTROID_X: x1 + columns.dot(np.arange(len(columns))) / total,
+            CENTROID_Y: y1 + rows.dot(np.arange(len(rows))) / total,
+            VISIBILITY: np.sqrt(2) * frame.std() / frame.mean(),
+        }
+
+
+class RoiStatistics(object):
+    """Hdf5Writer observer computing the statistics of regions of every
+    frame of a scan, averaged over the frames of each point.
+
+    Use with controls.scans.scan(reduction=...), which tells the order in
+    which the points are taken.
+    """
+
+    def __init__(self, n_points, regions=(None,), frames_per_point=1):
+        """
+        Args:
+            n_points: of the scan
+            regions: list of regions
+        """
+        super(RoiStatistics, self).__init__()
+        self.regions = list(regions)
+        self.frames_per_point = frames_per_point
+        self.order = np.arange(n_points)
+        self.sums = dict(
+            (metric, np.zeros((n_points, len(self.regions))))
+            for metric in METRICS)
+        self.counts = np.zeros(n_points, dtype=int)
+
+    def set_order(self, order):
+        "Points of the scan in acquisition order"
+        self.order = np.asarray(order)
+
+    def start(self, writer):
+        pass
+
+    def frame(self, index, data):
+        point = self.order[index // self.frames_per_point]
+        for i, region in enumerate(self.regions):
+            for metric, value in statistics(data, region).items():
+                self.sums[metric][point, i] += value
+        self.counts[point] += 1
+
+    def finish(self, writer):
+        missing = np.count_nonzero(self.counts == 0)
+        if missing:
+            logger.warning("no frame for %d of %d points",
+                           missing, len(self.counts))
+
+    def values(self, metric):
+        """Mean of metric over the frames of each point, nan for the
+        points without frames.
+
+        Returns:
+            (n_points, n_regions) array
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sums[metric] / self.counts[:, np.newaxis]
+
+
+def fit_peak(positions, values):
+    """Position of the maximum of values: the vertex of a gaussian fitted
+    to the points above half of the maximum, or the position of the
+    highest point if there are not enough of them."""
+    positions = np.asarray(positions, dtype=float)
+    values = np.asarray(values, dtype=float)
+    valid = np.isfinite(values)
+    positions = positions[valid]
+    values = values[valid]
+    if not len(values):
+        return np.nan
+    values = values - values.min()
+    best = int(np.argmax(values))
+    top = values > values[best] / 2
+    if np.count_nonzero(top) < 3:
+        return positions[best]
+    # a gaussian is a parabola in log scale
+    a, b, _ = np.polyfit(positions[top], np.log(values[top]), 2)
+    if a >= 0:
+        return positions[best]
+    return -b / (2 * a)
+
+
+def fit_edge(positions, values):
+    "Position of the steepest slope of values, see fit_peak"
+    positions = np.asarray(positions, dtype=float)
+    values = np.asarray(values, dtype=float)
+    return fit_peak(positions, np.abs(np.gradient(values, positions)))
+
+
+FITS = {
+    FIT_PEAK: fit_peak,
+    FIT_EDGE: fit_edge,
+}
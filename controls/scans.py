@@ -1,86 +1,678 @@
 from __future__ import division
 
-import dectris.albula
+import collections
 import logging
-import os
 import time
 import numpy as np
 
+import controls.exceptions
+import controls.hdf5
+import controls.journal
+import controls.phase_retrieval
+import controls.roi
+import controls.timing
+import controls.trajectories
+
 logger = logging.getLogger(__name__)
 
+# phase_stepping_scan walks each phase stepping curve in the same direction
+TRAVERSAL_RASTER = "raster"
+# phase_stepping_scan alternates the direction of the phase stepping curves
+TRAVERSAL_SERPENTINE = "serpentine"
 
-def dscan(detector, motor, begin, end, intervals, exposure_time=1):
-    initial_motor_position = motor.get_current_value()
-    logger.debug("initial motor position %s", initial_motor_position)
+# trigger modes in which the detector waits for hardware triggers
+EXTERNAL_TRIGGER_MODES = ("exts", "extm", "exte")
+
+# result of alignment_dscan
+Alignment = collections.namedtuple(
+    "Alignment", ["positions", "values", "statistics", "fitted"])
+
+
+class _Triggered(object):
+    "Completion handle for detectors that only trigger synchronously"
+
+    def __init__(self, response):
+        super(_Triggered, self).__init__()
+        self.response = response
+
+    def done(self):
+        return True
+
+    def exposed(self, timeout=None):
+        return self.response
+
+    def result(self, timeout=None):
+        return self.response
+
+
+def trigger_async(detector, exposure_time):
+    """Start an exposure and return its completion handle. Once
+    handle.exposed() returns the motors can move while the frame is still
+    being read out, handle.result() waits for the frame."""
+    start = getattr(detector, "trigger_async", None)
+    if start is None:
+        return _Triggered(detector.trigger(exposure_time))
+    return start(exposure_time)
+
+
+def prepare_series(detector, frames_per_point):
+    """Let the detector take all the frames of a scan point with one
+    trigger, if it supports series of images.
+
+    A step scan still sends one software trigger (expo on the Pilatus) per
+    point, on purpose: nothing here can send the hardware pulses of the
+    external trigger modes at each point, and in those modes the detector
+    does not tell when the frame of a point is taken, so the motors could
+    not wait for it before moving on. The settings are cached, so each
+    trigger is a single command. fly_dscan takes the whole scan as one
+    series instead.
+
+    Returns:
+        the number of triggers needed for each scan point
+
+    Raises:
+        ScanInterrupt if the detector waits for external triggers
+    """
+    trigger_mode = getattr(detector, "triggerMode", None)
+    if trigger_mode is not None and trigger_mode() in EXTERNAL_TRIGGER_MODES:
+        raise controls.exceptions.ScanInterrupt(
+            "step scans trigger the detector themselves, set the {0} "
+            "trigger mode back to ints".format(trigger_mode()))
+    set_n_images = getattr(detector, "setNImages", None)
+    if set_n_images is None:
+        return frames_per_point
+    set_n_images(frames_per_point)
+    return 1
+
+
+def prepare_phase_stepping(detector, exposure_time):
+    """Start a prepared phase stepping sequence on the detectors that
+    support one (PREPS/STEP/POSTPS on the Hamamatsu server).
+
+    Returns:
+        True if the sequence was started and must be finished with
+        detector.finish_phase_stepping()
+    """
+    prepare = getattr(detector, "prepare_phase_stepping", None)
+    if prepare is None:
+        return False
+    prepare(exposure_time)
+    return True
+
+
+def settle(motor):
+    "Wait for the motor to settle after a move, if it knows how"
+    settle = getattr(motor, "settle", None)
+    if settle is not None:
+        settle()
+
+
+class _ReadbackLog(object):
+    "Readbacks of a motor and the times they arrived, while in a with block"
+
+    def __init__(self, motor):
+        super(_ReadbackLog, self).__init__()
+        self.motor = motor
+        self.times = []
+        self.positions = []
+        self.index = None
+
+    def __enter__(self):
+        self.record(self.motor.get_readback(), time.time())
+        self.index = self.motor.add_readback_callback(self.record)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.motor.remove_readback_callback(self.index)
+        self.record(self.motor.get_readback(), time.time())
+
+    def record(self, position, timestamp):
+        self.times.append(timestamp)
+        self.positions.append(position)
+
+    def interpolate(self, times):
+        "Positions of the motor at times"
+        order = np.argsort(self.times)
+        return np.interp(
+            times,
+            np.asarray(self.times)[order],
+            np.asarray(self.positions)[order])
+
+
+def _limits(motors):
+    "Cached soft limits of the motors, infinite for the ones without"
+    low = []
+    high = []
+    for motor in motors:
+        get_low = getattr(motor, "get_low_limit", None)
+        get_high = getattr(motor, "get_high_limit", None)
+        low.append(-np.inf if get_low is None else get_low())
+        high.append(np.inf if get_high is None else get_high())
+    return np.array(low, dtype=float), np.array(high, dtype=float)
+
+
+def _move(motors, targets, overlap):
+    """Move the motors to targets, all at once with overlap, otherwise one
+    after the other, and let them settle."""
+    with controls.timing.span("scan.move"):
+        if overlap:
+            moves = [motor.mv(target, wait=False)
+                     for motor, target in zip(motors, targets)]
+            for move in moves:
+                move.wait()
+        else:
+            for motor, target in zip(motors, targets):
+                motor.mv(target)
+    with controls.timing.span("scan.settle"):
+        for motor in motors:
+            settle(motor)
+
+
+def _acquire(detector, motors, targets, order, exposure_time,
+             frames_per_point, overlap, phase_stepping, journal):
+    """Take the frames of the points in order as one detector series,
+    logging each point done in the journal.
+
+    Returns:
+        the series file saved by the detector
+    """
+    with controls.timing.span(controls.timing.SCAN):
+        return _acquire_series(
+            detector, motors, targets, order, exposure_time,
+            frames_per_point, overlap, phase_stepping, journal)
+
+
+def _acquire_series(detector, motors, targets, order, exposure_time,
+                    frames_per_point, overlap, phase_stepping, journal):
+    prepared = False
     try:
-        motor.mvr(begin)
-        step = (end - begin) / intervals
-        detector.setNTrigger(intervals + 1)
+        triggers_per_point = prepare_series(detector, frames_per_point)
+        detector.setNTrigger(len(order) * triggers_per_point)
         try:
             # needed for Titlis
             detector.setExposureParameters(exposure_time)
         except AttributeError:
             pass
-        detector.arm()
-        detector.trigger(exposure_time)
-        for i in range(intervals):
-            motor.mvr(step)
-            time.sleep(0.1)
-            logger.info(motor)
-            logger.debug("snap %d, exposure time %s",
-                i + 1,
-                exposure_time
+        # nominal exposure of the frames of one trigger
+        trigger_exposure = exposure_time * frames_per_point / triggers_per_point
+        with controls.timing.span("scan.arm"):
+            detector.arm()
+        if journal is not None:
+            journal.start_segment(getattr(detector, "series_file", None))
+        if phase_stepping:
+            prepared = prepare_phase_stepping(detector, exposure_time)
+        triggered = None
+        current = np.full(len(motors), np.nan)
+        for n, k in enumerate(order):
+            if triggered is not None:
+                if overlap:
+                    # move during the readout of the previous frame
+                    with controls.timing.span("scan.wait_exposed"):
+                        triggered.exposed()
+                else:
+                    with controls.timing.span("scan.wait_readout"):
+                        triggered.result()
+            changed = np.flatnonzero(targets[k] != current)
+            _move([motors[i] for i in changed], targets[k, changed], overlap)
+            current = targets[k]
+            if triggered is not None:
+                with controls.timing.span("scan.wait_readout"):
+                    triggered.result()
+                if journal is not None:
+                    journal.point_done(order[n - 1])
+            for _ in range(triggers_per_point):
+                start = controls.timing.clock()
+                with controls.timing.span("scan.trigger"):
+                    triggered = trigger_async(detector, exposure_time)
+                controls.timing.record(
+                    controls.timing.EXPOSURE, start, start + trigger_exposure)
+            logger.debug("point %d of %d at %s, exposure time %s",
+                n + 1,
+                len(order),
+                current,
+                exposure_time,
                 )
-            detector.trigger(exposure_time)
-        detector.disarm()
-        detector.save()
-        
+        with controls.timing.span("scan.wait_readout"):
+            triggered.result()
+        if journal is not None:
+            journal.point_done(order[-1])
+        if prepared:
+            prepared = False
+            detector.finish_phase_stepping()
+        with controls.timing.span("scan.disarm"):
+            detector.disarm()
+        with controls.timing.span("scan.save"):
+            return detector.save()
     finally:
-        logger.debug("going back to initial motor position %s", initial_motor_position)
-        motor.mv(initial_motor_position)
+        if prepared:
+            detector.finish_phase_stepping()
+
+
+def _commit_partial_series(detector):
+    """After a failure, end the series and save the frames already taken,
+    as far as the detector still answers."""
+    for step in ("abort", "disarm", "save"):
+        method = getattr(detector, step, None)
+        if method is None:
+            continue
+        try:
+            method()
+        except Exception:
+            logger.exception("%s after the failed scan failed", step)
+
+
+def _check_journal(journal, motors, points, relative, frames_per_point):
+    """Check that the journal is that of the same scan. The points are
+    compared, not the targets, as the motors are wherever the failed run
+    left them."""
+    header = journal.header
+    if (header is None or
+            header["frames_per_point"] != frames_per_point or
+            header["relative"] != relative or
+            header["motors"] != [motor.name for motor in motors] or
+            np.shape(header["points"]) != points.shape or
+            not np.allclose(header["points"], points)):
+        raise controls.exceptions.ScanInterrupt(
+            "{0} is the journal of a different scan".format(
+                journal.filename))
+
+
+def _points_committed(journal, frames_per_point):
+    """Number of points whose frames are safely in the series files,
+    dropping from the journal the ones that are not."""
+    done = 0
+    for series_file, n_done in journal.segments:
+        available = 0
+        if series_file is not None:
+            available = (
+                controls.hdf5.count_frames(series_file) // frames_per_point)
+        done += min(n_done, available)
+        if available < n_done:
+            break
+    journal.truncate(done)
+    return done
+
+
+def _canonical_frames(order, frames_per_point):
+    "Canonical index of each frame of the points visited in order"
+    return (np.repeat(order, frames_per_point) * frames_per_point +
+            np.tile(np.arange(frames_per_point), len(order)))
+
+
+def _visits_all_once(order, n_points):
+    "Whether order is a permutation of the n_points points"
+    return len(order) == n_points and np.array_equal(
+        np.sort(order), np.arange(n_points))
+
+
+def scan(detector, motors, points, exposure_time=1, frames_per_point=1,
+         relative=True, order=None, optimize=False, overlap=True,
+         phase_stepping=False, shape=None, journal=None, reduction=None):
+    """Take frames_per_point frames at each point of a trajectory of any
+    number of motors, then bring the motors back to where they were.
+
+    Args:
+        motors: list of the n_axes motors
+        points: (n_points, n_axes) array of positions, see
+            controls.trajectories
+        relative: points are relative to the current positions
+        order: visiting order of the points, by default as given
+        optimize: visit the points in the order minimizing the travel,
+            when the points can be taken in any order
+        overlap: move the motors during the readout of the previous
+            frame, and all of them at once. Otherwise every move waits for
+            the frame and for the other motors.
+        phase_stepping: run the scan as a prepared phase stepping
+            sequence on the detectors that support one
+        shape: of the grid of points, to save the grid index of each
+            frame
+        journal: file logging the progress of the scan. If it exists and
+            the scan did not finish, the scan resumes after the last point
+            whose frames were saved, and the frames of all the runs are
+            presented as one series in ScanJournal.output_file. A resumed
+            scan keeps the targets of the first run, and brings the
+            motors back to where they were before it.
+        reduction: Hdf5Writer observer added to the frame_observers of
+            the detector for the scan, such as
+            controls.phase_retrieval.OnlineRetrieval. It gets the
+            acquisition order of the points with set_order().
+
+    All the targets are checked against the soft limits before anything
+    moves. When order visits every point once, the frames are saved in
+    the canonical order, that of points, on the detectors with a
+    frame_order and in the output file of a journal. Otherwise they are
+    saved in the order they are taken. SCAN_GROUP of the output file
+    gets, for each frame as saved, the index of its point in points
+    ("point"), its index in the canonical order of the frames
+    ("canonical_frame"), its grid index with shape ("index") and the
+    position of every motor. A detector with decimation saves only some
+    of the frames, and "frame" gives their index among the frames taken.
+
+    Returns:
+        the name of the output file, if the detector saves to one
+    """
+    # the timing report covers the spans of this scan only
+    started = controls.timing.clock()
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 1:
+        points = points[:, np.newaxis]
+    initial_positions = np.array(
+        [motor.get_current_value() for motor in motors], dtype=float)
+    logger.debug("initial motor positions %s", initial_positions)
+    targets = points + initial_positions if relative else points
+    if journal is not None:
+        journal = controls.journal.ScanJournal(journal)
+    resume = journal is not None and journal.exists()
+    if resume:
+        journal.load()
+        _check_journal(journal, motors, points, relative, frames_per_point)
+        # the motors did not go back after the failed run
+        targets = np.asarray(journal.header["targets"], dtype=float)
+        initial_positions = np.asarray(
+            journal.header["initial_positions"], dtype=float)
+    low, high = _limits(motors)
+    outside = controls.trajectories.out_of_limits(targets, low, high)
+    if len(outside):
+        raise controls.exceptions.MotorInterrupt(
+            "{0} of {1} scan points out of range, first {2}".format(
+                len(outside), len(targets), targets[outside[0]]))
+    observers = None
+    if reduction is not None:
+        observers = getattr(detector, "frame_observers", None)
+        if observers is None:
+            raise controls.exceptions.ScanInterrupt(
+                "the detector does not pass its frames on to be reduced")
+    if resume:
+        order = np.asarray(journal.header["order"])
+        done = _points_committed(journal, frames_per_point)
+        logger.info("resuming the scan of %s after %d of %d points",
+                    journal.filename, done, len(order))
+    else:
+        if optimize:
+            order = controls.trajectories.optimize_order(
+                targets, start=initial_positions)
+        elif order is None:
+            order = np.arange(len(targets))
+        order = np.asarray(order)
+        done = 0
+        if journal is not None:
+            journal.create(
+                points=points.tolist(),
+                relative=relative,
+                targets=targets.tolist(),
+                initial_positions=initial_positions.tolist(),
+                order=order.tolist(),
+                motors=[motor.name for motor in motors],
+                frames_per_point=frames_per_point,
+                exposure_time=exposure_time)
+    remaining = order[done:]
+    canonical = _canonical_frames(order, frames_per_point)
+    # saved in canonical order by the detector, or by the journal
+    decimation = getattr(detector, "decimation", 1)
+    reordered = (
+        decimation == 1 and
+        _visits_all_once(order, len(targets)) and
+        not np.array_equal(order, np.arange(len(targets))) and
+        (journal is not None or hasattr(detector, "frame_order")))
+    previous_frame_order = getattr(detector, "frame_order", None)
+    if reordered and journal is None:
+        detector.frame_order = canonical
+    if observers is not None:
+        reduction.set_order(remaining)
+        observers.append(reduction)
+    output_file = None
+    try:
+        if len(remaining):
+            output_file = _acquire(
+                detector, motors, targets, remaining, exposure_time,
+                frames_per_point, overlap, phase_stepping, journal)
+        else:
+            logger.info("all the points of %s are done", journal.filename)
+    except Exception:
+        if journal is not None:
+            _commit_partial_series(detector)
+        raise
+    finally:
+        if observers is not None:
+            observers.remove(reduction)
+        if reordered and journal is None:
+            detector.frame_order = previous_frame_order
+        logger.debug("going back to initial motor positions %s", initial_positions)
+        for motor, position in zip(motors, initial_positions):
+            motor.mv(position)
+    if journal is not None:
+        if not journal.finished:
+            journal.finish()
+        controls.hdf5.write_segments(journal.output_file, [
+            (series_file, n_done * frames_per_point)
+            for series_file, n_done in journal.segments],
+            frame_order=canonical if reordered else None)
+        output_file = journal.output_file
+    if output_file is not None:
+        if reordered:
+            canonical = np.arange(len(canonical))
+        datasets = {}
+        if decimation != 1:
+            # the frames taken that were saved
+            saved = np.arange(0, len(canonical), decimation)
+            canonical = canonical[saved]
+            datasets["frame"] = saved
+        point = canonical // frames_per_point
+        datasets["point"] = point
+        datasets["canonical_frame"] = canonical
+        if shape is not None:
+            datasets["index"] = np.stack(
+                np.unravel_index(point, shape), axis=1)
+        for i, motor in enumerate(motors):
+            datasets[motor.name] = targets[point, i]
+        controls.hdf5.write_scan_data(output_file, datasets)
+    if controls.timing.enabled():
+        logger.info("scan timing\n%s",
+                    controls.timing.format_report(since=started))
+    return output_file
+
+
+def dscan(detector, motor, begin, end, intervals, exposure_time=1,
+          frames_per_point=1, journal=None):
+    """Step motor from begin to end, relative to its current position.
+
+    Args:
+        journal: see scan()
+    """
+    return scan(
+        detector, [motor],
+        controls.trajectories.grid(np.linspace(begin, end, intervals + 1)),
+        exposure_time=exposure_time,
+        frames_per_point=frames_per_point,
+        journal=journal)
+
+
+def alignment_dscan(detector, motor, begin, end, intervals, regions=(None,),
+                    metric=controls.roi.SUM, fit=None, exposure_time=1,
+                    frames_per_point=1, decimation=0):
+    """dscan keeping only statistics of regions of interest of the
+    frames, for alignment. The frames go through a
+    controls.roi.RoiStatistics as they arrive, and only one out of
+    decimation is saved. By default none is, and the detector writes no
+    series file.
+
+    Args:
+        regions: list of (x1, y1, x2, y2) regions, None for the whole
+            frame
+        metric: one of controls.roi.METRICS, for the values and the fit
+        fit: controls.roi.FIT_PEAK or controls.roi.FIT_EDGE, to fit the
+            position of the peak or of the edge of metric in each region
+        decimation: see controls.hdf5.Hdf5Writer
+
+    Returns:
+        Alignment: the absolute positions of the motor, the (n_points,
+        n_regions) values of metric, the RoiStatistics with all the
+        metrics, and the fitted position for each region, or None
+    """
+    if metric not in controls.roi.METRICS:
+        raise ValueError("unknown metric {0}".format(metric))
+    if fit is not None and fit not in controls.roi.FITS:
+        raise ValueError("unknown fit {0}".format(fit))
+    positions = motor.get_current_value() + np.linspace(
+        begin, end, intervals + 1)
+    statistics = controls.roi.RoiStatistics(
+        len(positions), regions, frames_per_point)
+    previous_decimation = getattr(detector, "decimation", None)
+    if previous_decimation is not None:
+        detector.decimation = decimation
+    try:
+        scan(
+            detector, [motor], positions[:, np.newaxis],
+            exposure_time=exposure_time,
+            frames_per_point=frames_per_point,
+            relative=False,
+            reduction=statistics)
+    finally:
+        if previous_decimation is not None:
+            detector.decimation = previous_decimation
+    values = statistics.values(metric)
+    fitted = None
+    if fit is not None:
+        fitted = np.array([
+            controls.roi.FITS[fit](positions, column)
+            for column in values.T])
+    return Alignment(positions, values, statistics, fitted)
 
 
 def phase_stepping_scan(
         detector, motor, begin, end, intervals,
         phase_stepping_motor, phase_stepping_begin, phase_stepping_end,
-        phase_steps, exposure_time=1):
+        phase_steps, exposure_time=1, frames_per_point=1,
+        order=TRAVERSAL_RASTER, overlap=True, journal=None, flat=None,
+        reduction_workers=4):
+    """Phase stepping curve at each of intervals + 1 positions of motor.
+
+    Args:
+        order: TRAVERSAL_RASTER walks the phase stepping motor back to its
+            start at every position of motor, TRAVERSAL_SERPENTINE
+            alternates the stepping direction instead
+        overlap, journal: see scan()
+        flat: phase stepping curve without the sample, as a
+            controls.phase_retrieval.FlatReference or the output file of
+            a phase_stepping_scan. With it each curve is reduced to
+            absorption, differential phase and dark-field while scanning,
+            into controls.phase_retrieval.REDUCED_GROUP of the series
+            file.
+        reduction_workers: threads reducing the curves
+    """
+    if order not in (TRAVERSAL_RASTER, TRAVERSAL_SERPENTINE):
+        raise ValueError("unknown traversal order {0}".format(order))
+    shape = (intervals + 1, phase_steps)
+    points = controls.trajectories.grid(
+        np.linspace(begin, end, intervals + 1),
+        np.linspace(
+            phase_stepping_begin,
+            phase_stepping_end,
+            phase_steps,
+            endpoint=False))
+    visiting_order = None
+    if order == TRAVERSAL_SERPENTINE:
+        visiting_order = controls.trajectories.serpentine(shape)
+    reduction = None
+    if flat is not None:
+        if not isinstance(flat, controls.phase_retrieval.FlatReference):
+            flat = controls.phase_retrieval.FlatReference.from_file(
+                flat, phase_steps)
+        reduction = controls.phase_retrieval.OnlineRetrieval(
+            flat, shape, frames_per_point, reduction_workers)
+    return scan(
+        detector, [motor, phase_stepping_motor], points,
+        exposure_time=exposure_time,
+        frames_per_point=frames_per_point,
+        order=visiting_order,
+        overlap=overlap,
+        phase_stepping=True,
+        shape=shape,
+        journal=journal,
+        reduction=reduction)
+
+
+def fly_dscan(detector, motor, begin, end, intervals, exposure_time=1):
+    """Continuous version of dscan: sweep the motor from begin to end,
+    relative to its current position, at constant velocity while the
+    detector takes intervals + 1 frames in a single internally timed
+    series. The frames are centred on the points of the step scan and
+    each is tagged in the output file with the motor position
+    interpolated from the readbacks at its middle.
+
+    The middle of each frame is measured on the detectors that timestamp
+    their frames (the Eiger stream) and saved as SCAN_GROUP/timestamp.
+    For the others it is the nominal time after the trigger, saved as
+    SCAN_GROUP/nominal_timestamp.
+
+    Returns:
+        the position of the motor at the middle of each frame
+    """
+    if getattr(detector, "setNImages", None) is None:
+        raise controls.exceptions.ScanInterrupt(
+            "fly scans need a detector taking series of images")
     initial_motor_position = motor.get_current_value()
-    initial_phase_stepping_position = phase_stepping_motor.get_current_value()
-    logger.debug("initial motor position %s", initial_motor_position)
-    logger.debug("initial phase stepping motor position %s",
-                 initial_phase_stepping_position)
+    initial_velocity = motor.get_velocity()
+    initial_n_images = getattr(detector, "n_images", 1)
+    logger.debug("initial motor position %s, velocity %s",
+                 initial_motor_position, initial_velocity)
+    n_frames = intervals + 1
+    frame_time = exposure_time + getattr(detector, "readout_time", 0)
+    step = (end - begin) / intervals
     try:
-        detector.setNTrigger((intervals + 1) * phase_steps)
+        motor.mv(initial_motor_position + begin - step / 2)
+        settle(motor)
+        motor.set_velocity(abs(step) / frame_time)
+        detector.setNImages(n_frames)
+        detector.setNTrigger(1)
         try:
             # needed for Titlis
             detector.setExposureParameters(exposure_time)
         except AttributeError:
             pass
         detector.arm()
-        motor_positions = np.linspace(begin, end, intervals + 1)
-        phase_stepping_positions = np.linspace(
-            phase_stepping_begin,
-            phase_stepping_end,
-            phase_steps,
-            endpoint=False)
-        logger.debug(motor_positions)
-        logger.debug(phase_stepping_positions)
-        for i, motor_position in enumerate(motor_positions):
-            motor.mv(initial_motor_position + motor_position)
-            logger.debug(motor)
-            for phase_stepping_position in phase_stepping_positions:
-                phase_stepping_motor.mv(
-                    initial_phase_stepping_position + phase_stepping_position)
-                detector.trigger(exposure_time)
-                logger.debug("step %d, exposure_time %s",
-                    i + 1,
-                    exposure_time,
-                    )
-                logger.debug(phase_stepping_motor)
+        with _ReadbackLog(motor) as readbacks:
+            move = motor.mv(
+                initial_motor_position + end + step / 2, wait=False)
+            started = time.time()
+            triggered = trigger_async(detector, exposure_time)
+            triggered.result()
+            move.wait()
         detector.disarm()
-        detector.save()
-        
+        output_file = detector.save()
     finally:
+        # the next scans take one frame per trigger again
+        detector.setNImages(initial_n_images)
+        motor.set_velocity(initial_velocity)
         logger.debug("going back to initial motor position %s", initial_motor_position)
         motor.mv(initial_motor_position)
-        phase_stepping_motor.mv(initial_phase_stepping_position)
+    timestamps = _frame_times(detector, n_frames, exposure_time)
+    if timestamps is not None:
+        timestamp_name = "timestamp"
+    else:
+        logger.warning("no time for each frame, assuming the nominal ones")
+        timestamps = (
+            started + frame_time * np.arange(n_frames) + exposure_time / 2)
+        timestamp_name = "nominal_timestamp"
+    positions = readbacks.interpolate(timestamps)
+    logger.debug(positions)
+    if output_file is not None:
+        controls.hdf5.write_scan_data(output_file, {
+            motor.name: positions,
+            timestamp_name: timestamps,
+        })
+    return positions
+
+
+def _frame_times(detector, n_frames, exposure_time):
+    """Measured middle of each frame of the last series: the time it came
+    off the detector stream, less half of the exposure, as the frames are
+    read out while the next one is exposed.
+
+    Returns:
+        an array of n_frames times, or None if the detector does not tell
+    """
+    arrivals = getattr(detector, "frame_arrivals", None)
+    if arrivals is None or len(arrivals) != n_frames:
+        return None
+    return np.asarray(arrivals, dtype=float) - exposure_time / 2
@@ -0,0 +1,223 @@
+from __future__ import division, print_function
+
+import click
+import contextlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import controls.cbf
+import controls.hamamatsu_flat_panel
+import controls.motors
+import controls.pilatus
+import controls.scans
+import controls.simulators.camserver
+import controls.simulators.eiger
+import controls.simulators.hamamatsu
+import controls.simulators.pv
+import controls.timing
+import controls.transfer
+
+logger = logging.getLogger(__name__)
+
+DETECTORS = ("pilatus", "hamamatsu", "eiger")
+
+
+def synthetic_frame(shape, seed=0):
+    """Pilatus-like frame: low poisson counts, dead pixels at -1, module
+    gaps and a few hot rows that need the wide byte offset escapes."""
+    random = np.random.RandomState(seed)
+    frame = random.poisson(3, shape).astype(np.int32)
+    frame[:, ::487] = -1
+    frame[::195, :] = -1
+    frame[random.randint(0, shape[0], 10)] = random.randint(
+        1000, 2000000, (10, shape[1]))
+    return frame
+
+
+@click.group()
+@click.option("-v", "--verbose", count=True)
+def main(verbose):
+    logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO)
+
+
+@main.command()
+@click.option("--frames", default=32, help="number of cbf files")
+@click.option("--rows", default=2527)
+@click.option("--columns", default=2463)
+@click.option("--workers", default=os.cpu_count() if hasattr(
+    os, "cpu_count") else 4, help="size of the process pool")
+def cbf(frames, rows, columns, workers):
+    "Decode synthetic cbf files, serially and in a process pool"
+    directory = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(frames):
+            path = os.path.join(directory, "frame_{0:05d}.cbf".format(i))
+            controls.cbf.write_cbf(path, synthetic_frame((rows, columns), i))
+            paths.append(path)
+        megabytes = sum(os.path.getsize(path) for path in paths) / 1e6
+        click.echo("{0} frames of {1}x{2}, {3:.1f} MB compressed".format(
+            frames, rows, columns, megabytes))
+
+        stack = np.empty((frames, rows, columns), dtype=np.int32)
+        start = time.time()
+        for path, frame in zip(paths, stack):
+            controls.cbf.read_cbf(path, out=frame)
+        elapsed = time.time() - start
+        click.echo("serial: {0:.1f} frames/s, {1:.1f} MB/s".format(
+            frames / elapsed, megabytes / elapsed))
+
+        executor = ProcessPoolExecutor(workers)
+        # start the workers before timing
+        list(executor.map(controls.cbf.read_header, paths[:workers]))
+        start = time.time()
+        for i, frame in enumerate(executor.map(controls.cbf.read_cbf, paths)):
+            stack[i] = frame
+        elapsed = time.time() - start
+        executor.shutdown()
+        click.echo("{0} workers: {1:.1f} frames/s, {2:.1f} MB/s".format(
+            workers, frames / elapsed, megabytes / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+@contextlib.contextmanager
+def simulated_setup(detector, velocity, settle_time):
+    """Simulated motor records and a detector talking to its simulated
+    server, saving into a temporary directory.
+
+    Yields:
+        the SimulatedIOC and the detector
+    """
+    directory = tempfile.mkdtemp()
+    image_path = os.path.join(directory, "images")
+    os.mkdir(image_path)
+    ioc = controls.simulators.pv.SimulatedIOC(
+        speed=velocity, settle_time=settle_time)
+    try:
+        if detector == "pilatus":
+            with controls.simulators.camserver.SimulatedCamserver(
+                    image_path) as server:
+                pilatus = controls.pilatus.Pilatus(
+                    server.host, server.port,
+                    storage_path=directory,
+                    transport=controls.transfer.LocalDirectoryTransport(
+                        image_path))
+                try:
+                    yield ioc, pilatus
+                finally:
+                    pilatus.close()
+        elif detector == "hamamatsu":
+            with controls.simulators.hamamatsu.SimulatedHamamatsuServer(
+                    image_path) as server:
+                flat_panel = controls.hamamatsu_flat_panel.HamamatsuFlatPanel(
+                    server.host, server.port,
+                    storage_path=directory,
+                    save_mode=controls.hamamatsu_flat_panel.SAVE_HDF5,
+                    local_image_path=image_path)
+                try:
+                    yield ioc, flat_panel
+                finally:
+                    flat_panel.close()
+        else:
+            from controls import eiger
+            with controls.simulators.eiger.SimulatedEiger() as dcu:
+                yield ioc, eiger.Eiger(
+                    dcu.host, dcu.port,
+                    storage_path=directory,
+                    stream=dcu.stream)
+    finally:
+        shutil.rmtree(directory)
+
+
+def scan_options(command):
+    "Options of the simulated setup, shared by the scan benchmarks"
+    options = [
+        click.option("--detector", type=click.Choice(DETECTORS),
+                     default="pilatus"),
+        click.option("--exposure-time", default=0.01),
+        click.option("--frames-per-point", default=1),
+        click.option("--velocity", default=10.0,
+                     help="of the motors in units/s, 0 to move instantly"),
+        click.option("--settle-time", default=0.0,
+                     help="seconds a motor takes to settle after a move"),
+        click.option("--trace", type=click.Path(),
+                     help="write the spans of the scan as a chrome trace"),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def report_scan(n_points, n_frames, trace=None):
+    "Print the timing of the scan just recorded"
+    report = controls.timing.report()
+    click.echo(controls.timing.format_report())
+    click.echo(
+        "{0} points, {1} frames in {2:.3f} s: "
+        "{3:.1f} ms overhead per point, {4:.1f} frames/s".format(
+            n_points, n_frames, report["wall"],
+            1e3 * (report["wall"] - report["exposure"]) / n_points,
+            n_frames / report["wall"]))
+    if trace is not None:
+        controls.timing.export_trace(trace)
+
+
+@main.command()
+@scan_options
+@click.option("--intervals", default=20)
+@click.option("--step", default=0.1, help="between the points")
+def dscan(detector, exposure_time, frames_per_point, velocity, settle_time,
+          trace, intervals, step):
+    "Step scan of a simulated motor"
+    with simulated_setup(detector, velocity, settle_time) as (ioc, camera):
+        motor = controls.motors.Motor(
+            "SIM:TRX", "trx", pv_factory=ioc.pv)
+        controls.timing.enable()
+        try:
+            controls.scans.dscan(
+                camera, motor, 0, step * intervals, intervals,
+                exposure_time=exposure_time,
+                frames_per_point=frames_per_point)
+        finally:
+            controls.timing.disable()
+    n_points = intervals + 1
+    report_scan(n_points, n_points * frames_per_point, trace)
+
+
+@main.command("phase-stepping")
+@scan_options
+@click.option("--intervals", default=4)
+@click.option("--step", default=1.0, help="between the positions")
+@click.option("--phase-steps", default=8)
+@click.option("--period", default=1.0, help="of the phase stepping curve")
+@click.option("--order", type=click.Choice((
+    controls.scans.TRAVERSAL_RASTER, controls.scans.TRAVERSAL_SERPENTINE)),
+    default=controls.scans.TRAVERSAL_RASTER)
+def phase_stepping(detector, exposure_time, frames_per_point, velocity,
+                   settle_time, trace, intervals, step, phase_steps, period,
+                   order):
+    "Phase stepping scan of two simulated motors"
+    with simulated_setup(detector, velocity, settle_time) as (ioc, camera):
+        motor = controls.motors.Motor(
+            "SIM:TRX", "trx", pv_factory=ioc.pv)
+        phase_stepping_motor = controls.motors.Motor(
+            "SIM:G2TRX", "g2trx", pv_factory=ioc.pv)
+        controls.timing.enable()
+        try:
+            controls.scans.phase_stepping_scan(
+                camera, motor, 0, step * intervals, intervals,
+                phase_stepping_motor, 0, period, phase_steps,
+                exposure_time=exposure_time,
+                frames_per_point=frames_per_point,
+                order=order)
+        finally:
+            controls.timing.disable()
+    n_points = (intervals + 1) * phase_steps
+    report_scan(n_points, n_points * frames_per_point, trace)
@@ -55,6 +55,13 @@ def main(verbose, storage_path, threshold):
     smpltry = controls.motors.Motor("X02DA-BNK-HE:SMPL_TRY", "smpltry")
     smplroty = controls.motors.Motor("X02DA-BNK-HE:SMPL_ROTY", "smplroty")
     stptrx = controls.motors.Motor("X02DA-BNK-HE:STP_TRX", "stptrx")
+    # move the axes of a grating stage in parallel with g1.mv({g1trx: 1, ...})
+    g0 = controls.motors.MotorGroup(
+        [g0trx, g0try, g0trz, g0rotx, g0roty, g0rotz], "g0")
+    g1 = controls.motors.MotorGroup(
+        [g1trx, g1try, g1trz, g1rotx, g1roty, g1rotz], "g1")
+    g2 = controls.motors.MotorGroup(
+        [g2trx, g2try, g2trz, g2rotx, g2roty, g2rotz], "g2")
     # detector = controls.eiger.Eiger(
         # "129.129.99.112",
         # storage_path=storage_path,
@@ -0,0 +1,75 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def answer_is_ok(answer):
+    "Default acknowledgement check: the server replied at all"
+    return answer is not None
+
+
+class SettingsCache(object):
+    """Last value of each detector setting acknowledged by the server.
+
+    The socket based detectors resend their settings before every frame;
+    going through the cache turns the repeated ones into no-ops, saving a
+    round trip each. Drop the cache with invalidate() whenever the server
+    state becomes unknown: reconnection, errors, detector restarts.
+    """
+
+    def __init__(self, is_ok=answer_is_ok):
+        """
+        Args:
+            is_ok: function telling from the answer of the server whether
+                the setting was accepted
+        """
+        super(SettingsCache, self).__init__()
+        self.is_ok = is_ok
+        self.values = {}
+
+    def set(self, name, value, send):
+        """Call send(value) unless value is the one last acknowledged for
+        name.
+
+        Returns:
+            the answer of the server, or the cached one if nothing was sent
+        """
+        if not self.changed(name, value):
+            logger.debug("%s already %s", name, value)
+            return self.values[name][1]
+        self.invalidate(name)
+        try:
+            answer = send(value)
+        except Exception:
+            self.invalidate()
+            raise
+        return self.acknowledge(name, value, answer)
+
+    def changed(self, name, value):
+        """Whether value differs from the one last acknowledged for name,
+        for callers that batch the commands of several settings."""
+        return name not in self.values or self.values[name][0] != value
+
+    def acknowledge(self, name, value, answer):
+        "Record the answer of the server to a setting sent by the caller"
+        if self.is_ok(answer):
+            self.values[name] = (value, answer)
+        else:
+            self.invalidate(name)
+        return answer
+
+    def seed(self, name, value, answer=None):
+        "Record a value read back from the server"
+        self.values[name] = (value, answer)
+
+    def get(self, name, default=None):
+        if name in self.values:
+            return self.values[name][0]
+        return default
+
+    def invalidate(self, name=None):
+        "Forget one setting, or all of them"
+        if name is None:
+            self.values.clear()
+        else:
+            self.values.pop(name, None)
@@ -0,0 +1,5 @@
+"""Stand-ins for the hardware of the setup, to run the controls offline.
+
+pv simulates the motor records of controls.motors, camserver, hamamatsu
+and eiger the servers of the detectors.
+"""
@@ -0,0 +1,211 @@
+"""Stand-in for the camserver of a Pilatus detector.
+
+It answers the commands used by controls.pilatus over TCP, and exposes
+by writing cbf files into a local directory, which takes the place of the
+image directory of the detector host:
+
+    with SimulatedCamserver(image_path) as camserver:
+        pilatus = controls.pilatus.Pilatus(
+            camserver.host, camserver.port,
+            transport=controls.transfer.LocalDirectoryTransport(image_path))
+
+The external trigger modes behave as if the triggers came at the frame
+period.
+"""
+
+import collections
+import datetime
+import logging
+import os
+import select
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import controls.cbf
+import controls.pilatus
+import controls.simulators.tcp
+
+logger = logging.getLogger(__name__)
+
+# abort command, sent without a line terminator
+KILL = "k"
+
+
+class _Lines(object):
+    "Commands read from a connection, one per line"
+
+    def __init__(self, connection):
+        super(_Lines, self).__init__()
+        self.connection = connection
+        self.buffer = b""
+        self.pending = collections.deque()
+
+    def next(self, timeout=None):
+        """Next command, or None after timeout seconds without one.
+
+        Raises:
+            EOFError when the client closed the connection
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not self.pending:
+            if self.buffer.strip() == KILL.encode():
+                self.buffer = b""
+                return KILL
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                readable, _, _ = select.select(
+                    [self.connection], [], [], remaining)
+                if not readable:
+                    return None
+            data = self.connection.recv(4096)
+            if not data:
+                raise EOFError
+            lines = (self.buffer + data).split(b"\n")
+            self.buffer = lines.pop()
+            self.pending.extend(
+                line.strip().decode() for line in lines if line.strip())
+        return self.pending.popleft()
+
+    def push_back(self, line):
+        self.pending.appendleft(line)
+
+
+class SimulatedCamserver(controls.simulators.tcp.SimulatedServer):
+    "camserver answering on host:port and writing its frames to image_path"
+
+    def __init__(self, image_path, shape=(195, 487), threshold=10000,
+                 threshold_time=0, host="127.0.0.1", port=0):
+        """
+        Args:
+            shape: of the frames
+            threshold: initial threshold in eV
+            threshold_time: seconds taken by SetThreshold to load the trim
+                files
+        """
+        super(SimulatedCamserver, self).__init__(host, port)
+        self.image_path = image_path
+        self.shape = shape
+        self.threshold = threshold
+        self.threshold_time = threshold_time
+        self.settings = {
+            "exptime": 1.0,
+            "expperiod": 1.0 + controls.pilatus.READOUT_TIME,
+            "nimages": 1,
+        }
+        self.frames_written = 0
+        # every frame is a copy of the same file
+        template = tempfile.NamedTemporaryFile(suffix=".cbf", delete=False)
+        template.close()
+        self.template = template.name
+        random = np.random.RandomState(0)
+        controls.cbf.write_cbf(
+            self.template, random.poisson(3, shape).astype(np.int32))
+
+    def close(self):
+        super(SimulatedCamserver, self).close()
+        if os.path.exists(self.template):
+            os.remove(self.template)
+
+    def handle(self, connection):
+        lines = _Lines(connection)
+        while self.running:
+            try:
+                command = lines.next()
+            except EOFError:
+                return
+            for reply in self.answer(command, lines):
+                logger.debug("camserver: %s -> %s", command, reply)
+                connection.sendall(
+                    (reply + controls.pilatus.CAMSERVER_DELIMITER).encode())
+
+    def answer(self, command, lines):
+        """Generate the replies to command as they are due. An exposure
+        reads the next commands from lines, to catch a kill."""
+        words = command.split()
+        name = words[0].lower()
+        arguments = words[1:]
+        if name == KILL:
+            # nothing to stop
+            return
+        if name in ("imgmode", "prog", "ldflatfield"):
+            yield "15 OK"
+        elif name == "imgpath":
+            yield "10 OK {0}".format(" ".join(arguments))
+        elif name == "setthreshold":
+            if arguments:
+                self.threshold = int(arguments[-1])
+                time.sleep(self.threshold_time)
+                yield "15 OK /tmp/setthreshold.cmd"
+            else:
+                yield ("15 OK  Settings: mid gain; threshold: {0} eV; "
+                       "vcmp: 0.6 V".format(self.threshold))
+        elif name in ("exptime", "expperiod"):
+            if arguments:
+                self.settings[name] = float(arguments[0])
+            yield "15 OK  Exposure {0} set to: {1:.7f} sec.".format(
+                "time" if name == "exptime" else "period",
+                self.settings[name])
+        elif name == "nimages":
+            if arguments:
+                self.settings[name] = int(arguments[0])
+            yield "15 OK  N images set to: {0}".format(self.settings[name])
+        elif name == "version":
+            yield "24 OK Code release:  simulated camserver"
+        elif name == "status":
+            yield "5 OK Camera status: idle"
+        elif name in controls.pilatus.TRIGGER_COMMANDS.values():
+            if not arguments:
+                yield "15 ERR {0} needs a file name".format(name)
+                return
+            yield "15 OK  Starting {0:.7f} second background: {1}".format(
+                self.settings["exptime"],
+                datetime.datetime.now().isoformat())
+            yield self.expose(arguments[0], lines)
+        else:
+            yield "1 ERR unknown command {0}".format(command)
+
+    def expose(self, filename, lines):
+        """Write the frames of a series at the frame period, until the
+        end or a kill command.
+
+        Returns:
+            the final reply
+        """
+        n_images = self.settings["nimages"]
+        period = max(self.settings["expperiod"], self.settings["exptime"])
+        base, extension = os.path.splitext(os.path.basename(filename))
+        start = time.time()
+        for i in range(n_images):
+            if self._killed(lines, start + (i + 1) * period):
+                return "7 ERR kill"
+            if n_images == 1:
+                name = base + extension
+            else:
+                # camserver numbers the frames of a series
+                name = "{0}_{1:05d}{2}".format(base, i, extension)
+            self._write_frame(name)
+        return "7 OK {0}".format(os.path.join(self.image_path, filename))
+
+    def _killed(self, lines, deadline):
+        "Wait until deadline, True if a kill command came in the meantime"
+        command = lines.next(max(0, deadline - time.time()))
+        if command == KILL:
+            return True
+        if command is not None:
+            # camserver reads the next commands after the exposure
+            lines.push_back(command)
+            time.sleep(max(0, deadline - time.time()))
+        return False
+
+    def _write_frame(self, name):
+        # rename, so that the frame is never seen half written
+        temporary = os.path.join(self.image_path, "." + name)
+        shutil.copyfile(self.template, temporary)
+        os.rename(temporary, os.path.join(self.image_path, name))
+        self.frames_written += 1
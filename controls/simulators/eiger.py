@@ -0,0 +1,231 @@
+"""Stand-in for the DCU of an Eiger detector.
+
+An HTTP server answers the SIMPLON API (detector/api/<version>/config,
+command and status) on the loopback interface, and the frames of each
+series go to an in-process stream with the interface of
+dectris.albula.DEigerStream:
+
+    with SimulatedEiger() as dcu:
+        eiger = controls.eiger.Eiger(dcu.host, dcu.port, stream=dcu.stream)
+
+The stream is not served over zmq, as the albula stream client always
+connects to the port of the real DCU. With stream_compression, the frames
+are pushed compressed, as controls.hdf5.CompressedFrame, like the ones
+of controls.eiger.ZmqStream.
+"""
+
+import json
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+import controls.hdf5
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+API_VERSION = "1.6.0"
+_PATH = re.compile(
+    r"^/(?P<api>detector|stream)/api/(?P<version>[^/]+)/"
+    r"(?P<kind>config|command|status)/(?P<name>[\w/]+)$")
+
+
+class SimulatedEigerStream(object):
+    """Messages of the series as dicts: a "dheader", one "data" per frame
+    with the frame as a numpy array, and a "dseries_end"."""
+
+    def __init__(self):
+        super(SimulatedEigerStream, self).__init__()
+        self.messages = queue.Queue()
+        self.is_enabled = False
+
+    def setEnabled(self, enabled):
+        self.is_enabled = enabled
+
+    def enabled(self):
+        return self.is_enabled
+
+    def version(self):
+        return API_VERSION
+
+    def put(self, message):
+        if self.is_enabled:
+            self.messages.put(message)
+
+    def pop(self, timeout=None):
+        return self.messages.get(timeout=timeout)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/detector/api/version":
+            return self._reply({"value": API_VERSION})
+        match = _PATH.match(self.path)
+        if match is None:
+            return self._reply({"error": "not found"}, 404)
+        self._reply(self.server.dcu.get(
+            match.group("api"), match.group("kind"), match.group("name")))
+
+    def do_PUT(self):
+        match = _PATH.match(self.path)
+        if match is None:
+            return self._reply({"error": "not found"}, 404)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        value = json.loads(body.decode()).get("value") if body else None
+        self._reply(self.server.dcu.put(
+            match.group("api"), match.group("kind"), match.group("name"),
+            value))
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SimulatedEiger(object):
+    """DCU answering on host:port. A trigger exposes nimages frames of
+    count_time, or of the trigger value in the inte trigger mode, and
+    pushes them to the stream."""
+
+    def __init__(self, shape=(514, 1030), stream_compression=None,
+                 host="127.0.0.1", port=0):
+        """
+        Args:
+            stream_compression: None, or the controls.hdf5 compression of
+                the frames of the stream
+        """
+        super(SimulatedEiger, self).__init__()
+        self.config = {
+            "count_time": 0.5,
+            "frame_time": 0.5,
+            "nimages": 1,
+            "ntrigger": 1,
+            "trigger_mode": "ints",
+            "photon_energy": 8000.0,
+            "x_pixels_in_detector": shape[1],
+            "y_pixels_in_detector": shape[0],
+            "bit_depth_image": 32,
+        }
+        self.state = "idle"
+        self.sequence_id = 0
+        self.frames_sent = 0
+        self.stream = SimulatedEigerStream()
+        random = np.random.RandomState(0)
+        self.frame = random.poisson(3, shape).astype(np.uint32)
+        if stream_compression is not None:
+            compressor = controls.hdf5.ChunkCompressor(stream_compression)
+            self.frame = controls.hdf5.CompressedFrame(
+                compressor.compress(self.frame), shape, np.uint32,
+                compressor.compression)
+        self.lock = threading.Lock()
+        self.server = _ThreadingHTTPServer((host, port), _Handler)
+        self.server.dcu = self
+        self.host, self.port = self.server.server_address[:2]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="simulated-eiger")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def get(self, api, kind, name):
+        if api == "stream":
+            return {"value": "enabled" if self.stream.enabled()
+                    else "disabled"}
+        if kind == "status":
+            return {"value": self.state if name == "state" else None}
+        return {"value": self.config.get(name), "access_mode": "rw"}
+
+    def put(self, api, kind, name, value):
+        if api == "stream":
+            self.stream.setEnabled(value == "enabled")
+            return [name]
+        if kind == "config":
+            self.config[name] = value
+            return [name]
+        if kind == "command":
+            return getattr(self, "_" + name, self._unknown)(value)
+        return {}
+
+    def _unknown(self, value):
+        return {}
+
+    def _initialize(self, value):
+        self.state = "idle"
+        return {}
+
+    def _arm(self, value):
+        with self.lock:
+            self.sequence_id += 1
+            self.state = "ready"
+            self.stream.put({"type": "dheader", "series": self.sequence_id})
+        return {"sequence id": self.sequence_id}
+
+    def _trigger(self, value):
+        # triggers are exposed one at a time, like on the DCU
+        with self.lock:
+            if self.config["trigger_mode"] == "inte" and value:
+                period = value
+            else:
+                period = max(
+                    self.config["count_time"], self.config["frame_time"])
+            self.state = "acquire"
+            for _ in range(int(self.config["nimages"])):
+                time.sleep(period)
+                self.frames_sent += 1
+                self.stream.put({
+                    "type": "data",
+                    "series": self.sequence_id,
+                    "frame": self.frames_sent,
+                    "data": self.frame,
+                })
+            self.state = "ready"
+        return {}
+
+    def _disarm(self, value):
+        with self.lock:
+            if self.state != "idle":
+                self.stream.put(
+                    {"type": "dseries_end", "series": self.sequence_id})
+            self.state = "idle"
+        return {"sequence id": self.sequence_id}
+
+    _abort = _cancel = _disarm
@@ -0,0 +1,101 @@
+"""Stand-in for the camera server of the Hamamatsu flat panel.
+
+It answers the NN_params commands of controls.hamamatsu_flat_panel over
+TCP and snaps by writing tiff files of the ROI into a local directory,
+which takes the place of the image share:
+
+    with SimulatedHamamatsuServer(image_path) as server:
+        detector = controls.hamamatsu_flat_panel.HamamatsuFlatPanel(
+            server.host, server.port, local_image_path=image_path,
+            save_mode=controls.hamamatsu_flat_panel.SAVE_HDF5)
+"""
+
+import logging
+import os
+import time
+
+import numpy as np
+
+import controls.tiff
+import controls.simulators.tcp
+
+logger = logging.getLogger(__name__)
+
+# command codes, see controls.hamamatsu_flat_panel
+EXPTIME = "11"
+# snap and step take the name of the image file
+SNAP = "12"
+STEP = "27"
+GETEXPTIME = "17"
+SETROI = "19"
+PREPS = "25"
+POSTPS = "26"
+STATUS = "24"
+
+
+class SimulatedHamamatsuServer(
+        controls.simulators.tcp.SimulatedServer):
+    "Hamamatsu server answering on host:port, saving to image_path"
+
+    def __init__(self, image_path, reply_delimiter=None, host="127.0.0.1",
+                 port=0):
+        """
+        Args:
+            reply_delimiter: appended to every answer, None to send them
+                as they are, like the real server as far as we know
+        """
+        super(SimulatedHamamatsuServer, self).__init__(host, port)
+        self.image_path = image_path
+        self.reply_delimiter = reply_delimiter or ""
+        self.exposure_time = 1.0
+        self.phase_stepping = False
+        self.frames_written = 0
+        self.image = None
+        self.set_roi(0, 0, 1024, 1024)
+
+    def set_roi(self, x1, y1, x2, y2):
+        random = np.random.RandomState(0)
+        self.image = random.poisson(
+            1000, (y2 - y1, x2 - x1)).astype(np.uint16)
+
+    def handle(self, connection):
+        while self.running:
+            # the commands are not terminated, each recv is one
+            data = connection.recv(256)
+            if not data:
+                return
+            command = data.decode()
+            reply = self.answer(command)
+            logger.debug("hamamatsu: %s -> %s", command, reply)
+            connection.sendall((reply + self.reply_delimiter).encode())
+
+    def answer(self, command):
+        code, _, parameters = command.partition("_")
+        if code == EXPTIME:
+            self.exposure_time = float(parameters)
+        elif code == GETEXPTIME:
+            return str(self.exposure_time)
+        elif code == SETROI:
+            self.set_roi(*[int(x) for x in parameters.split(",")])
+        elif code == PREPS:
+            self.exposure_time = float(parameters)
+            self.phase_stepping = True
+        elif code == POSTPS:
+            self.phase_stepping = False
+        elif code == STEP and not self.phase_stepping:
+            return "ERR step outside of a phase stepping sequence"
+        elif code in (SNAP, STEP):
+            self.snap(parameters)
+        elif code == STATUS:
+            return "idle"
+        return "OK"
+
+    def snap(self, filename):
+        time.sleep(self.exposure_time)
+        # the file name is a windows path on the server
+        name = filename.replace("\\", "/").rsplit("/", 1)[-1]
+        # rename, so that the image is never seen half written
+        temporary = os.path.join(self.image_path, "." + name)
+        controls.tiff.write_tiff(temporary, self.image)
+        os.rename(temporary, os.path.join(self.image_path, name))
+        self.frames_written += 1
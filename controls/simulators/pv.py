@@ -0,0 +1,188 @@
+"""Stand-in for pyepics process variables and motor records.
+
+SimulatedIOC.pv has the signature of epics.PV, so it can be passed as the
+pv_factory of controls.motors.Motor:
+
+    ioc = SimulatedIOC()
+    motor = controls.motors.Motor("X02DA-BNK-HE:G1_TRX", "g1trx",
+                                  pv_factory=ioc.pv)
+
+The PVs count the reads that bypass the monitors in forced_gets, to
+check that the hot paths only use the cached values.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedPV(object):
+    "Process variable that calls its monitor callbacks on every change"
+
+    def __init__(self, pvname, value=0.0, upper_ctrl_limit=None,
+                 lower_ctrl_limit=None):
+        super(SimulatedPV, self).__init__()
+        self.pvname = pvname
+        self.value = value
+        self.upper_ctrl_limit = upper_ctrl_limit
+        self.lower_ctrl_limit = lower_ctrl_limit
+        self.connected = True
+        self.put_complete = True
+        self.callbacks = {}
+        self.forced_gets = 0
+        self.lock = threading.Lock()
+
+    def add_callback(self, callback, **kwargs):
+        index = len(self.callbacks) + 1
+        self.callbacks[index] = callback
+        return index
+
+    def remove_callback(self, index):
+        self.callbacks.pop(index, None)
+
+    def get(self, use_monitor=True, **kwargs):
+        if not use_monitor:
+            self.forced_gets += 1
+        return self.value
+
+    def put(self, value, wait=False, timeout=30.0, use_complete=False,
+            callback=None, **kwargs):
+        self.update(value)
+        if callback is not None:
+            callback(pvname=self.pvname)
+
+    def update(self, value):
+        "Change the value on the server side, as the IOC would"
+        with self.lock:
+            self.value = value
+            callbacks = list(self.callbacks.values())
+        for callback in callbacks:
+            callback(pvname=self.pvname, value=value)
+
+
+class _SetpointPV(SimulatedPV):
+    "VAL field of a motor record: a put starts a move"
+
+    def __init__(self, pvname, record):
+        super(_SetpointPV, self).__init__(pvname, record.position)
+        self.record = record
+
+    @property
+    def upper_ctrl_limit(self):
+        return self.record.pvs["HLM"].value
+
+    @upper_ctrl_limit.setter
+    def upper_ctrl_limit(self, value):
+        pass
+
+    @property
+    def lower_ctrl_limit(self):
+        return self.record.pvs["LLM"].value
+
+    @lower_ctrl_limit.setter
+    def lower_ctrl_limit(self, value):
+        pass
+
+    def put(self, value, wait=False, timeout=30.0, use_complete=False,
+            callback=None, **kwargs):
+        self.put_complete = False
+        self.update(value)
+        thread = self.record.move(value, self._completed(callback))
+        if wait:
+            thread.join(timeout)
+
+    def _completed(self, callback):
+        def completed():
+            self.put_complete = True
+            if callback is not None:
+                callback(pvname=self.pvname)
+        return completed
+
+
+class SimulatedMotorRecord(object):
+    """The VAL, RBV, DMOV, HLM, LLM and VELO fields of a motor record,
+    moving at VELO units per second, or instantly if VELO is 0. DMOV
+    stays 0 for settle_time seconds after the readback reached the
+    target, like the DLY field of a real record."""
+
+    FIELDS = ("VAL", "RBV", "DMOV", "HLM", "LLM", "VELO")
+
+    def __init__(self, name, position=0.0, high_limit=100.0,
+                 low_limit=-100.0, speed=None, settle_time=0,
+                 update_interval=0.01):
+        super(SimulatedMotorRecord, self).__init__()
+        self.name = name
+        self.position = position
+        self.settle_time = settle_time
+        self.update_interval = update_interval
+        self.pvs = {}
+        self.pvs["HLM"] = SimulatedPV(name + ".HLM", high_limit)
+        self.pvs["LLM"] = SimulatedPV(name + ".LLM", low_limit)
+        self.pvs["RBV"] = SimulatedPV(name + ".RBV", position)
+        self.pvs["DMOV"] = SimulatedPV(name + ".DMOV", 1)
+        self.pvs["VELO"] = SimulatedPV(name + ".VELO", speed or 0)
+        self.pvs["VAL"] = _SetpointPV(name + ".VAL", self)
+        self.moves = 0
+
+    def move(self, target, completed):
+        "Move to target in a thread, then call completed()"
+        self.moves += 1
+        self.pvs["DMOV"].update(0)
+        thread = threading.Thread(
+            target=self._run, args=(target, completed),
+            name="{0}-move".format(self.name))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self, target, completed):
+        speed = self.pvs["VELO"].value
+        if speed:
+            start = self.position
+            duration = abs(target - start) / speed
+            began = time.time()
+            elapsed = 0
+            while elapsed < duration:
+                time.sleep(self.update_interval)
+                elapsed = min(time.time() - began, duration)
+                self.position = start + (target - start) * elapsed / duration
+                self.pvs["RBV"].update(self.position)
+        self.position = target
+        self.pvs["RBV"].update(target)
+        if self.settle_time:
+            time.sleep(self.settle_time)
+        self.pvs["DMOV"].update(1)
+        completed()
+
+
+class SimulatedIOC(object):
+    "Motor records created on the first access to one of their fields"
+
+    def __init__(self, **record_options):
+        """
+        Args:
+            record_options: keyword arguments of every SimulatedMotorRecord
+        """
+        super(SimulatedIOC, self).__init__()
+        self.record_options = record_options
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def record(self, name):
+        with self.lock:
+            if name not in self.records:
+                self.records[name] = SimulatedMotorRecord(
+                    name, **self.record_options)
+            return self.records[name]
+
+    def pv(self, pvname, callback=None, **kwargs):
+        "Same signature as epics.PV"
+        name, _, field = pvname.rpartition(".")
+        if field not in SimulatedMotorRecord.FIELDS:
+            raise ValueError("unknown motor record field {0}".format(pvname))
+        pv = self.record(name).pvs[field]
+        if callback is not None:
+            pv.add_callback(callback)
+        return pv
@@ -0,0 +1,92 @@
+"""Threaded TCP server on the loopback interface, the base of the
+simulated detector servers."""
+
+import logging
+import select
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SimulatedServer(object):
+    """Accept connections in a thread and serve each one in its own thread
+    with handle(connection), which the simulated servers override.
+
+    The port is picked by the system unless given. Use as a context
+    manager, or call start() and close().
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super(SimulatedServer, self).__init__()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.host, self.port = self.server.getsockname()
+        self.connections = []
+        self.running = False
+        self.acceptor = threading.Thread(
+            target=self._accept,
+            name="{0}-accept".format(type(self).__name__))
+        self.acceptor.daemon = True
+
+    def start(self):
+        self.running = True
+        self.server.listen(5)
+        self.acceptor.start()
+        return self
+
+    def close(self):
+        self.running = False
+        self.server.close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            connection.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def handle(self, connection):
+        """Serve a connection until the client is done with it. The
+        connection is closed on return, so this default refuses every
+        client."""
+        logger.warning("%s: no handler, closing the connection",
+                       type(self).__name__)
+
+    def _accept(self):
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.server], [], [], 0.1)
+                if not readable:
+                    continue
+                connection, address = self.server.accept()
+            except (socket.error, ValueError):
+                # closed
+                return
+            logger.debug("%s: connection from %s",
+                         type(self).__name__, address)
+            self.connections.append(connection)
+            thread = threading.Thread(
+                target=self._serve, args=(connection,),
+                name="{0}-serve".format(type(self).__name__))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        try:
+            self.handle(connection)
+        except socket.error:
+            pass
+        except Exception:
+            logger.exception("%s failed", type(self).__name__)
+        finally:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            connection.close()
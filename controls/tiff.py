@@ -0,0 +1,147 @@
+"""Read and write the uncompressed single image tiff files of the
+Hamamatsu flat panel server.
+
+The pixels are memory mapped when they are stored contiguously, so that
+they are read only once, straight into the hdf5 buffers. Compressed
+files need the optional tifffile package.
+"""
+
+import struct
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+SAMPLE_FORMAT = 339
+
+# tiff field type: (struct format, size)
+FIELD_TYPES = {
+    1: ("B", 1),
+    3: ("H", 2),
+    4: ("I", 4),
+    16: ("Q", 8),
+}
+
+# SampleFormat tag: numpy kind
+SAMPLE_KINDS = {1: "u", 2: "i", 3: "f"}
+# tiff field type of LONG
+LONG = 4
+
+
+class TiffError(ValueError):
+    "Malformed or unsupported tiff file"
+
+
+def read_tags(path):
+    """Tags of the first image of a tiff file.
+
+    Returns:
+        byte order ("<" or ">") and a dict of tag: tuple of values
+    """
+    with open(path, "rb") as input_file:
+        header = input_file.read(8)
+        if header[:2] == b"II":
+            order = "<"
+        elif header[:2] == b"MM":
+            order = ">"
+        else:
+            raise TiffError("{0} is not a tiff file".format(path))
+        magic, offset = struct.unpack(order + "HI", header[2:8])
+        if magic != 42:
+            raise TiffError("{0}: unsupported tiff version {1}".format(
+                path, magic))
+        input_file.seek(offset)
+        n_entries, = struct.unpack(order + "H", input_file.read(2))
+        entries = input_file.read(12 * n_entries)
+        tags = {}
+        for i in range(n_entries):
+            tag, field_type, count, value = struct.unpack(
+                order + "HHI4s", entries[12 * i:12 * (i + 1)])
+            if field_type not in FIELD_TYPES:
+                continue
+            code, size = FIELD_TYPES[field_type]
+            if count * size > 4:
+                position = input_file.tell()
+                input_file.seek(struct.unpack(order + "I", value)[0])
+                value = input_file.read(count * size)
+                input_file.seek(position)
+            tags[tag] = struct.unpack(
+                order + code * count, value[:count * size])
+    return order, tags
+
+
+def read_tiff(path):
+    """Return the image of a tiff file, memory mapped if it is stored
+    uncompressed in contiguous strips."""
+    order, tags = read_tags(path)
+    try:
+        shape = (tags[IMAGE_LENGTH][0], tags[IMAGE_WIDTH][0])
+        offsets = tags[STRIP_OFFSETS]
+        byte_counts = tags[STRIP_BYTE_COUNTS]
+    except KeyError as e:
+        raise TiffError("{0}: missing tag {1}".format(path, e))
+    compression = tags.get(COMPRESSION, (1,))[0]
+    samples = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+    if compression != 1 or samples != 1:
+        if tifffile is None:
+            raise TiffError(
+                "{0}: compressed or multi sample tiff needs tifffile".format(
+                    path))
+        return tifffile.imread(path)
+    dtype = np.dtype("{0}{1}{2}".format(
+        order,
+        SAMPLE_KINDS[tags.get(SAMPLE_FORMAT, (1,))[0]],
+        tags.get(BITS_PER_SAMPLE, (16,))[0] // 8))
+    contiguous = all(
+        offset + count == next_offset
+        for offset, count, next_offset in zip(
+            offsets, byte_counts, offsets[1:]))
+    if contiguous:
+        return np.memmap(
+            path, dtype=dtype, mode="r", offset=offsets[0], shape=shape)
+    image = np.empty(shape, dtype=dtype)
+    flat = image.reshape(-1).view(np.uint8)
+    position = 0
+    with open(path, "rb") as input_file:
+        for offset, count in zip(offsets, byte_counts):
+            input_file.seek(offset)
+            flat[position:position + count] = np.frombuffer(
+                input_file.read(count), dtype=np.uint8)
+            position += count
+    return image
+
+
+def write_tiff(path, data):
+    """Write a 2D array as an uncompressed little endian tiff file with a
+    single strip, like the files of the Hamamatsu server."""
+    data = np.asarray(data)
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder("<"))
+    kinds = dict((kind, code) for code, kind in SAMPLE_KINDS.items())
+    tags = [
+        (IMAGE_WIDTH, data.shape[1]),
+        (IMAGE_LENGTH, data.shape[0]),
+        (BITS_PER_SAMPLE, 8 * data.dtype.itemsize),
+        (COMPRESSION, 1),
+        (STRIP_OFFSETS, 8),
+        (SAMPLES_PER_PIXEL, 1),
+        (STRIP_BYTE_COUNTS, data.nbytes),
+        (SAMPLE_FORMAT, kinds[data.dtype.kind]),
+    ]
+    with open(path, "wb") as output_file:
+        # the pixels right after the header, the directory after them
+        output_file.write(struct.pack("<2sHI", b"II", 42, 8 + data.nbytes))
+        output_file.write(data.tobytes())
+        output_file.write(struct.pack("<H", len(tags)))
+        for tag, value in tags:
+            output_file.write(struct.pack("<HHII", tag, LONG, 1, value))
+        output_file.write(struct.pack("<I", 0))
@@ -0,0 +1,258 @@
+"""Where the time of a scan goes.
+
+Code on the hot paths wraps its phases in spans:
+
+    with controls.timing.span("motor.move"):
+        ...
+
+While recording is disabled, the default, span() returns a shared no-op
+context manager. Once enable() is called, every span is stored with its
+monotonic start time, duration and thread in a preallocated ring buffer
+keeping the most recent ones. report() sums them up per phase, and
+export_trace() writes them in the Chrome trace event format, viewable in
+chrome://tracing or Perfetto.
+"""
+
+from __future__ import division
+
+import itertools
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+clock = getattr(time, "monotonic", time.time)
+
+# phase of the nominal exposure of the frames, for the duty cycle
+EXPOSURE = "exposure"
+# phase spanning a whole scan, the wall time of the duty cycle
+SCAN = "scan"
+
+SPAN_DTYPE = np.dtype([
+    ("phase", np.int32),
+    ("start", np.float64),
+    ("duration", np.float64),
+    ("thread", np.int64),
+])
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    __slots__ = ("recorder", "phase", "start")
+
+    def __init__(self, recorder, phase):
+        self.recorder = recorder
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.recorder.record(self.phase, self.start, clock())
+        return False
+
+
+class Recorder(object):
+    "Ring buffer of the spans of the last capacity phases"
+
+    def __init__(self, capacity=1 << 16):
+        super(Recorder, self).__init__()
+        self.capacity = capacity
+        self.spans = np.zeros(capacity, dtype=SPAN_DTYPE)
+        self.phases = {}
+        self.names = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.recorded = 0
+
+    def code(self, phase):
+        try:
+            return self.phases[phase]
+        except KeyError:
+            with self.lock:
+                if phase not in self.phases:
+                    self.phases[phase] = len(self.names)
+                    self.names.append(phase)
+                return self.phases[phase]
+
+    def record(self, phase, start, end):
+        # next() on itertools.count is atomic, so threads get distinct slots
+        n = next(self.counter)
+        self.spans[n % self.capacity] = (
+            self.code(phase), start, end - start,
+            threading.current_thread().ident or 0)
+        self.recorded = max(self.recorded, n + 1)
+
+    def reset(self):
+        self.counter = itertools.count()
+        self.recorded = 0
+
+    def recent(self, since=None):
+        """The spans still in the buffer, oldest first, only the ones
+        started at clock() since or later if given"""
+        if self.recorded <= self.capacity:
+            spans = self.spans[:self.recorded]
+        else:
+            split = self.recorded % self.capacity
+            spans = np.concatenate(
+                (self.spans[split:], self.spans[:split]))
+        if since is not None:
+            spans = spans[spans["start"] >= since]
+        return spans[np.argsort(spans["start"], kind="mergesort")]
+
+    @property
+    def dropped(self):
+        return max(0, self.recorded - self.capacity)
+
+    def report(self, since=None):
+        """Totals and percentiles of the duration of each phase, and the
+        duty cycle: nominal exposure time over the wall time of the scan
+        spans, or of all the spans if there is none. With since, only the
+        spans started at clock() since or later count, such as those of
+        the last scan.
+
+        Returns:
+            dict with "phases": {phase: {count, total, mean, p50, p90, p99,
+            max}}, "wall", "exposure", "duty_cycle" and "dropped"
+        """
+        spans = self.recent(since)
+        phases = {}
+        for code, name in enumerate(self.names):
+            durations = spans["duration"][spans["phase"] == code]
+            if not len(durations):
+                continue
+            p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+            phases[name] = dict(
+                count=len(durations),
+                total=float(durations.sum()),
+                mean=float(durations.mean()),
+                p50=float(p50),
+                p90=float(p90),
+                p99=float(p99),
+                max=float(durations.max()),
+            )
+        if SCAN in phases:
+            wall = phases[SCAN]["total"]
+        elif len(spans):
+            wall = float(
+                (spans["start"] + spans["duration"]).max() -
+                spans["start"].min())
+        else:
+            wall = 0.0
+        exposure = phases.get(EXPOSURE, {}).get("total", 0.0)
+        return dict(
+            phases=phases,
+            wall=wall,
+            exposure=exposure,
+            duty_cycle=exposure / wall if wall else 0.0,
+            dropped=self.dropped,
+        )
+
+    def format_report(self, since=None):
+        "report() as a table"
+        report = self.report(since)
+        lines = ["{0:<24} {1:>7} {2:>10} {3:>6} {4:>9} {5:>9} {6:>9}".format(
+            "phase", "count", "total s", "%", "p50 ms", "p90 ms", "p99 ms")]
+        wall = report["wall"] or 1
+        for name, phase in sorted(
+                report["phases"].items(), key=lambda item: -item[1]["total"]):
+            lines.append(
+                "{0:<24} {1:>7d} {2:>10.3f} {3:>6.1f} "
+                "{4:>9.2f} {5:>9.2f} {6:>9.2f}".format(
+                    name, phase["count"], phase["total"],
+                    100 * phase["total"] / wall,
+                    1e3 * phase["p50"], 1e3 * phase["p90"],
+                    1e3 * phase["p99"]))
+        lines.append(
+            "wall {0:.3f} s, exposure {1:.3f} s, duty cycle {2:.1%}".format(
+                report["wall"], report["exposure"], report["duty_cycle"]))
+        if report["dropped"]:
+            lines.append("{0} older spans dropped".format(report["dropped"]))
+        return "\n".join(lines)
+
+    def export_trace(self, filename):
+        "Write the spans as Chrome trace events (json)"
+        spans = self.recent()
+        pid = os.getpid()
+        events = [
+            dict(
+                name=self.names[span["phase"]],
+                cat=self.names[span["phase"]].split(".")[0],
+                ph="X",
+                ts=1e6 * float(span["start"]),
+                dur=1e6 * float(span["duration"]),
+                pid=pid,
+                tid=int(span["thread"]),
+            )
+            for span in spans]
+        with open(filename, "w") as trace_file:
+            json.dump({"traceEvents": events}, trace_file)
+
+
+# recorder being filled, None when disabled
+_recorder = None
+# last recorder, kept for report() after disable()
+_last_recorder = None
+
+
+def enable(capacity=1 << 16):
+    "Start recording the spans into a new ring buffer"
+    global _recorder, _last_recorder
+    _recorder = _last_recorder = Recorder(capacity)
+    return _recorder
+
+
+def disable():
+    "Stop recording, keeping the spans for report()"
+    global _recorder
+    _recorder = None
+    return _last_recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def recorder():
+    "The recorder being filled, or the last one after disable()"
+    return _last_recorder
+
+
+def span(phase):
+    "Context manager timing phase"
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, phase)
+
+
+def record(phase, start, end):
+    "Record a span measured by the caller with clock()"
+    if _recorder is not None:
+        _recorder.record(phase, start, end)
+
+
+def report(since=None):
+    return recorder().report(since)
+
+
+def format_report(since=None):
+    return recorder().format_report(since)
+
+
+def export_trace(filename):
+    recorder().export_trace(filename)
@@ -0,0 +1,164 @@
+"""Scan trajectories as numpy arrays of shape (n_points, n_axes), and the
+orders to visit them in.
+
+The generators return the points in their canonical order. Visiting
+orders are index arrays into the points: serpentine() for grids, or
+optimize_order() to shorten the travel between arbitrary points.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+# golden angle in radians, spacing the points of spiral() evenly
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+def grid(*axes):
+    """Every combination of the positions of each axis, the last axis
+    varying fastest.
+
+    Args:
+        axes: one 1D array of positions per axis
+    """
+    axes = [np.asarray(axis, dtype=float) for axis in axes]
+    mesh = np.meshgrid(*axes, indexing="ij")
+    return np.stack([m.ravel() for m in mesh], axis=1)
+
+
+def points(positions):
+    "Explicit list of points, as a (n_points, n_axes) array"
+    positions = np.asarray(positions, dtype=float)
+    if positions.ndim == 1:
+        positions = positions[:, np.newaxis]
+    if positions.ndim != 2:
+        raise ValueError("points must be a list of positions per axis")
+    return positions
+
+
+def spiral(n_points, step, center=(0, 0)):
+    """Fermat spiral of two axes, with about one point per step ** 2 of
+    area, growing from center."""
+    k = np.arange(n_points)
+    radius = step * np.sqrt(k)
+    angle = k * GOLDEN_ANGLE
+    return np.stack(
+        [center[0] + radius * np.cos(angle),
+         center[1] + radius * np.sin(angle)], axis=1)
+
+
+def random(n_points, low, high, seed=None):
+    "Uniformly distributed points between the low and high corners"
+    low = np.atleast_1d(np.asarray(low, dtype=float))
+    high = np.atleast_1d(np.asarray(high, dtype=float))
+    generator = np.random.RandomState(seed)
+    return low + (high - low) * generator.random_sample(
+        (n_points, len(low)))
+
+
+def serpentine(shape):
+    """Order of the points of a grid of shape in which the direction of
+    the fastest axis alternates."""
+    index = np.arange(int(np.prod(shape))).reshape(shape)
+    for outer in np.ndindex(*shape[:-1]):
+        if sum(outer) % 2:
+            index[outer] = index[outer][::-1]
+    return index.ravel()
+
+
+def out_of_limits(positions, low, high):
+    """Indices of the points with any axis outside of [low, high], checked
+    in one pass.
+
+    Args:
+        low, high: limits of each axis
+    """
+    positions = np.asarray(positions, dtype=float)
+    outside = (positions < np.asarray(low)) | (positions > np.asarray(high))
+    return np.flatnonzero(outside.any(axis=1))
+
+
+def travel_times(positions, start=None, weights=None):
+    """Time between consecutive points when all the axes move at once:
+    the longest of the distances of each axis, times its weight, typically
+    the inverse of its velocity."""
+    positions = np.asarray(positions, dtype=float)
+    if start is not None:
+        positions = np.vstack([start, positions])
+    if weights is None:
+        weights = np.ones(positions.shape[1])
+    return np.max(np.abs(np.diff(positions, axis=0)) * weights, axis=1)
+
+
+def _distances(positions, point, weights):
+    return np.max(np.abs(positions - point) * weights, axis=1)
+
+
+def nearest_neighbour(positions, start=None, weights=None):
+    """Order visiting the closest point not visited yet, from start or
+    from the first point."""
+    positions = np.asarray(positions, dtype=float)
+    n_points = len(positions)
+    if weights is None:
+        weights = np.ones(positions.shape[1])
+    visited = np.zeros(n_points, dtype=bool)
+    order = np.empty(n_points, dtype=int)
+    if start is None:
+        current = positions[0]
+    else:
+        current = np.asarray(start, dtype=float)
+    for k in range(n_points):
+        distances = _distances(positions, current, weights)
+        distances[visited] = np.inf
+        nearest = int(np.argmin(distances))
+        order[k] = nearest
+        visited[nearest] = True
+        current = positions[nearest]
+    return order
+
+
+def two_opt(positions, order, start=None, weights=None, max_passes=10):
+    """Improve an open path by reversing the segments that shorten it,
+    until no reversal helps or after max_passes passes."""
+    positions = np.asarray(positions, dtype=float)
+    if weights is None:
+        weights = np.ones(positions.shape[1])
+    order = np.array(order)
+    # with a fixed start the first point of the path can change too
+    anchored = start is not None
+    for _ in range(max_passes):
+        improved = False
+        if anchored:
+            path = np.vstack([start, positions[order]])
+        else:
+            path = positions[order]
+        n = len(path)
+        for i in range(n - 2):
+            a = path[i]
+            b = path[i + 1]
+            # reverse path[i + 1:j + 1], for every j at once
+            c = path[i + 2:]
+            ab = _distances(b[np.newaxis], a, weights)[0]
+            ac = _distances(c, a, weights)
+            # the edge after c, missing for the last point
+            d = path[i + 3:]
+            cd = np.append(np.max(np.abs(c[:-1] - d) * weights, axis=1), 0)
+            bd = np.append(_distances(d, b, weights), 0)
+            gain = ab + cd - ac - bd
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-12:
+                j += i + 2
+                path[i + 1:j + 1] = path[i + 1:j + 1][::-1].copy()
+                offset = 1 if anchored else 0
+                order[i + 1 - offset:j + 1 - offset] = (
+                    order[i + 1 - offset:j + 1 - offset][::-1].copy())
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def optimize_order(positions, start=None, weights=None):
+    "Short visiting order: nearest neighbour, refined by 2-opt"
+    order = nearest_neighbour(positions, start, weights)
+    return two_opt(positions, order, start, weights)
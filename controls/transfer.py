@@ -0,0 +1,264 @@
+"""Collect the images written by a detector server into an hdf5 file.
+
+A transport lists, fetches and removes files in one remote directory.
+SshTransport keeps a single multiplexed ssh connection open for all the
+transfers, LocalDirectoryTransport reads a directory of the local
+filesystem, either a network share of the detector server or a stand-in
+for the detector host. FileCollector moves the files through a transport
+into an Hdf5Writer while they are being acquired.
+"""
+
+import glob
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import controls.exceptions
+import controls.timing
+
+logger = logging.getLogger(__name__)
+
+
+class LocalDirectoryTransport(object):
+    "Files in a directory of the local filesystem"
+
+    def __init__(self, path):
+        super(LocalDirectoryTransport, self).__init__()
+        self.path = path
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def list(self, pattern):
+        "Sorted names of the files matching pattern"
+        return sorted(
+            os.path.basename(name)
+            for name in glob.glob(os.path.join(self.path, pattern)))
+
+    def fetch(self, names, destination):
+        """Local paths of the files, which are read in place, so
+        destination is not used."""
+        return [os.path.join(self.path, name) for name in names]
+
+    def remove(self, names):
+        for name in names:
+            os.remove(os.path.join(self.path, name))
+
+
+class SshTransport(object):
+    """Files in a directory of a remote host, reached through an ssh
+    master connection that is opened once and shared by every command."""
+
+    def __init__(self, host, path, user="det"):
+        super(SshTransport, self).__init__()
+        self.host = host
+        self.path = path
+        self.user = user
+        self.control_directory = None
+
+    @property
+    def target(self):
+        return "{0}@{1}".format(self.user, self.host)
+
+    def options(self):
+        return [
+            "-o", "ControlPath={0}".format(
+                os.path.join(self.control_directory, "master")),
+            "-o", "BatchMode=yes",
+        ]
+
+    def open(self):
+        if self.control_directory is not None:
+            return
+        self.control_directory = tempfile.mkdtemp()
+        command = ["ssh", "-f", "-N",
+                   "-o", "ControlMaster=yes",
+                   "-o", "ControlPersist=yes"] + self.options() + [self.target]
+        logger.debug(command)
+        subprocess.check_call(command)
+
+    def close(self):
+        if self.control_directory is None:
+            return
+        command = ["ssh", "-O", "exit"] + self.options() + [self.target]
+        logger.debug(command)
+        subprocess.call(command)
+        shutil.rmtree(self.control_directory)
+        self.control_directory = None
+
+    def ssh(self, remote_command):
+        self.open()
+        command = ["ssh"] + self.options() + [self.target, remote_command]
+        logger.debug(command)
+        return subprocess.check_output(command)
+
+    def list(self, pattern):
+        "Sorted names of the files matching pattern"
+        output = self.ssh("cd {0} && ls -1 {1} 2>/dev/null; true".format(
+            self.path, pattern))
+        return sorted(output.decode().split())
+
+    def fetch(self, names, destination):
+        "Copy the files to the destination directory with a single scp"
+        if not names:
+            return []
+        self.open()
+        sources = ["{0}:{1}/{2}".format(self.target, self.path, name)
+                   for name in names]
+        command = ["scp", "-q"] + self.options() + sources + [destination]
+        logger.debug(command)
+        subprocess.check_call(command)
+        return [os.path.join(destination, name) for name in names]
+
+    def remove(self, names):
+        if not names:
+            return
+        self.ssh("cd {0} && rm -f {1}".format(self.path, " ".join(names)))
+
+
+class FileCollector(object):
+    """Move the image files of a series into an hdf5 file while the series
+    is being acquired.
+
+    A thread fetches the files matching the patterns passed to add(),
+    decodes them in a pool of workers and writes the frames in order.
+    Files are removed from the transport only once their frames are in the
+    hdf5 file.
+    """
+
+    def __init__(self, transport, hdf5_writer, read, workers=4,
+                 processes=True, timeout=30):
+        """
+        Args:
+            transport: where the files are
+            hdf5_writer: closed controls.hdf5.Hdf5Writer
+            read: module level function decoding a file into an array
+            workers: size of the pool running read
+            processes: use a process pool for cpu bound decoding, or a
+                thread pool for io bound reading
+            timeout: seconds to wait for the files expected by add()
+        """
+        super(FileCollector, self).__init__()
+        self.transport = transport
+        self.hdf5_writer = hdf5_writer
+        self.read = read
+        self.workers = workers
+        self.processes = processes
+        self.timeout = timeout
+        self.patterns = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(
+            target=self._run, name="file-collector")
+        self.thread.daemon = True
+
+    @property
+    def filename(self):
+        return self.hdf5_writer.filename
+
+    def start(self):
+        self.hdf5_writer.open()
+        self.thread.start()
+
+    def add(self, pattern, count=None):
+        """Collect the files matching pattern, once they are complete.
+
+        Args:
+            count: number of files expected, waited for up to timeout
+                seconds. Otherwise only the files already there are taken.
+        """
+        self.patterns.put((pattern, count))
+
+    def finish(self):
+        "Wait for all the files to be written and close the hdf5 file"
+        self.patterns.put(None)
+        self.thread.join()
+        if self.errors:
+            raise controls.exceptions.CameraInterrupt(
+                "collecting the images into {0} failed: {1}".format(
+                    self.filename, self.errors[0]))
+
+    def _list(self, pattern, count):
+        names = self.transport.list(pattern)
+        if count is None:
+            return names
+        deadline = time.time() + self.timeout
+        while len(names) < count and time.time() < deadline:
+            time.sleep(0.05)
+            names = self.transport.list(pattern)
+        if len(names) < count:
+            logger.error("only %d of %d files %s after %s s",
+                         len(names), count, pattern, self.timeout)
+        return names
+
+    def _run(self):
+        tempdir = tempfile.mkdtemp()
+        if self.processes:
+            executor = ProcessPoolExecutor(self.workers)
+        else:
+            executor = ThreadPoolExecutor(self.workers)
+        # (name, decoded frame) in acquisition order
+        pending = []
+        finished = False
+        try:
+            while not finished:
+                try:
+                    # block only when there is nothing left to commit
+                    item = self.patterns.get(
+                        timeout=0.1 if pending else None)
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    finished = True
+                elif item:
+                    with controls.timing.span("collector.list"):
+                        names = self._list(*item)
+                    logger.debug("collecting %s", names)
+                    with controls.timing.span("collector.fetch"):
+                        paths = self.transport.fetch(names, tempdir)
+                    pending.extend(
+                        (name, executor.submit(self.read, path))
+                        for name, path in zip(names, paths))
+                pending = self._commit(pending, tempdir, wait=finished)
+        except Exception as e:
+            logger.exception("collecting %s failed", self.filename)
+            self.errors.append(e)
+        finally:
+            executor.shutdown()
+            shutil.rmtree(tempdir)
+            self.hdf5_writer.close()
+
+    def _commit(self, pending, tempdir, wait=False):
+        """Write the decoded frames at the head of pending, then remove
+        their files. With wait, write all of them.
+
+        Returns:
+            the frames still being decoded
+        """
+        committed = []
+        while pending and (wait or pending[0][1].done()):
+            name, future = pending.pop(0)
+            with controls.timing.span("collector.decode_wait"):
+                frame = future.result()
+            self.hdf5_writer.write(frame)
+            committed.append(name)
+        if committed:
+            self.hdf5_writer.flush()
+            self.transport.remove(committed)
+            for name in committed:
+                local_copy = os.path.join(tempdir, name)
+                if os.path.exists(local_copy):
+                    os.remove(local_copy)
+        return pending
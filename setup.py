@@ -38,9 +38,15 @@ setup(
         'h5py',
         'pyserial',
         'requests',
+        'futures; python_version < "3"',
     ],
+    extras_require={
+        # lz4 and bitshuffle chunk compression in controls.hdf5
+        'compression': ['lz4', 'bitshuffle'],
+    },
     entry_points="""
     [console_scripts]
     bunker4controls = controls.scripts.cli:main
+    bunker4benchmark = controls.scripts.benchmark:main
     """
 )
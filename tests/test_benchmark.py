@@ -0,0 +1,26 @@
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import controls.scripts.benchmark
+
+SCENARIOS = [
+    ["dscan", "--intervals", "2", "--exposure-time", "0.001"],
+    ["phase-stepping", "--intervals", "1", "--phase-steps", "3",
+     "--exposure-time", "0.001"],
+]
+
+
+@pytest.mark.parametrize("detector", controls.scripts.benchmark.DETECTORS)
+@pytest.mark.parametrize("scenario", SCENARIOS, ids=lambda s: s[0])
+def test_runs_without_albula_or_epics(detector, scenario):
+    subprocess.check_call([sys.executable, "-c", textwrap.dedent("""
+        import sys
+        sys.modules["dectris"] = None
+        sys.modules["dectris.albula"] = None
+        sys.modules["epics"] = None
+        import controls.scripts.benchmark
+        controls.scripts.benchmark.main(sys.argv[1:])
+        """)] + scenario + ["--detector", detector])
@@ -0,0 +1,32 @@
+import h5py
+import pytest
+
+import controls.hamamatsu_flat_panel
+import controls.hdf5
+import controls.simulators.hamamatsu
+
+
+@pytest.mark.parametrize("reply_delimiter", [None, "\n"])
+def test_snaps_with_either_framing(tmpdir, reply_delimiter):
+    image_path = tmpdir.mkdir("images")
+    with controls.simulators.hamamatsu.SimulatedHamamatsuServer(
+            str(image_path), reply_delimiter=reply_delimiter) as server:
+        detector = controls.hamamatsu_flat_panel.HamamatsuFlatPanel(
+            server.host, server.port,
+            storage_path=str(tmpdir),
+            local_image_path=str(image_path),
+            save_mode=controls.hamamatsu_flat_panel.SAVE_HDF5,
+            reply_delimiter=reply_delimiter)
+        try:
+            detector.setNTrigger(3)
+            detector.arm()
+            for _ in range(3):
+                assert detector.trigger(0.001) == "OK"
+            detector.disarm()
+            filename = detector.save()
+        finally:
+            detector.close()
+    with h5py.File(filename, "r") as input_file:
+        stack = input_file[
+            controls.hdf5.DATA_GROUP + "/" + controls.hdf5.STACK_DATASET]
+        assert stack.shape == (3, 600, 1000)
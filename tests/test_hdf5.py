@@ -0,0 +1,169 @@
+import subprocess
+import sys
+import textwrap
+
+import h5py
+import numpy as np
+import pytest
+
+import controls.hdf5
+
+
+def frames(n=3, shape=(32, 48), dtype=np.uint16):
+    random = np.random.RandomState(0)
+    return random.poisson(3, (n,) + shape).astype(dtype)
+
+
+@pytest.mark.parametrize("layout", [
+    controls.hdf5.LAYOUT_STACK, controls.hdf5.LAYOUT_PER_FRAME])
+@pytest.mark.parametrize("dtype", [np.uint16, np.uint32])
+def test_bslz4_readable_with_the_filter(tmpdir, layout, dtype):
+    pytest.importorskip("bitshuffle.h5")
+    filename = str(tmpdir.join("series.h5"))
+    data = frames(dtype=dtype)
+    writer = controls.hdf5.Hdf5Writer(
+        filename, compression=controls.hdf5.COMPRESSION_BSLZ4,
+        layout=layout)
+    writer.open()
+    for frame in data:
+        writer.write(frame)
+    writer.close()
+    with h5py.File(filename, "r") as input_file:
+        group = input_file[controls.hdf5.DATA_GROUP]
+        if layout == controls.hdf5.LAYOUT_STACK:
+            datasets = [group[controls.hdf5.STACK_DATASET]]
+            read = datasets[0][...]
+        else:
+            datasets = [group[name] for name in sorted(group)]
+            read = np.stack([dataset[...] for dataset in datasets])
+        for dataset in datasets:
+            filters = dataset.id.get_create_plist()
+            _, options, _ = filters.get_filter_by_id(
+                controls.hdf5.BITSHUFFLE_FILTER)
+            assert options[2:] == (
+                np.dtype(dtype).itemsize,
+                controls.hdf5.bitshuffle_block_size(
+                    np.dtype(dtype).itemsize),
+                controls.hdf5.BITSHUFFLE_LZ4)
+    np.testing.assert_array_equal(read, data)
+
+
+def test_lz4_readable_with_the_filter(tmpdir):
+    pytest.importorskip("hdf5plugin")
+    filename = str(tmpdir.join("series.h5"))
+    data = frames()
+    writer = controls.hdf5.Hdf5Writer(
+        filename, compression=controls.hdf5.COMPRESSION_LZ4)
+    writer.open()
+    for frame in data:
+        writer.write(frame)
+    writer.close()
+    with h5py.File(filename, "r") as input_file:
+        read = input_file[
+            controls.hdf5.DATA_GROUP + "/" + controls.hdf5.STACK_DATASET][...]
+    np.testing.assert_array_equal(read, data)
+
+
+def test_bslz4_written_without_the_filter(tmpdir):
+    pytest.importorskip("bitshuffle.h5")
+    filename = str(tmpdir.join("series.h5"))
+    # a fresh interpreter in which no hdf5 filter plugin is registered
+    subprocess.check_call([sys.executable, "-c", textwrap.dedent("""
+        import sys
+        sys.modules["bitshuffle.h5"] = None
+        sys.modules["hdf5plugin"] = None
+        import h5py
+        import numpy as np
+        import controls.hdf5
+        assert not h5py.h5z.filter_avail(controls.hdf5.BITSHUFFLE_FILTER)
+        writer = controls.hdf5.Hdf5Writer(
+            sys.argv[1], compression=controls.hdf5.COMPRESSION_BSLZ4)
+        writer.open()
+        writer.write(np.arange(32 * 48, dtype=np.uint16).reshape(32, 48))
+        writer.close()
+        """), filename])
+    with h5py.File(filename, "r") as input_file:
+        read = input_file[
+            controls.hdf5.DATA_GROUP + "/" + controls.hdf5.STACK_DATASET][0]
+    np.testing.assert_array_equal(
+        read, np.arange(32 * 48, dtype=np.uint16).reshape(32, 48))
+
+
+@pytest.mark.parametrize("layouts", [
+    (controls.hdf5.LAYOUT_PER_FRAME, controls.hdf5.LAYOUT_PER_FRAME),
+    (controls.hdf5.LAYOUT_STACK, controls.hdf5.LAYOUT_PER_FRAME),
+])
+def test_segments_of_per_frame_series(tmpdir, layouts):
+    data = frames(5)
+    segments = []
+    # the first series died after 3 frames, of which 2 were journaled
+    for layout, (written, done) in zip(layouts, [(3, 2), (3, 3)]):
+        filename = str(tmpdir.join("series_{0}.h5".format(len(segments))))
+        writer = controls.hdf5.Hdf5Writer(filename, layout=layout)
+        writer.open()
+        start = sum(n_done for _, n_done in segments)
+        for frame in data[start:start + written]:
+            writer.write(frame)
+        writer.close()
+        assert controls.hdf5.count_frames(filename) == written
+        segments.append((filename, done))
+    output_file = str(tmpdir.join("scan.h5"))
+    controls.hdf5.write_segments(output_file, segments)
+    with controls.hdf5.SeriesReader(output_file) as series:
+        np.testing.assert_array_equal(series[:], data)
+
+
+def test_compressed_frames_written_without_the_codec(tmpdir, monkeypatch):
+    pytest.importorskip("bitshuffle.h5")
+    data = frames()
+    compressor = controls.hdf5.ChunkCompressor(
+        controls.hdf5.COMPRESSION_BSLZ4)
+    compressed = [
+        controls.hdf5.CompressedFrame(
+            compressor.compress(frame), frame.shape, frame.dtype,
+            controls.hdf5.COMPRESSION_BSLZ4)
+        for frame in data]
+    monkeypatch.setattr(controls.hdf5, "bitshuffle", None)
+    with pytest.raises(ImportError):
+        compressed[0].data()
+    filename = str(tmpdir.join("series.h5"))
+    writer = controls.hdf5.Hdf5Writer(
+        filename, compression=controls.hdf5.COMPRESSION_BSLZ4)
+    writer.open()
+    for frame in compressed:
+        writer.write(frame)
+    writer.close()
+    # frames to compress fall back to gzip
+    gzip_file = str(tmpdir.join("gzip.h5"))
+    writer = controls.hdf5.Hdf5Writer(
+        gzip_file, compression=controls.hdf5.COMPRESSION_BSLZ4)
+    writer.open()
+    writer.write(data[0])
+    writer.close()
+    monkeypatch.undo()
+    with h5py.File(filename, "r") as input_file:
+        stack = input_file[
+            controls.hdf5.DATA_GROUP + "/" + controls.hdf5.STACK_DATASET]
+        assert stack.id.read_direct_chunk((1, 0, 0))[1] == compressed[1].chunk
+        np.testing.assert_array_equal(stack[...], data)
+    with h5py.File(gzip_file, "r") as input_file:
+        stack = input_file[
+            controls.hdf5.DATA_GROUP + "/" + controls.hdf5.STACK_DATASET]
+        assert stack.compression == "gzip"
+        np.testing.assert_array_equal(stack[0], data[0])
+
+
+@pytest.mark.parametrize("compression", [None, controls.hdf5.COMPRESSION_GZIP])
+def test_frame_order(tmpdir, compression):
+    filename = str(tmpdir.join("series.h5"))
+    data = frames(n=8)
+    frame_order = [0, 1, 3, 2, 4, 5, 7, 6]
+    writer = controls.hdf5.Hdf5Writer(
+        filename, compression=compression, batch_size=3,
+        frame_order=frame_order)
+    writer.open()
+    for frame in data:
+        writer.write(frame)
+    writer.close()
+    with controls.hdf5.SeriesReader(filename) as series:
+        np.testing.assert_array_equal(series[frame_order], data)
@@ -0,0 +1,83 @@
+import pytest
+
+import controls.exceptions
+import controls.motors
+import controls.simulators.pv
+
+NAME = "X02DA-BNK-HE:G1_TRX"
+
+
+@pytest.fixture
+def ioc():
+    return controls.simulators.pv.SimulatedIOC(speed=10.0)
+
+
+@pytest.fixture
+def motor(ioc):
+    return controls.motors.Motor(NAME, "g1trx", pv_factory=ioc.pv)
+
+
+def test_cached_reads_do_not_get(ioc, motor, monkeypatch):
+    def get(self, *args, **kwargs):
+        raise AssertionError("{0} read from the IOC".format(self.pvname))
+    monkeypatch.setattr(controls.simulators.pv.SimulatedPV, "get", get)
+    for _ in range(3):
+        assert motor.get_current_value() == 0.0
+        assert motor.get_readback() == 0.0
+        assert motor.get_high_limit() == 100.0
+        assert motor.get_low_limit() == -100.0
+        assert not motor.is_moving()
+        motor.check_position(50.0)
+
+
+def test_monitors_refresh_the_cache(ioc, motor):
+    record = ioc.record(NAME)
+    record.pvs["HLM"].update(5.0)
+    record.pvs["LLM"].update(-5.0)
+    record.pvs["RBV"].update(1.5)
+    record.pvs["DMOV"].update(0)
+    assert motor.get_high_limit() == 5.0
+    assert motor.get_low_limit() == -5.0
+    assert motor.get_readback() == 1.5
+    assert motor.is_moving()
+    record.pvs["DMOV"].update(1)
+    assert not motor.is_moving()
+
+
+def test_move_completes_with_dmov(ioc, motor):
+    readbacks = []
+    motor.add_readback_callback(lambda value, now: readbacks.append(value))
+    move = motor.mv(1.0, wait=False)
+    assert motor.is_moving()
+    assert not move.done()
+    move.wait(timeout=5)
+    assert move.done()
+    assert not motor.is_moving()
+    assert motor.get_current_value() == 1.0
+    assert motor.get_readback() == 1.0
+    assert len(readbacks) > 1
+
+
+def test_move_times_out(ioc, motor):
+    move = motor.mv(50.0, wait=False)
+    with pytest.raises(controls.exceptions.MotorInterrupt):
+        move.wait(timeout=0.05)
+
+
+def test_limits_are_refused(ioc, motor):
+    with pytest.raises(controls.exceptions.MotorInterrupt):
+        motor.mv(101.0)
+    with pytest.raises(controls.exceptions.MotorInterrupt):
+        motor.mvr(-101.0)
+    assert ioc.record(NAME).moves == 0
+
+
+def test_group_refuses_before_moving(ioc, motor):
+    other = controls.motors.Motor(
+        "X02DA-BNK-HE:G2_TRX", "g2trx", pv_factory=ioc.pv)
+    group = controls.motors.MotorGroup([motor, other])
+    with pytest.raises(controls.exceptions.MotorInterrupt):
+        group.mv({motor: 1.0, other: 200.0})
+    assert ioc.record(NAME).moves == 0
+    group.mv({motor: 0.5, other: -0.5}, timeout=5)
+    assert group.get_current_value() == {motor: 0.5, other: -0.5}
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import controls.hdf5
+import controls.phase_retrieval
+
+
+@pytest.mark.parametrize("layout,num_image_per_file", [
+    (controls.hdf5.LAYOUT_STACK, None),
+    (controls.hdf5.LAYOUT_STACK, 5),
+    (controls.hdf5.LAYOUT_PER_FRAME, None),
+])
+def test_flat_from_file_of_any_layout(tmpdir, layout, num_image_per_file):
+    filename = str(tmpdir.join("flat.h5"))
+    phase_steps = 4
+    random = np.random.RandomState(0)
+    curves = random.uniform(10, 20, (phase_steps, 8, 6))
+    # 3 positions of the outer motor, 2 frames per phase step
+    points = np.repeat(np.arange(3 * phase_steps), 2)
+    writer = controls.hdf5.Hdf5Writer(
+        filename, layout=layout, num_image_per_file=num_image_per_file,
+        n_frames=len(points))
+    writer.open()
+    for point in points:
+        writer.write(curves[point % phase_steps])
+    writer.close()
+    controls.hdf5.write_scan_data(filename, {"point": points})
+    flat = controls.phase_retrieval.FlatReference.from_file(
+        filename, phase_steps)
+    expected = controls.phase_retrieval.FlatReference(curves)
+    np.testing.assert_allclose(flat.mean, expected.mean)
+    np.testing.assert_allclose(flat.harmonic, expected.harmonic)
@@ -0,0 +1,157 @@
+import h5py
+import numpy as np
+import pytest
+
+import controls.eiger
+import controls.exceptions
+import controls.hdf5
+import controls.journal
+import controls.motors
+import controls.scans
+import controls.simulators.eiger
+import controls.simulators.pv
+import controls.timing
+
+
+@pytest.fixture
+def ioc():
+    return controls.simulators.pv.SimulatedIOC(speed=100.0)
+
+
+@pytest.fixture
+def motor(ioc):
+    return controls.motors.Motor("SIM:TRX", "trx", pv_factory=ioc.pv)
+
+
+@pytest.fixture
+def dcu():
+    with controls.simulators.eiger.SimulatedEiger((16, 20)) as dcu:
+        yield dcu
+
+
+@pytest.fixture
+def eiger(dcu, tmpdir):
+    return controls.eiger.Eiger(
+        dcu.host, dcu.port, storage_path=str(tmpdir), stream=dcu.stream)
+
+
+def scan_data(filename, name):
+    with h5py.File(filename, "r") as input_file:
+        return input_file[controls.hdf5.SCAN_GROUP + "/" + name][...]
+
+
+def test_fly_dscan_restores_n_images(dcu, eiger, motor, tmpdir):
+    positions = controls.scans.fly_dscan(
+        eiger, motor, 0, 0.1, 4, exposure_time=0.01)
+    assert len(positions) == 5
+    assert eiger.n_images == 1
+    assert dcu.config["nimages"] == 1
+    assert motor.get_current_value() == 0.0
+    output_file, = tmpdir.listdir("*.h5")
+    timestamps = scan_data(str(output_file), "timestamp")
+    assert np.all(np.diff(timestamps) > 0)
+
+
+@pytest.mark.parametrize("use_journal", [False, True])
+def test_serpentine_frames_in_canonical_order(
+        dcu, eiger, ioc, tmpdir, use_journal):
+    outer = controls.motors.Motor("SIM:TRX", "trx", pv_factory=ioc.pv)
+    inner = controls.motors.Motor("SIM:G2", "g2", pv_factory=ioc.pv)
+
+    def expose(readback, now):
+        # every frame tells the point it was taken at
+        point = (int(round(outer.get_readback() / 0.5)) * 3 +
+                 int(round(inner.get_readback() * 3)))
+        dcu.frame = np.full((16, 20), point, dtype=np.uint32)
+    outer.add_readback_callback(expose)
+    inner.add_readback_callback(expose)
+    journal = str(tmpdir.join("scan.json")) if use_journal else None
+    output_file = controls.scans.phase_stepping_scan(
+        eiger, outer, 0, 1, 2, inner, 0, 1, 3,
+        exposure_time=0.001, frames_per_point=2,
+        order=controls.scans.TRAVERSAL_SERPENTINE, overlap=False,
+        journal=journal)
+    assert eiger.frame_order is None
+    canonical = np.arange(18)
+    with controls.hdf5.SeriesReader(output_file) as series:
+        assert len(series) == 18
+        assert np.all(series[:, 0, 0] == canonical // 2)
+    np.testing.assert_array_equal(
+        scan_data(output_file, "canonical_frame"), canonical)
+    np.testing.assert_array_equal(
+        scan_data(output_file, "point"), canonical // 2)
+    np.testing.assert_allclose(
+        scan_data(output_file, "g2"), np.tile(np.repeat(
+            [0, 1 / 3, 2 / 3], 2), 3))
+
+
+def test_resume_with_the_motors_left_mid_scan(
+        dcu, eiger, motor, tmpdir, monkeypatch):
+    def expose(readback, now):
+        dcu.frame = np.full((16, 20), int(round(readback * 10)),
+                            dtype=np.uint32)
+    motor.add_readback_callback(expose)
+    journal = str(tmpdir.join("scan.json"))
+    trigger_async = eiger.trigger_async
+    triggers = []
+
+    def failing_trigger(exposure_time=1, timeout=10):
+        triggers.append(exposure_time)
+        if len(triggers) == 4:
+            raise controls.exceptions.EigerError("lost the detector")
+        return trigger_async(exposure_time, timeout)
+    monkeypatch.setattr(eiger, "trigger_async", failing_trigger)
+    with pytest.raises(controls.exceptions.EigerError):
+        controls.scans.dscan(
+            eiger, motor, 0, 0.5, 5, exposure_time=0.001, journal=journal)
+    monkeypatch.undo()
+    # as if the failed run had died before taking the motor back
+    motor.mv(0.3)
+    output_file = controls.scans.dscan(
+        eiger, motor, 0, 0.5, 5, exposure_time=0.001, journal=journal)
+    assert motor.get_current_value() == 0.0
+    segments = controls.journal.ScanJournal(journal).load().segments
+    assert [n_done for _, n_done in segments] == [3, 3]
+    with controls.hdf5.SeriesReader(output_file) as series:
+        np.testing.assert_array_equal(series[:, 0, 0], np.arange(6))
+    np.testing.assert_allclose(
+        scan_data(output_file, "trx"), np.linspace(0, 0.5, 6))
+
+
+def test_timing_report_of_each_scan(dcu, eiger, motor, caplog):
+    controls.timing.enable()
+    try:
+        with caplog.at_level("INFO", logger="controls.scans"):
+            for intervals in (2, 4):
+                controls.scans.dscan(
+                    eiger, motor, 0, 0.1, intervals, exposure_time=0.001)
+    finally:
+        controls.timing.disable()
+    reports = [record.getMessage() for record in caplog.records
+               if record.getMessage().startswith("scan timing")]
+    assert len(reports) == 2
+    for report, n_points in zip(reports, (3, 5)):
+        trigger, = [line.split() for line in report.splitlines()
+                    if line.startswith("scan.trigger ")]
+        assert int(trigger[1]) == n_points
+
+
+@pytest.mark.parametrize("decimation", [0, 2])
+def test_alignment_dscan_saves_the_decimated_frames(
+        dcu, eiger, motor, tmpdir, decimation):
+    alignment = controls.scans.alignment_dscan(
+        eiger, motor, 0, 0.4, 4, exposure_time=0.001,
+        decimation=decimation)
+    assert np.all(np.isfinite(alignment.values))
+    assert eiger.decimation == 1
+    output_files = tmpdir.listdir("*.h5")
+    if not decimation:
+        assert output_files == []
+        return
+    output_file, = output_files
+    with controls.hdf5.SeriesReader(str(output_file)) as series:
+        assert len(series) == 3
+    np.testing.assert_array_equal(
+        scan_data(str(output_file), "frame"), [0, 2, 4])
+    np.testing.assert_allclose(
+        scan_data(str(output_file), "trx"), [0, 0.2, 0.4])